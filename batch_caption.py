@@ -0,0 +1,200 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import datetime
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Set
+
+from dotenv import load_dotenv
+
+from caption_generation import DEFAULT_MODELS, MultiModalCaptionGenerator
+from image_ingest import IngestedImage
+from rate_limiting import PRIORITY_BATCH
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".tif", ".webp"}
+MANIFEST_EXTENSIONS = {".txt", ".jsonl", ".lst"}
+
+
+def iter_image_paths(sources:Iterable[str])->Iterator[str]:
+    """Lazily expand directories, glob patterns and manifest files into image paths"""
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                        yield os.path.join(root, name)
+        elif glob.has_magic(source):
+            for path in glob.iglob(source, recursive=True):
+                if os.path.isfile(path):
+                    yield path
+        elif os.path.splitext(source)[1].lower() in MANIFEST_EXTENSIONS:
+            yield from iter_manifest(source)
+        else:
+            yield source
+
+
+def iter_manifest(manifest_path:str)->Iterator[str]:
+    # Manifests hold one path per line, either bare or as a JSON object with a "path" key
+    base_dir = os.path.dirname(manifest_path)
+    with open(manifest_path, mode="r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = json.loads(line)["path"] if line.startswith("{") else line
+            yield path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+
+def load_completed(output_path:str)->Set[str]:
+    """Paths already captioned successfully by a previous run writing to the same file"""
+    completed = set()
+    try:
+        with open(output_path, mode="r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A run killed mid-write can leave a truncated last line
+                    continue
+                if record.get("caption") is not None:
+                    completed.add(record["path"])
+    except FileNotFoundError:
+        pass
+    return completed
+
+
+def percentile(values:List[float], pct:float)->float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class BatchCaptioner:
+    def __init__(self, generator:MultiModalCaptionGenerator, provider:str, model:str|None=None,
+    concurrency:int=8, use_cache:bool|None=None, fsync_every:int=50) -> None:
+        self.generator = generator
+        self.provider = provider
+        self.model = model or DEFAULT_MODELS[provider]
+        self.concurrency = concurrency
+        self.use_cache = use_cache
+        self.fsync_every = fsync_every
+
+    def caption_file(self, path:str)->Dict:
+        start = time.perf_counter()
+        record = {"path": path, "provider": self.provider, "model": self.model, "caption": None}
+        try:
+            # Large JPEGs decode straight to the working resolution; only the compact payload is kept
+            prepared = self.generator.prepare_image(IngestedImage(path).working)
+            prepared.encode(self.provider)
+            prepared.release({"phash", self.generator.duplicate_index.method})
+
+            record["caption"] = self.generator.generate_caption(
+                prepared, self.provider, model=self.model, use_cache=self.use_cache, priority=PRIORITY_BATCH
+            )
+        except Exception as e:
+            record["error"] = str(e)
+
+        record["elapsed"] = round(time.perf_counter() - start, 4)
+        record["timestamp"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return record
+
+    def run(self, sources:Iterable[str], output_path:str, limit:int|None=None)->Dict:
+        completed = load_completed(output_path)
+        latencies = []
+        succeeded = failed = skipped = 0
+        start = time.perf_counter()
+
+        with open(output_path, mode="a") as out, ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            pending: Set[Future] = set()
+            written = 0
+
+            def drain(block_until_below:int):
+                nonlocal succeeded, failed, written
+                while len(pending) > block_until_below:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                        record = future.result()
+                        out.write(json.dumps(record) + "\n")
+                        out.flush()
+                        written += 1
+                        if written % self.fsync_every == 0:
+                            os.fsync(out.fileno())
+
+                        latencies.append(record["elapsed"])
+                        if record["caption"] is not None:
+                            succeeded += 1
+                        else:
+                            failed += 1
+
+            submitted = 0
+            for path in iter_image_paths(sources):
+                if path in completed:
+                    skipped += 1
+                    continue
+                if limit is not None and submitted >= limit:
+                    break
+
+                # Only a bounded window of images is in flight, so memory stays flat
+                drain(self.concurrency * 2 - 1)
+                pending.add(pool.submit(self.caption_file, path))
+                submitted += 1
+
+            drain(0)
+            os.fsync(out.fileno())
+
+        elapsed = time.perf_counter() - start
+        processed = succeeded + failed
+        return {
+            "succeeded": succeeded,
+            "failed": failed,
+            "skipped": skipped,
+            "elapsed": round(elapsed, 3),
+            "images_per_second": round(processed / elapsed, 3) if elapsed else 0.0,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "latency_p99": percentile(latencies, 99)
+        }
+
+
+def main(argv:List[str]|None=None)->int:
+    parser = argparse.ArgumentParser(description="Caption a directory, glob or manifest of images to JSONL")
+    parser.add_argument("sources", nargs="+", help="Image directories, glob patterns, manifest files or image paths")
+    parser.add_argument("-o", "--output", default="captions.jsonl", help="JSONL file to append results to")
+    parser.add_argument("-p", "--provider", default="openai", choices=sorted(DEFAULT_MODELS))
+    parser.add_argument("-m", "--model", default=None, help="Model name (defaults to the provider's default)")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("--limit", type=int, default=None, help="Stop after submitting this many new images")
+    parser.add_argument("--no-cache", action="store_true", help="Always request fresh captions")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    generator = MultiModalCaptionGenerator()
+    generator.configure_apis(
+        openai_key=os.getenv("OPENAI_API_ICG"),
+        groq_key=os.getenv("GROQ_API_ICG"),
+        gemini_key=os.getenv("GEMINI_API_ICG")
+    )
+
+    captioner = BatchCaptioner(
+        generator, args.provider, model=args.model, concurrency=args.concurrency,
+        use_cache=False if args.no_cache else None
+    )
+    summary = captioner.run(args.sources, args.output, limit=args.limit)
+
+    print(
+        f"Captioned {summary['succeeded']} images ({summary['failed']} failed, {summary['skipped']} already done) "
+        f"in {summary['elapsed']:.1f}s: {summary['images_per_second']:.2f} images/s, "
+        f"latency p50 {summary['latency_p50']:.2f}s / p95 {summary['latency_p95']:.2f}s / p99 {summary['latency_p99']:.2f}s"
+    )
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,497 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple
+
+from dotenv import load_dotenv
+
+from batch_caption import iter_image_paths
+from caption_generation import CAPTION_PROMPT, DEFAULT_MODELS, MultiModalCaptionGenerator, vision_messages
+from caption_history import CaptionHistory
+from image_ingest import IngestedImage
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# The same request parameters as the synchronous calls, so batch results fill the same cache entries
+BATCH_PARAMS = {
+    "openai": {"max_completion_tokens": 20000},
+    "groq": {"max_tokens": 500, "temperature": 0.7}
+}
+
+# Provider limits per batch input file are 50,000 requests and 200 MB
+MAX_REQUESTS_PER_BATCH = 50_000
+MAX_BYTES_PER_BATCH = 190 * 1024 * 1024
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def _write_json(path:str, data:Dict):
+    # Written aside and renamed, so a crash never leaves a half-written state file
+    temp_path = f"{path}.tmp"
+    with open(temp_path, mode="w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def _read_jsonl(path:str)->Iterator[Dict]:
+    with open(path, mode="r") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+class OpenAIBatchBackend:
+    """The OpenAI batch protocol: upload an input file, create a batch, poll it, download the output.
+
+    Groq serves the same protocol, so its client works here too.
+    """
+
+    def __init__(self, client) -> None:
+        self.client = client
+
+    def upload(self, path:str)->str:
+        with open(path, mode="rb") as f:
+            return self.client.files.create(file=f, purpose="batch").id
+
+    def create(self, input_file_id:str, endpoint:str=BATCH_ENDPOINT)->str:
+        return self.client.batches.create(input_file_id=input_file_id, endpoint=endpoint, completion_window="24h").id
+
+    def retrieve(self, batch_id:str)->Dict:
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        return {
+            "id": batch.id,
+            "status": batch.status,
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id,
+            "request_counts": counts.model_dump() if counts is not None else {}
+        }
+
+    def download(self, file_id:str, path:str):
+        self.client.files.content(file_id).write_to_file(path)
+
+
+class LocalBatchBackend:
+    """File-based stand-in for the provider's batch service, for running whole jobs offline.
+
+    Files and batch records live under `root`; a LocalBatchServer pointed at the same root
+    does the processing, possibly in another process.
+    """
+
+    def __init__(self, root:str) -> None:
+        self.root = root
+        self.files_dir = os.path.join(root, "files")
+        self.batches_dir = os.path.join(root, "batches")
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.batches_dir, exist_ok=True)
+
+    def file_path(self, file_id:str)->str:
+        return os.path.join(self.files_dir, f"{file_id}.jsonl")
+
+    def batch_path(self, batch_id:str)->str:
+        return os.path.join(self.batches_dir, f"{batch_id}.json")
+
+    def upload(self, path:str)->str:
+        file_id = f"file-{uuid.uuid4().hex}"
+        shutil.copyfile(path, self.file_path(file_id))
+        return file_id
+
+    def create(self, input_file_id:str, endpoint:str=BATCH_ENDPOINT)->str:
+        if not os.path.exists(self.file_path(input_file_id)):
+            raise ValueError(f"Unknown input file: {input_file_id}")
+        batch_id = f"batch-{uuid.uuid4().hex}"
+        _write_json(self.batch_path(batch_id), {
+            "id": batch_id,
+            "status": "validating",
+            "endpoint": endpoint,
+            "input_file_id": input_file_id,
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": time.time(),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0}
+        })
+        return batch_id
+
+    def retrieve(self, batch_id:str)->Dict:
+        with open(self.batch_path(batch_id), mode="r") as f:
+            return json.load(f)
+
+    def download(self, file_id:str, path:str):
+        shutil.copyfile(self.file_path(file_id), path)
+
+
+def stub_response(request:Dict)->str:
+    """Deterministic caption for the stand-in server"""
+    digest = hashlib.sha256(json.dumps(request["body"], sort_keys=True).encode()).hexdigest()
+    return f"Stub caption {digest[:8]} for {request['custom_id']}"
+
+
+class LocalBatchServer:
+    """Processes batches submitted to a LocalBatchBackend, writing provider-format output files.
+
+    `respond(request)` returns the caption for one batch input line, or raises to report
+    that request as failed.
+    """
+
+    def __init__(self, root:str, respond:Callable[[Dict], str]=stub_response) -> None:
+        self.backend = LocalBatchBackend(root)
+        self.respond = respond
+
+    def _update(self, batch:Dict, **changes):
+        batch.update(changes)
+        _write_json(self.backend.batch_path(batch["id"]), batch)
+
+    def _process(self, batch:Dict):
+        self._update(batch, status="in_progress", in_progress_at=time.time())
+        output_file_id = f"file-{uuid.uuid4().hex}"
+        error_file_id = f"file-{uuid.uuid4().hex}"
+        completed = failed = 0
+
+        with open(self.backend.file_path(output_file_id), mode="w") as output, \
+                open(self.backend.file_path(error_file_id), mode="w") as errors:
+            for request in _read_jsonl(self.backend.file_path(batch["input_file_id"])):
+                line = {"id": f"batch_req_{uuid.uuid4().hex[:16]}", "custom_id": request["custom_id"]}
+                try:
+                    caption = self.respond(request)
+                except Exception as e:
+                    line.update(response=None, error={"code": "server_error", "message": str(e)})
+                    errors.write(json.dumps(line) + "\n")
+                    failed += 1
+                    continue
+                line.update(error=None, response={"status_code": 200, "body": {
+                    "object": "chat.completion",
+                    "model": request["body"].get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": caption},
+                        "finish_reason": "stop"}]
+                }})
+                output.write(json.dumps(line) + "\n")
+                completed += 1
+
+        self._update(batch, status="completed", completed_at=time.time(), output_file_id=output_file_id,
+            error_file_id=error_file_id if failed else None,
+            request_counts={"total": completed + failed, "completed": completed, "failed": failed})
+
+    def run_once(self)->int:
+        """Process every waiting batch; returns how many were processed"""
+        processed = 0
+        for name in sorted(os.listdir(self.backend.batches_dir)):
+            if not name.endswith(".json"):
+                continue
+            batch = self.backend.retrieve(name[:-len(".json")])
+            if batch["status"] == "validating":
+                self._process(batch)
+                processed += 1
+        return processed
+
+    def serve_forever(self, interval:float=1.0):
+        while True:
+            if not self.run_once():
+                time.sleep(interval)
+
+
+def _bounded_map(fn:Callable, items:Iterable, workers:int)->Iterator:
+    """Like pool.map, in order, but with only a small window of items in flight"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        window: deque[Future] = deque()
+        for item in items:
+            window.append(pool.submit(fn, item))
+            if len(window) >= workers * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+class BatchCaptionJob:
+    """A captioning run through a provider's batch API, resumable from its job directory.
+
+    prepare() writes batch input shards and a manifest of what each request ID refers to,
+    submit() uploads and starts each shard once, poll() waits for them, and merge() adds the
+    results to CaptionHistory. Request IDs derive from the caption cache key, so merging twice,
+    or merging images captioned before, adds nothing new.
+    """
+
+    def __init__(self, job_dir:str, backend, provider:str="openai", model:str|None=None,
+    generator:MultiModalCaptionGenerator|None=None, max_requests:int=MAX_REQUESTS_PER_BATCH,
+    max_bytes:int=MAX_BYTES_PER_BATCH) -> None:
+        if provider not in BATCH_PARAMS:
+            raise ValueError(f"Batch jobs aren't supported for {provider}")
+        self.job_dir = job_dir
+        self.backend = backend
+        self.generator = generator or MultiModalCaptionGenerator(use_cache=False)
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.state_path = os.path.join(job_dir, "job.json")
+        self.manifest_path = os.path.join(job_dir, "manifest.jsonl")
+        os.makedirs(job_dir, exist_ok=True)
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path, mode="r") as f:
+                self.state = json.load(f)
+        else:
+            self.state = {"provider": provider, "model": model or DEFAULT_MODELS[provider], "shards": []}
+
+    @property
+    def provider(self)->str:
+        return self.state["provider"]
+
+    @property
+    def model(self)->str:
+        return self.state["model"]
+
+    def _save(self):
+        _write_json(self.state_path, self.state)
+
+    def _encode(self, path:str)->Tuple[str, Dict, str]|Tuple[str, None, str]:
+        try:
+            prepared = self.generator.prepare_image(IngestedImage(path).working)
+            encoded = prepared.encode(self.provider)
+            params = BATCH_PARAMS[self.provider]
+            cache_key = self.generator._cache_key(self.provider, self.model, prepared, params)
+            request_id = f"icg-{cache_key[:40]}"
+            request = {
+                "custom_id": request_id,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {"model": self.model, "messages": vision_messages(CAPTION_PROMPT, encoded.data_url), **params}
+            }
+            entry = {
+                "request_id": request_id,
+                "path": path,
+                "image_name": os.path.basename(path),
+                "content_hash": prepared.fingerprint,
+                "perceptual_hash": prepared.perceptual_hash,
+                "cache_key": cache_key
+            }
+            return path, {"request": request, "entry": entry}, ""
+        except Exception as e:
+            return path, None, str(e)
+
+    def prepare(self, sources:Iterable[str], skip_request_ids:Set[str]|None=None, workers:int=4)->Dict:
+        """Write batch input shards for the images, skipping request IDs already known"""
+        if self.state["shards"]:
+            raise ValueError(f"Job in {self.job_dir} is already prepared")
+        seen = set(skip_request_ids or ())
+        shards = []
+        prepared = skipped = failed = 0
+        shard_file = None
+        shard = None
+
+        with open(self.manifest_path, mode="w") as manifest:
+            for path, item, error in _bounded_map(self._encode, iter_image_paths(sources), workers):
+                if item is None:
+                    print(f"Skipping {path}: {error}", file=sys.stderr)
+                    failed += 1
+                    continue
+                request_id = item["entry"]["request_id"]
+                if request_id in seen:
+                    skipped += 1
+                    continue
+                seen.add(request_id)
+
+                line = json.dumps(item["request"]) + "\n"
+                size = len(line.encode())
+                if shard is None or shard["requests"] >= self.max_requests or shard["bytes"] + size > self.max_bytes:
+                    if shard_file is not None:
+                        shard_file.close()
+                    shard = {"input": f"requests-{len(shards):04d}.jsonl", "requests": 0, "bytes": 0, "status": "prepared"}
+                    shards.append(shard)
+                    shard_file = open(os.path.join(self.job_dir, shard["input"]), mode="w")
+                shard_file.write(line)
+                shard["requests"] += 1
+                shard["bytes"] += size
+                manifest.write(json.dumps(item["entry"]) + "\n")
+                prepared += 1
+
+        if shard_file is not None:
+            shard_file.close()
+        self.state["shards"] = shards
+        self._save()
+        return {"requests": prepared, "skipped": skipped, "failed": failed, "shards": len(shards)}
+
+    def submit(self)->List[str]:
+        """Upload and start every shard not started yet; safe to call again after a crash"""
+        batch_ids = []
+        for shard in self.state["shards"]:
+            if shard.get("batch_id") is None:
+                if shard.get("file_id") is None:
+                    shard["file_id"] = self.backend.upload(os.path.join(self.job_dir, shard["input"]))
+                    self._save()
+                shard["batch_id"] = self.backend.create(shard["file_id"])
+                shard["status"] = "submitted"
+                self._save()
+            batch_ids.append(shard["batch_id"])
+        return batch_ids
+
+    def refresh(self)->Dict[str, int]:
+        statuses: Dict[str, int] = {}
+        for shard in self.state["shards"]:
+            if shard.get("batch_id") and shard["status"] not in TERMINAL_STATUSES:
+                batch = self.backend.retrieve(shard["batch_id"])
+                shard.update(status=batch["status"], output_file_id=batch.get("output_file_id"),
+                    error_file_id=batch.get("error_file_id"), request_counts=batch.get("request_counts"))
+            statuses[shard["status"]] = statuses.get(shard["status"], 0) + 1
+        self._save()
+        return statuses
+
+    def poll(self, interval:float=30.0, timeout:float|None=None, on_update:Callable[[Dict], None]|None=None)->Dict[str, int]:
+        """Wait until every submitted shard has finished one way or another"""
+        unsubmitted = sum(1 for shard in self.state["shards"] if shard.get("batch_id") is None)
+        if unsubmitted:
+            # A prepared shard never reaches a final state by itself, so waiting on it would never end
+            raise ValueError(f"{unsubmitted} batch file(s) in {self.job_dir} have not been submitted yet")
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            statuses = self.refresh()
+            if on_update is not None:
+                on_update(statuses)
+            if all(status in TERMINAL_STATUSES for status in statuses):
+                return statuses
+            if deadline is not None and time.monotonic() >= deadline:
+                return statuses
+            time.sleep(interval)
+
+    def download(self)->List[str]:
+        paths = []
+        for index, shard in enumerate(self.state["shards"]):
+            for kind in ("output", "error"):
+                file_id = shard.get(f"{kind}_file_id")
+                path = os.path.join(self.job_dir, f"{kind}-{index:04d}.jsonl")
+                if file_id and not os.path.exists(path):
+                    self.backend.download(file_id, f"{path}.partial")
+                    os.replace(f"{path}.partial", path)
+                if os.path.exists(path):
+                    paths.append(path)
+        return paths
+
+    def merge(self, history:CaptionHistory, model_name:str|None=None)->Dict:
+        """Add finished captions to the history (and the caption cache) once per request ID"""
+        manifest = {entry["request_id"]: entry for entry in _read_jsonl(self.manifest_path)}
+        existing = {record["request_id"] for record in history.get_history() if record.get("request_id")}
+        merged = duplicates = failed = 0
+        failures = []
+
+        for path in self.download():
+            for line in _read_jsonl(path):
+                request_id = line.get("custom_id")
+                entry = manifest.get(request_id)
+                response = line.get("response") or {}
+                if entry is None:
+                    continue
+                if line.get("error") or response.get("status_code") != 200:
+                    failed += 1
+                    failures.append({"request_id": request_id, "path": entry["path"],
+                        "error": line.get("error") or response.get("body")})
+                    continue
+                if request_id in existing:
+                    duplicates += 1
+                    continue
+
+                caption = response["body"]["choices"][0]["message"]["content"]
+                self.generator.cache.put(entry["cache_key"], caption)
+                history.add_interaction(entry["image_name"], model_name or self.model, caption,
+                    content_hash=entry["content_hash"], perceptual_hash=entry["perceptual_hash"],
+                    request_id=request_id)
+                existing.add(request_id)
+                merged += 1
+
+        history.flush()
+        if failures:
+            with open(os.path.join(self.job_dir, "failures.jsonl"), mode="w") as f:
+                for failure in failures:
+                    f.write(json.dumps(failure) + "\n")
+        return {"merged": merged, "already_merged": duplicates, "failed": failed}
+
+
+def make_backend(provider:str, local_root:str|None, generator:MultiModalCaptionGenerator):
+    if local_root:
+        return LocalBatchBackend(local_root)
+    if provider == "openai":
+        key = os.getenv("OPENAI_API_ICG")
+        return OpenAIBatchBackend(generator.clients.openai(key)) if key else None
+    key = os.getenv("GROQ_API_ICG")
+    return OpenAIBatchBackend(generator.clients.groq(key)) if key else None
+
+
+def main(argv:List[str]|None=None)->int:
+    parser = argparse.ArgumentParser(description="Caption images through a provider batch API")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def job_parser(name:str, help_text:str)->argparse.ArgumentParser:
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("-j", "--job-dir", required=True)
+        sub.add_argument("-p", "--provider", default=None, choices=sorted(BATCH_PARAMS),
+            help="Defaults to the job's own provider, or openai for a new job")
+        sub.add_argument("-m", "--model", default=None)
+        sub.add_argument("--local", default=None, metavar="ROOT", help="Use the local stand-in server's directory")
+        sub.add_argument("--storage", default="jsonl", choices=["json", "jsonl", "sqlite"])
+        return sub
+
+    for name, help_text in (("prepare", "Write batch input files"), ("run", "Prepare, submit, wait and merge")):
+        sub = job_parser(name, help_text)
+        sub.add_argument("sources", nargs="+", help="Image directories, glob patterns, manifest files or image paths")
+        sub.add_argument("--workers", type=int, default=4)
+    job_parser("submit", "Upload and start prepared batches")
+    for name in ("poll", "run"):
+        sub = subparsers.choices.get(name) or job_parser(name, "Wait for submitted batches")
+        sub.add_argument("--interval", type=float, default=30.0)
+        sub.add_argument("--timeout", type=float, default=None)
+    job_parser("merge", "Merge finished results into the caption history")
+    serve = subparsers.add_parser("serve-local", help="Run the local stand-in batch server")
+    serve.add_argument("root")
+    serve.add_argument("--interval", type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve-local":
+        LocalBatchServer(args.root).serve_forever(args.interval)
+        return 0
+
+    load_dotenv()
+    generator = MultiModalCaptionGenerator()
+    job = BatchCaptionJob(args.job_dir, None, provider=args.provider or "openai", model=args.model, generator=generator)
+    # A resumed job keeps the provider it was prepared for; its batches only exist there
+    if args.provider and args.provider != job.provider:
+        print(f"Job in {args.job_dir} uses {job.provider}, not {args.provider}", file=sys.stderr)
+        return 1
+    job.backend = make_backend(job.provider, args.local, generator)
+    if job.backend is None and args.command != "prepare":
+        print(f"{job.provider} API key is not configured!", file=sys.stderr)
+        return 1
+    history = CaptionHistory(use_file_history=False, storage=args.storage)
+
+    try:
+        if args.command in ("prepare", "run") and not job.state["shards"]:
+            known = {record["request_id"] for record in history.get_history() if record.get("request_id")}
+            summary = job.prepare(args.sources, skip_request_ids=known, workers=args.workers)
+            print(f"Prepared {summary['requests']} requests in {summary['shards']} batch files "
+                f"({summary['skipped']} duplicates or already captioned, {summary['failed']} unreadable)")
+        if args.command in ("submit", "run"):
+            print(f"Submitted batches: {', '.join(job.submit()) or 'none'}")
+        if args.command in ("poll", "run"):
+            if any(shard.get("batch_id") is None for shard in job.state["shards"]):
+                print("Some batch files haven't been submitted yet; run submit first", file=sys.stderr)
+                return 1
+            statuses = job.poll(args.interval, args.timeout,
+                on_update=lambda statuses: print(f"Batch status: {statuses}", flush=True))
+            if not all(status in TERMINAL_STATUSES for status in statuses):
+                return 1
+        if args.command in ("merge", "run"):
+            summary = job.merge(history)
+            print(f"Merged {summary['merged']} captions ({summary['already_merged']} already merged, "
+                f"{summary['failed']} failed)")
+            return 1 if summary["failed"] else 0
+    finally:
+        history.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""Bulk caption export throughput as the process pool grows.
+
+Synthetic photos are written to a temporary directory and exported with each worker
+count, first decoding from files in the workers and then handing in-memory frames over
+shared memory versus pickling them. A plain single-process loop over the same inputs is
+each mode's baseline, and speedup and per-core efficiency are reported against it. Scaling is capped by the cores
+actually available. Run from the repository root:
+
+    python -m benchmarks.bench_bulk_render --images 200 --workers 1 2 4 8
+"""
+import os
+import time
+import argparse
+import tempfile
+from typing import List
+
+import cv2
+import numpy as np
+
+from bulk_render import BulkRenderer, RenderJob, RenderStyle, encode_frame, render_frame
+
+CAPTION = "A golden retriever leaps across a sunlit meadow chasing a bright red frisbee at dusk"
+
+
+def make_images(directory:str, count:int, width:int, height:int)->List[str]:
+    rng = np.random.default_rng(0)
+    # Smooth gradients plus noise compress like photos rather than like pure noise
+    base = np.linspace(0, 255, width, dtype=np.float32)[None, :, None] * np.ones((height, 1, 3), np.float32)
+    paths = []
+    for index in range(count):
+        noise = rng.normal(0, 12, (height, width, 3)).astype(np.float32)
+        image = np.clip(base * rng.uniform(0.3, 1.0, 3) + noise, 0, 255).astype(np.uint8)
+        path = os.path.join(directory, f"photo_{index:05d}.jpg")
+        cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        paths.append(path)
+    return paths
+
+
+def sequential(jobs:List[RenderJob], output_dir:str, style:RenderStyle, fmt:str)->float:
+    """Images per second rendering the jobs one after another in this process"""
+    start = time.perf_counter()
+    for index, job in enumerate(jobs):
+        frame = job.frame.copy() if job.frame is not None else cv2.imread(job.path)
+        with open(os.path.join(output_dir, f"sequential_{index}"), mode="wb") as f:
+            f.write(encode_frame(render_frame(frame, CAPTION, style), fmt, 90))
+    return len(jobs) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--workers", type=int, nargs="+", default=None)
+    parser.add_argument("--method", default="overlay", choices=["overlay", "background"])
+    parser.add_argument("--format", default="JPEG")
+    parser.add_argument("--font", default="fonts/Poppins-Regular.ttf" if os.path.exists("fonts/Poppins-Regular.ttf") else None)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, 2, 4, 8, cores} & set(range(1, cores + 1))) or [1]
+    style = RenderStyle(method=args.method, font_path=args.font)
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_dir = os.path.join(directory, "in")
+        os.makedirs(input_dir)
+        paths = make_images(input_dir, args.images, args.width, args.height)
+        file_jobs = [RenderJob(CAPTION, path=path) for path in paths]
+        # In-memory frames: copied into shared memory slots, or pickled into each task
+        frame_jobs = [RenderJob(CAPTION, frame=cv2.imread(path)) for path in paths[:64]]
+        modes = [("files", file_jobs, True), ("frames shm", frame_jobs, True), ("frames pickle", frame_jobs, False)]
+
+        print(f"{len(paths)} images {args.width}x{args.height}, {args.method}, {args.format}, {cores} cores available")
+        print(f"{'mode':>14} {'workers':>8} {'images/s':>9} {'speedup':>8} {'efficiency':>11}")
+        for mode, jobs, share_frames in modes:
+            baseline = sequential(jobs, directory, style, args.format)
+            print(f"{mode:>14} {'loop':>8} {baseline:>9.1f} {1.0:>8.2f} {'':>11}")
+            for workers in worker_counts:
+                renderer = BulkRenderer(os.path.join(directory, f"{mode}_{workers}"), style=style, workers=workers,
+                    fmt=args.format, ordered=False, share_frames=share_frames)
+                summary = renderer.run(jobs)
+                rate = summary["succeeded"] / summary["elapsed"]
+                print(f"{mode:>14} {workers:>8} {rate:>9.1f} {rate / baseline:>8.2f} {rate / baseline / workers:>11.0%}")
+
+
+if __name__ == "__main__":
+    main()
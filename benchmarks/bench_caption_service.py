@@ -0,0 +1,107 @@
+"""Load test for the caption HTTP service against a stub provider.
+
+A stub provider plugin sleeps for an injected latency instead of calling an API, so no keys
+or network are needed. The service runs on an ephemeral local port and is hit with a mix of
+repeated and distinct images at a fixed concurrency; repeated images that arrive while an
+identical request is still in flight should be coalesced into one upstream call. Run from
+the repository root:
+
+    python -m benchmarks.bench_caption_service --requests 2000 --concurrency 64
+"""
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from typing import List
+
+import aiohttp
+from aiohttp import web
+
+from batch_caption import percentile
+from caption_cache import CaptionCache
+from caption_generation import MultiModalCaptionGenerator
+from caption_service import CaptionService
+from benchmarks.stubs import StubProvider, make_images, register_stub
+
+
+async def run_load(url:str, images:List[bytes], requests:int, concurrency:int, hot_fraction:float,
+hot_images:int, endpoint:str, seed:int):
+    rng = random.Random(seed)
+    # A few hot images account for most traffic, the rest are each requested once
+    cold = iter(images[hot_images:])
+    bodies = [images[rng.randrange(hot_images)] if rng.random() < hot_fraction else next(cold, images[0])
+        for _ in range(requests)]
+
+    latencies, errors = [], 0
+    queue: asyncio.Queue = asyncio.Queue()
+    for body in bodies:
+        queue.put_nowait(body)
+
+    async def worker(session:aiohttp.ClientSession):
+        nonlocal errors
+        while not queue.empty():
+            body = queue.get_nowait()
+            start = time.perf_counter()
+            async with session.post(f"{url}{endpoint}?provider=stub&use_cache=0", data=body,
+                    headers={"Content-Type": "image/png"}) as response:
+                await response.read()
+                if response.status != 200:
+                    errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+async def main_async(args):
+    stub = StubProvider(args.latency, args.latency / 4, seed=args.seed)
+    register_stub(stub)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        generator = MultiModalCaptionGenerator(cache=CaptionCache(cache_dir), use_cache=False,
+            max_concurrency=args.concurrency)
+        generator.configure_apis(plugin_keys={"stub": "unused"})
+        service = CaptionService(generator, history=None, render_workers=args.render_workers)
+
+        runner = web.AppRunner(service.create_app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+
+        images = make_images(args.hot_images + args.requests, args.size, args.seed)
+        try:
+            latencies, errors, elapsed = await run_load(f"http://127.0.0.1:{port}", images, args.requests,
+                args.concurrency, args.hot_fraction, args.hot_images, args.endpoint, args.seed)
+        finally:
+            await runner.cleanup()
+
+    print(f"{args.requests} requests to {args.endpoint} at concurrency {args.concurrency} "
+        f"(stub latency {args.latency * 1000:.0f} ms, {args.hot_fraction:.0%} of traffic on {args.hot_images} images)")
+    print(f"  throughput   {args.requests / elapsed:8.1f} req/s over {elapsed:.2f}s, {errors} errors")
+    print(f"  latency ms   p50 {percentile(latencies, 50) * 1000:7.1f}   p95 {percentile(latencies, 95) * 1000:7.1f}"
+        f"   p99 {percentile(latencies, 99) * 1000:7.1f}")
+    print(f"  upstream     {stub.calls} provider calls, {service.single_flight.coalesced} requests coalesced")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.2, help="Median stub provider latency in seconds")
+    parser.add_argument("--hot-fraction", type=float, default=0.5)
+    parser.add_argument("--hot-images", type=int, default=8)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--render-workers", type=int, default=4)
+    parser.add_argument("--endpoint", default="/caption", choices=["/caption", "/caption/render"])
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
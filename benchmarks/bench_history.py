@@ -0,0 +1,103 @@
+"""Query latency of the history storage engines as the history grows.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_history --max-rows 1000000
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import datetime
+from typing import Callable, Dict, List
+
+from history_storage import HistoryStore, JsonLinesStore, SQLiteStore
+
+MODELS = ["OpenAI GPT-5 Nano", "Google  GEMINI 2.5 Flash Lite", "GROQ VISION"]
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+
+def synthetic_records(start:int, count:int)->List[Dict]:
+    base = datetime.datetime(2025, 1, 1)
+    return [
+        {
+            "timestamp": (base + datetime.timedelta(seconds=30 * i)).strftime("%Y-%m-%d %H:%M:%S"),
+            "image_name": f"image_{i % 50_000:05d}.jpg",
+            "model": MODELS[i % len(MODELS)],
+            "caption": f"Synthetic caption number {i} for benchmarking.",
+            "content_hash": f"{random.getrandbits(128):032x}"
+        }
+        for i in range(start, start + count)
+    ]
+
+
+def time_query(fn:Callable, repeats:int)->float:
+    """Median latency in milliseconds"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def bench_store(store:HistoryStore, sizes:List[int], repeats:int)->List[Dict]:
+    results = []
+    rows = 0
+    for size in sizes:
+        store.append_many(synthetic_records(rows, size - rows))
+        rows = size
+
+        window_start = (datetime.datetime(2025, 1, 1) + datetime.timedelta(seconds=30 * (size // 2)))
+        since = window_start.strftime("%Y-%m-%d %H:%M:%S")
+        until = (window_start + datetime.timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
+
+        queries = {
+            "recent_10": lambda: store.recent(10),
+            "model_page_50": lambda: store.query(model=MODELS[1], limit=50, newest_first=True),
+            "image_lookup": lambda: store.search("image_name", "image_00042.jpg"),
+            "time_range_1h": lambda: store.query(since=since, until=until),
+            "count_model": lambda: store.count(model=MODELS[2])
+        }
+        row = {"rows": size}
+        for name, fn in queries.items():
+            row[name] = time_query(fn, repeats)
+        results.append(row)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-rows", type=int, default=1_000_000)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--engines", nargs="+", default=["sqlite", "jsonl"], choices=["sqlite", "jsonl"])
+    parser.add_argument("--jsonl-max-rows", type=int, default=100_000,
+        help="Full scans get slow; cap the JSON-lines engine separately")
+    args = parser.parse_args()
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        for engine in args.engines:
+            if engine == "sqlite":
+                store = SQLiteStore(os.path.join(tmp, "history.db"), legacy_path=None)
+                limit = args.max_rows
+            else:
+                store = JsonLinesStore(os.path.join(tmp, "history.jsonl"), fsync="never", legacy_path=None)
+                limit = min(args.max_rows, args.jsonl_max_rows)
+
+            sizes = [size for size in SIZES if size <= limit]
+            results = bench_store(store, sizes, args.repeats)
+            store.close()
+
+            print(f"\n{engine} (median ms over {args.repeats} runs)")
+            columns = list(results[0].keys())
+            print("  ".join(f"{column:>14}" for column in columns))
+            for row in results:
+                print("  ".join(f"{row[column]:>14.3f}" if column != "rows" else f"{row[column]:>14,}"
+                    for column in columns))
+
+
+if __name__ == "__main__":
+    main()
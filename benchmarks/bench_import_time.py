@@ -0,0 +1,68 @@
+"""Cold import time of the app's entry modules, and which provider SDKs they drag in.
+
+Each module is imported in a fresh interpreter with `python -X importtime`; the best of
+several runs is reported. With --max-ms the script exits non-zero when any module is
+slower, so it can guard against an eager import creeping back in. Run from the
+repository root:
+
+    python -m benchmarks.bench_import_time --max-ms 1000
+"""
+import sys
+import argparse
+import subprocess
+from typing import Dict, List, Tuple
+
+MODULES = ["caption_generation", "caption_history", "batch_caption", "provider_router", "caption_overlay",
+    "video_overlay"]
+HEAVY_MODULES = ["openai", "groq", "google.generativeai", "httpx", "langchain_community"]
+
+
+def import_time(module:str)->Tuple[float, Dict[str, float]]:
+    """Cumulative import time of `module` in ms, plus the cumulative times of the heavy modules it imported"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True, capture_output=True, text=True
+    ).stderr
+
+    total = 0.0
+    heavy = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = [part.strip() for part in line[len("import time:"):].split("|")]
+        if not parts[1].isdigit():
+            continue
+        cumulative_ms = int(parts[1]) / 1000
+        name = parts[2]
+        if name == module:
+            total = cumulative_ms
+        elif name in HEAVY_MODULES:
+            heavy[name] = cumulative_ms
+    return total, heavy
+
+
+def main()->int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-ms", type=float, default=None, help="Fail if any module takes longer than this")
+    args = parser.parse_args()
+
+    failures: List[str] = []
+    print(f"{'module':>20} {'best ms':>9}  heavy imports")
+    for module in args.modules:
+        runs = [import_time(module) for _ in range(args.repeats)]
+        best, heavy = min(runs, key=lambda run: run[0])
+        heavy_list = ", ".join(f"{name} {ms:.0f}ms" for name, ms in heavy.items()) or "-"
+        print(f"{module:>20} {best:>9.1f}  {heavy_list}")
+        if args.max_ms is not None and best > args.max_ms:
+            failures.append(module)
+
+    if failures:
+        print(f"Slower than {args.max_ms:g} ms: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
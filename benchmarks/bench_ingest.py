@@ -0,0 +1,99 @@
+"""Decode time and peak memory of large JPEG uploads, full versus reduced-resolution decode.
+
+Each scenario decodes the same file in a fresh interpreter so peak RSS belongs to it alone:
+"pil full" is the old path (open, load, orientation, RGB), "pil draft" is IngestedImage's
+working decode, and the cv2 rows compare IMREAD_COLOR with IMREAD_REDUCED_COLOR_*. The
+files carry an EXIF rotation so orientation handling is part of the timing. Run from the
+repository root:
+
+    python -m benchmarks.bench_ingest --megapixels 24 48 100
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+# Generated in its own interpreter too: a child starts with the parent's peak RSS as its own
+MAKE_JPEG = r"""
+import sys
+from PIL import Image
+path, width, height = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+gradient = Image.linear_gradient("L")
+channels = (gradient.rotate(90).resize((width, height)), gradient.resize((width, height)),
+    Image.effect_noise((width, height), 24))
+exif = Image.Exif()
+exif[0x0112] = 6
+Image.merge("RGB", channels).save(path, "JPEG", quality=90, exif=exif.tobytes())
+"""
+
+SCENARIO = r"""
+import sys, json, time, resource
+from PIL import Image, ImageOps
+from image_ingest import IngestedImage, decode_image_cv2
+
+scenario, path, max_edge = sys.argv[1], sys.argv[2], int(sys.argv[3])
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+if scenario == "pil full":
+    image = ImageOps.exif_transpose(Image.open(path)).convert("RGB")
+    size = image.size
+elif scenario == "pil draft":
+    image = IngestedImage(path, working_max_edge=max_edge).working.convert("RGB")
+    size = image.size
+elif scenario == "cv2 full":
+    frame = decode_image_cv2(path)
+    size = (frame.shape[1], frame.shape[0])
+else:
+    frame = decode_image_cv2(path, max_edge)
+    size = (frame.shape[1], frame.shape[0])
+elapsed = time.perf_counter() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"elapsed_ms": elapsed * 1000, "extra_mb": (after - before) / 1024, "size": size}))
+"""
+
+SCENARIOS = ["pil full", "pil draft", "cv2 full", "cv2 reduced"]
+
+
+def make_jpeg(path:str, megapixels:float):
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    subprocess.run([sys.executable, "-c", MAKE_JPEG, path, str(width), str(height)], check=True)
+    return width, height
+
+
+def run_scenario(scenario:str, path:str, max_edge:int, repeats:int)->dict:
+    results = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", SCENARIO, scenario, path, str(max_edge)],
+            check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return min(results, key=lambda result: result["elapsed_ms"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[24, 48, 100])
+    parser.add_argument("--max-edge", type=int, default=None, help="Working resolution (defaults to IngestedImage's)")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    from image_ingest import WORKING_MAX_EDGE
+    max_edge = args.max_edge or WORKING_MAX_EDGE
+
+    print(f"working max edge {max_edge}px")
+    print(f"{'input':>14} {'scenario':>12} {'decoded':>11} {'ms':>8} {'extra MB':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for megapixels in args.megapixels:
+            path = os.path.join(directory, f"{megapixels:g}mp.jpg")
+            width, height = make_jpeg(path, megapixels)
+            for scenario in SCENARIOS:
+                result = run_scenario(scenario, path, max_edge, args.repeats)
+                decoded = f"{result['size'][0]}x{result['size'][1]}"
+                print(f"{f'{width}x{height}':>14} {scenario:>12} {decoded:>11} {result['elapsed_ms']:>8.0f} "
+                    f"{result['extra_mb']:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
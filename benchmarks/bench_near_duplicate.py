@@ -0,0 +1,79 @@
+"""Near-duplicate lookup latency over perceptual hashes as the index grows.
+
+Random 64-bit hashes stand in for captioned images, with a planted near-duplicate for
+every query. Each index structure is compared with a vectorised linear scan; "auto" is
+what NearDuplicateIndex uses by default. Run from
+the repository root:
+
+    python -m benchmarks.bench_near_duplicate --max-entries 1000000
+"""
+import time
+import random
+import argparse
+from typing import Callable, List
+
+import numpy as np
+
+from perceptual_hash import NearDuplicateIndex, scan
+
+SIZES = [10_000, 100_000, 1_000_000]
+
+
+def latencies_ms(fn:Callable[[int], object], queries:List[int])->List[float]:
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        fn(query)
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)
+
+
+def flip_bits(value:int, count:int)->int:
+    for position in random.sample(range(64), count):
+        value ^= 1 << position
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-entries", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--thresholds", type=int, nargs="+", default=[4, 6, 8, 12])
+    parser.add_argument("--structures", nargs="+", default=["auto", "multi-index", "bk-tree"],
+        choices=["auto", "multi-index", "bk-tree", "scan"])
+    parser.add_argument("--bk-tree-max-entries", type=int, default=100_000,
+        help="The BK-tree is slow to search at large thresholds; cap it separately")
+    args = parser.parse_args()
+
+    random.seed(0)
+    all_hashes = [random.getrandbits(64) for _ in range(args.max_entries)]
+    print(f"{'structure':>12} {'entries':>10} {'build s':>8} {'thr':>4} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'scan p50':>9} {'recall':>7}")
+
+    for size in [size for size in SIZES if size <= args.max_entries]:
+        hashes = all_hashes[:size]
+        array = np.array(hashes, dtype=np.uint64)
+        for structure in args.structures:
+            if structure == "bk-tree" and size > args.bk_tree_max_entries:
+                continue
+            index = NearDuplicateIndex(structure=structure)
+            start = time.perf_counter()
+            for item, value in enumerate(hashes):
+                index.add(value, {"provider": "stub", "model": "stub", "caption": str(item)})
+            build = time.perf_counter() - start
+
+            for threshold in args.thresholds:
+                targets = random.sample(range(size), args.queries)
+                queries = [flip_bits(hashes[target], random.randint(0, threshold)) for target in targets]
+                found = sum(str(target) in {record["caption"] for _, record in index.lookup(query, threshold)}
+                    for target, query in zip(targets, queries))
+
+                indexed = latencies_ms(lambda query: index.lookup(query, threshold), queries)
+                scanned = latencies_ms(lambda query: scan(array, query, threshold), queries[:50])
+                print(f"{structure:>12} {size:>10,} {build:>8.1f} {threshold:>4} {indexed[len(indexed) // 2]:>8.3f} "
+                    f"{indexed[int(len(indexed) * 0.99)]:>8.3f} {scanned[len(scanned) // 2]:>9.3f} "
+                    f"{found / len(queries):>7.0%}")
+
+
+if __name__ == "__main__":
+    main()
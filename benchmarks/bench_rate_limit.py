@@ -0,0 +1,140 @@
+"""Throughput and 429s against a quota-enforcing stub provider, with and without the scheduler.
+
+The stub provider admits requests from its own token bucket and answers 429 with a
+Retry-After header once the quota is spent. Batch workers hammer it while an interactive
+request arrives every second. "sdk-retry" retries each call a couple of times on its own,
+like the provider SDKs do; "scheduled" goes through RequestScheduler. Run from the repository root:
+
+    python -m benchmarks.bench_rate_limit --rpm 600 --seconds 20
+"""
+import time
+import random
+import argparse
+import threading
+import statistics
+from types import SimpleNamespace
+from typing import Dict, List
+
+from rate_limiting import PRIORITY_BATCH, PRIORITY_INTERACTIVE, ProviderLimits, RequestScheduler
+
+
+class StubRateLimitError(Exception):
+    def __init__(self, retry_after:float) -> None:
+        super().__init__("429 Too Many Requests")
+        self.status_code = 429
+        self.response = SimpleNamespace(headers={"retry-after-ms": str(int(retry_after * 1000))})
+
+
+class QuotaProvider:
+    """Answers after `latency` seconds if its requests-per-minute quota allows, else 429"""
+
+    def __init__(self, rpm:float, latency:float=0.05) -> None:
+        self.rate = rpm / 60.0
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.accepted: List[float] = []
+        self.rejected = 0
+
+    def __call__(self)->str:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.rejected += 1
+                raise StubRateLimitError((1 - self.tokens) / self.rate)
+            self.tokens -= 1
+            self.accepted.append(now)
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        return "caption"
+
+
+def run(mode:str, rpm:float, seconds:float, workers:int)->Dict:
+    provider = QuotaProvider(rpm)
+    scheduler = RequestScheduler({"stub": ProviderLimits(requests_per_minute=rpm, max_retries=8, base_delay=0.1)})
+    deadline = time.monotonic() + seconds
+    results = {"batch": [], "interactive": []}
+    failures = {"batch": 0, "interactive": 0}
+    lock = threading.Lock()
+
+    def one(kind:str):
+        start = time.monotonic()
+        try:
+            if mode == "sdk-retry":
+                # What the SDKs do on their own: a couple of retries per caller, no shared quota
+                for attempt in range(3):
+                    try:
+                        provider()
+                        break
+                    except StubRateLimitError as e:
+                        if attempt == 2:
+                            raise
+                        time.sleep(float(e.response.headers["retry-after-ms"]) / 1000 + random.uniform(0, 0.05))
+            else:
+                priority = PRIORITY_INTERACTIVE if kind == "interactive" else PRIORITY_BATCH
+                scheduler.call("stub", provider, priority=priority)
+            with lock:
+                results[kind].append(time.monotonic() - start)
+        except StubRateLimitError:
+            with lock:
+                failures[kind] += 1
+
+    def batch_worker():
+        while time.monotonic() < deadline:
+            one("batch")
+
+    def interactive_user():
+        while time.monotonic() < deadline:
+            one("interactive")
+            time.sleep(1.0)
+
+    threads = [threading.Thread(target=batch_worker) for _ in range(workers)]
+    threads.append(threading.Thread(target=interactive_user))
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Accepted requests per second over the steady part of the run
+    per_second = [0] * int(seconds)
+    for accepted_at in provider.accepted:
+        index = int(accepted_at - start)
+        if index < len(per_second):
+            per_second[index] += 1
+    steady = per_second[2:] or per_second
+    return {
+        "mode": mode,
+        "accepted": len(provider.accepted),
+        "rejected_429": provider.rejected,
+        "failed": failures["batch"] + failures["interactive"],
+        "per_second_mean": statistics.mean(steady),
+        "per_second_stdev": statistics.pstdev(steady),
+        "batch_p50": statistics.median(results["batch"]) if results["batch"] else 0.0,
+        "interactive_p50": statistics.median(results["interactive"]) if results["interactive"] else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rpm", type=float, default=600)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args()
+
+    random.seed(0)
+    print(f"quota: {args.rpm / 60:.1f} requests/s, {args.workers} batch workers + 1 interactive user")
+    print(f"{'mode':>10} {'accepted':>9} {'429s':>7} {'failed':>7} {'req/s':>7} {'stdev':>6} "
+        f"{'batch p50 ms':>13} {'ui p50 ms':>10}")
+    for mode in ("sdk-retry", "scheduled"):
+        row = run(mode, args.rpm, args.seconds, args.workers)
+        print(f"{row['mode']:>10} {row['accepted']:>9} {row['rejected_429']:>7} {row['failed']:>7} "
+            f"{row['per_second_mean']:>7.1f} {row['per_second_stdev']:>6.2f} "
+            f"{row['batch_p50'] * 1000:>13.0f} {row['interactive_p50'] * 1000:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Peak memory and time of one preview render on a large image.
+
+Each scenario runs in a fresh interpreter so its peak RSS isn't hidden by an earlier one.
+"legacy" repeats the old main.py round trip (PIL -> NumPy -> BGR -> overlay -> RGB -> PIL);
+"pil" passes the PIL image straight through. Run from the repository root:
+
+    python -m benchmarks.bench_render_memory --width 6000 --height 4000
+"""
+import sys
+import json
+import glob
+import argparse
+import subprocess
+
+SCENARIO = r"""
+import io, sys, json, time, resource
+import cv2
+import numpy as np
+from PIL import Image
+from caption_overlay import ImageCaptionOverlay
+
+scenario, method, width, height, font_path = sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), sys.argv[5] or None
+rng = np.random.default_rng(0)
+image = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+caption = "A large photograph with a caption long enough to wrap over a couple of lines at this size " * 2
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+start = time.perf_counter()
+if method == "overlay":
+    render = lambda source: ImageCaptionOverlay.add_caption_overlay(source, caption, font_size=3, thickness=4, font_path=font_path)
+else:
+    render = lambda source: ImageCaptionOverlay.add_caption_background(source, caption, font_path=font_path, font_size=72)
+if scenario == "legacy":
+    result = render(cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR))
+    result = Image.fromarray(cv2.cvtColor(result, cv2.COLOR_BGR2RGB))
+else:
+    result = render(image)
+elapsed = time.perf_counter() - start
+
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"elapsed_ms": elapsed * 1000, "baseline_mb": before / 1024, "peak_mb": after / 1024}))
+"""
+
+
+def run_scenario(scenario:str, method:str, width:int, height:int, font_path:str|None)->dict:
+    output = subprocess.run(
+        [sys.executable, "-c", SCENARIO, scenario, method, str(width), str(height), font_path or ""],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=4000)
+    parser.add_argument("--font", default=next(iter(sorted(glob.glob("fonts/*.ttf"))), None))
+    args = parser.parse_args()
+
+    frame_mb = args.width * args.height * 3 / 1024 / 1024
+    print(f"{args.width}x{args.height} RGB frame: {frame_mb:.0f} MB")
+    print(f"{'method':>10} {'font':>6} {'scenario':>8} {'ms':>8} {'render MB':>10} {'frames':>7}")
+    fonts = [None, args.font] if args.font else [None]
+    for method in ("overlay", "background"):
+        for font_path in fonts:
+            for scenario in ("legacy", "pil"):
+                result = run_scenario(scenario, method, args.width, args.height, font_path)
+                extra = result["peak_mb"] - result["baseline_mb"]
+                print(f"{method:>10} {'ttf' if font_path else 'cv2':>6} {scenario:>8} {result['elapsed_ms']:>8.0f} "
+                    f"{extra:>10.0f} {extra / frame_mb:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
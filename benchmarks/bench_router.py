@@ -0,0 +1,111 @@
+"""Tail latency of fixed-provider, routed and hedged captioning against stub providers.
+
+The stub providers sleep for latencies drawn from heavy-tailed distributions and fail at
+a set rate, so no API keys or network are needed. Run from the repository root:
+
+    python -m benchmarks.bench_router --requests 600 --scale 0.1
+"""
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from typing import Dict, List
+
+from PIL import Image
+
+from batch_caption import percentile
+from caption_cache import CaptionCache
+from caption_generation import MultiModalCaptionGenerator
+from provider_router import ProviderRouter
+
+# provider -> (median seconds, tail probability, tail multiplier, error rate)
+STUB_PROFILES = {
+    "openai": (1.0, 0.05, 8.0, 0.01),
+    "groq": (1.3, 0.03, 6.0, 0.02),
+    "gemini": (1.6, 0.02, 5.0, 0.10)
+}
+
+
+class StubCaptionGenerator(MultiModalCaptionGenerator):
+    """Real generator plumbing with the provider SDK calls replaced by injected latency"""
+
+    def __init__(self, profiles:Dict, scale:float, cache_dir:str, seed:int=0) -> None:
+        super().__init__(cache=CaptionCache(cache_dir), use_cache=False, max_concurrency=64)
+        self.profiles = profiles
+        self.scale = scale
+        self._random = random.Random(seed)
+        self.calls = {provider: 0 for provider in profiles}
+
+    def configured_providers(self)->List[str]:
+        return list(self.profiles)
+
+    def generate_caption(self, image, provider:str, model:str|None=None, use_cache:bool|None=None,
+    priority:int=0)->str:
+        median, tail_probability, tail_multiplier, error_rate = self.profiles[provider]
+        self.calls[provider] += 1
+        latency = median * self._random.lognormvariate(0, 0.25)
+        if self._random.random() < tail_probability:
+            latency *= tail_multiplier
+        time.sleep(latency * self.scale)
+        if self._random.random() < error_rate:
+            raise RuntimeError(f"{provider} returned 503")
+        return f"stub caption from {provider}"
+
+
+async def run_mode(mode:str, generator:StubCaptionGenerator, requests:int, concurrency:int)->Dict:
+    image = generator.prepare_image(Image.new("RGB", (64, 64)))
+    router = ProviderRouter(generator, hedge=(mode == "hedged"), min_hedge_delay=0.0)
+    latencies, failures = [], 0
+    queue = list(range(requests))
+
+    async def worker():
+        nonlocal failures
+        while queue:
+            queue.pop()
+            start = time.perf_counter()
+            if mode == "fixed":
+                result = await generator.agenerate_caption(image, "openai", use_cache=False)
+            else:
+                result = await router.aroute(image, use_cache=False)
+            latencies.append(time.perf_counter() - start)
+            failures += not result.ok
+
+    for provider in generator.calls:
+        generator.calls[provider] = 0
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {
+        "mode": mode,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "failures": failures,
+        "provider_calls": sum(generator.calls.values()),
+        "hedges": router.hedges,
+        "hedge_wins": router.hedge_wins,
+        "failovers": router.failovers
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=600)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--scale", type=float, default=0.1, help="Multiplier applied to the stub latencies")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = []
+        for mode in ("fixed", "routed", "hedged"):
+            generator = StubCaptionGenerator(STUB_PROFILES, args.scale, tmp)
+            results.append(asyncio.run(run_mode(mode, generator, args.requests, args.concurrency)))
+            generator._executor.shutdown(wait=True)
+
+    print(f"{'mode':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'failures':>9} {'calls':>7} {'hedges':>7} {'won':>5} {'failover':>9}")
+    for row in results:
+        print(f"{row['mode']:>8} {row['p50'] * 1000:>8.0f} {row['p95'] * 1000:>8.0f} {row['p99'] * 1000:>8.0f} "
+            f"{row['failures']:>9} {row['provider_calls']:>7} {row['hedges']:>7} {row['hedge_wins']:>5} {row['failovers']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Caption wrap and render time across caption lengths and font sizes.
+
+Compares measuring every growing prefix (the previous wrapping strategy) with the cached
+word-width layout, then times full overlay renders on a warm font cache. Run from the
+repository root:
+
+    python -m benchmarks.bench_text_layout --font fonts/Poppins-Regular.ttf
+"""
+import glob
+import time
+import random
+import string
+import argparse
+from typing import Callable, List
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import text_layout
+from caption_overlay import ImageCaptionOverlay
+
+CAPTION_WORDS = [10, 50, 200, 1000]
+
+
+def prefix_wrap(caption:str, max_width:int, measure:Callable[[str], int])->List[str]:
+    if measure(caption) <= max_width:
+        return [caption]
+    lines, current_line = [], ""
+    for word in caption.split():
+        test_line = current_line + " " + word if current_line else word
+        if measure(test_line) <= max_width:
+            current_line = test_line
+        else:
+            if current_line:
+                lines.append(current_line)
+            current_line = word
+    if current_line:
+        lines.append(current_line)
+    return lines
+
+
+def random_caption(words:int)->str:
+    return " ".join("".join(random.choice(string.ascii_lowercase) for _ in range(random.randint(2, 9)))
+        for _ in range(words))
+
+
+def best_of(fn:Callable, repeats:int)->float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def reset_caches():
+    text_layout.load_font.cache_clear()
+    text_layout.pil_text_bbox.cache_clear()
+    text_layout.cv2_text_size.cache_clear()
+    text_layout._measurers.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--font", default=next(iter(sorted(glob.glob("fonts/*.ttf"))), None))
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    image = np.zeros((1080, args.width, 3), dtype=np.uint8)
+    draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    max_width = args.width - 40
+
+    print(f"{'backend':>8} {'size':>6} {'words':>6} {'prefix ms':>10} {'cold ms':>9} {'warm ms':>9} "
+        f"{'render ms':>10} {'same':>5}")
+    for words in CAPTION_WORDS:
+        caption = random_caption(words)
+        configs = [("cv2", scale) for scale in (0.7, 1.5, 3.0)]
+        if args.font:
+            configs += [("pil", scale) for scale in (0.7, 1.5, 3.0)]
+
+        for backend, scale in configs:
+            if backend == "pil":
+                font = ImageFont.truetype(args.font, int(scale * 20))
+                measure = lambda text: (lambda box: box[2] - box[0])(draw.textbbox((0, 0), text, font=font))
+                measurer_for = lambda: text_layout.pil_measurer(text_layout.load_font(args.font, int(scale * 20)))
+                font_path = args.font
+            else:
+                measure = lambda text: cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, 2)[0][0]
+                measurer_for = lambda: text_layout.cv2_measurer(cv2.FONT_HERSHEY_SIMPLEX, scale, 2)
+                font_path = None
+
+            prefix_ms = best_of(lambda: prefix_wrap(caption, max_width, measure), args.repeats)
+
+            def cold():
+                reset_caches()
+                measurer_for().wrap(caption, max_width)
+            cold_ms = best_of(cold, args.repeats)
+            warm_ms = best_of(lambda: measurer_for().wrap(caption, max_width), args.repeats)
+
+            render_ms = best_of(lambda: ImageCaptionOverlay.add_caption_overlay(
+                image, caption, font_size=scale, thickness=2, font_path=font_path), args.repeats)
+
+            same = prefix_wrap(caption, max_width, measure) == measurer_for().wrap(caption, max_width)
+            size = f"{int(scale * 20)}px" if backend == "pil" else f"x{scale}"
+            print(f"{backend:>8} {size:>6} {words:>6} {prefix_ms:>10.2f} {cold_ms:>9.2f} {warm_ms:>9.2f} "
+                f"{render_ms:>10.2f} {str(same):>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Deterministic stand-ins for caption providers and test images, shared by the benchmarks.
+
+The stub provider sleeps for a seeded latency instead of calling an API and fails a seeded
+fraction of calls. Outcomes depend on the image and the attempt number, not on call order,
+so a run with many threads fails the same requests every time.
+"""
+import io
+import time
+import random
+import hashlib
+import threading
+from typing import Dict, List
+
+import numpy as np
+from PIL import Image
+
+from provider_registry import ProviderPlugin, register_provider
+
+
+class StubProviderError(Exception):
+    def __init__(self, message:str, status_code:int) -> None:
+        super().__init__(message)
+        # The scheduler retries by status code, as it does for SDK errors
+        self.status_code = status_code
+
+
+class StubProvider:
+    def __init__(self, latency:float=0.0, jitter:float=0.0, failure_rate:float=0.0, retryable:bool=True,
+    seed:int=0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.retryable = retryable
+        self.seed = seed
+        self.calls = 0
+        self.failures = 0
+        self._attempts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _random(self, fingerprint:str, attempt:int)->random.Random:
+        digest = hashlib.sha256(f"{self.seed}:{fingerprint}:{attempt}".encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def caption(self, generator, image, model:str, priority:int)->str:
+        fingerprint = image.fingerprint
+        with self._lock:
+            self.calls += 1
+            attempt = self._attempts.get(fingerprint, 0)
+            self._attempts[fingerprint] = attempt + 1
+        rng = self._random(fingerprint, attempt)
+        time.sleep(max(0.0, rng.gauss(self.latency, self.jitter)))
+
+        if rng.random() < self.failure_rate:
+            with self._lock:
+                self.failures += 1
+            raise StubProviderError("Stub provider failure", 503 if self.retryable else 400)
+        return f"Stub caption for {fingerprint[:8]}"
+
+    def reset(self):
+        with self._lock:
+            self.calls = self.failures = 0
+            self._attempts.clear()
+
+
+def register_stub(stub:StubProvider, name:str="stub")->ProviderPlugin:
+    plugin = ProviderPlugin(name, "stub-1", caption=stub.caption)
+    register_provider(plugin, replace=True)
+    return plugin
+
+
+def synthetic_photo(width:int, height:int, seed:int=0)->Image.Image:
+    """Gradients, shapes and mild noise: compresses roughly like a photo, unlike pure noise"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    phase = rng.uniform(0, 2 * np.pi, 3)
+    channels = [127 + 100 * np.sin(x / width * (3 + i) + y / height * (2 + i) + phase[i]) for i in range(3)]
+    pixels = np.stack(channels, axis=-1)
+    for _ in range(8):
+        cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+        radius = rng.uniform(0.05, 0.2) * min(width, height)
+        mask = (x - cx) ** 2 + (y - cy) ** 2 < radius ** 2
+        pixels[mask] = rng.uniform(0, 255, 3)
+    pixels += rng.normal(0, 6, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def make_images(count:int, size:int, seed:int)->List[bytes]:
+    """Small distinct PNGs, cheap to make in bulk"""
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        image = Image.new("RGB", (size, size), tuple(rng.randrange(256) for _ in range(3)))
+        image.putpixel((rng.randrange(size), rng.randrange(size)), (0, 0, 0))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        images.append(buffer.getvalue())
+    return images
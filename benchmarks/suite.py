@@ -0,0 +1,414 @@
+"""Reproducible benchmark suite: payload encoding, caption overlays, history and end-to-end captioning.
+
+Every input comes from a fixed seed and providers are local stubs, so runs on the same machine
+are comparable across commits. Results are written as JSON, and comparing against a saved
+baseline flags every case that got slower (or smaller, for throughputs) by more than the
+threshold. Run from the repository root:
+
+    python -m benchmarks.suite run --output results.json
+    python -m benchmarks.suite run --profile full --groups history --baseline baseline.json
+    python -m benchmarks.suite compare baseline.json results.json --threshold 0.1
+"""
+import gc
+import io
+import os
+import sys
+import glob
+import json
+import time
+import random
+import string
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple
+
+import cv2
+import numpy as np
+import PIL
+from PIL import Image
+
+from batch_caption import BatchCaptioner, percentile
+from benchmarks.bench_history import MODELS, synthetic_records
+from benchmarks.stubs import StubProvider, register_stub, synthetic_photo
+from caption_cache import CaptionCache
+from caption_generation import MultiModalCaptionGenerator
+from caption_history import CaptionHistory
+from caption_overlay import ImageCaptionOverlay
+from image_preprocessing import PreprocessConfig
+from rate_limiting import ProviderLimits, RequestScheduler
+
+SCHEMA_VERSION = 1
+
+
+@dataclass
+class Profile:
+    repeats: int
+    encode_sizes: List[int]
+    overlay_sizes: List[Tuple[int, int]]
+    caption_words: List[int]
+    history_sizes: List[int]
+    history_adds: int
+    e2e_images: int
+    e2e_runs: int
+
+
+PROFILES = {
+    "quick": Profile(repeats=5, encode_sizes=[512, 2048], overlay_sizes=[(640, 480), (1920, 1080)],
+        caption_words=[10, 50, 200], history_sizes=[1_000, 100_000], history_adds=500, e2e_images=40, e2e_runs=3),
+    "full": Profile(repeats=9, encode_sizes=[512, 2048, 4096], overlay_sizes=[(640, 480), (1920, 1080), (3840, 2160)],
+        caption_words=[10, 50, 200], history_sizes=[1_000, 100_000, 1_000_000], history_adds=2_000,
+        e2e_images=200, e2e_runs=3)
+}
+
+# name: (median latency s, failure rate, concurrency)
+E2E_SCENARIOS = {
+    "instant": (0.0, 0.0, 4),
+    "latency_20ms": (0.02, 0.0, 8),
+    "flaky_20ms": (0.02, 0.1, 8)
+}
+
+GROUPS = ["encode", "overlay", "history", "e2e"]
+
+
+class Suite:
+    def __init__(self, profile:Profile, seed:int=0, verbose:bool=True) -> None:
+        self.profile = profile
+        self.seed = seed
+        self.verbose = verbose
+        self.results: Dict[str, Dict] = {}
+
+    def record(self, name:str, group:str, values:List[float], unit:str, better:str="lower", **params):
+        ordered = sorted(values)
+        result = {
+            "group": group,
+            "params": params,
+            "unit": unit,
+            "better": better,
+            "value": ordered[len(ordered) // 2],
+            "min": ordered[0],
+            "max": ordered[-1],
+            "p95": percentile(ordered, 95),
+            "samples": len(ordered)
+        }
+        self.results[name] = result
+        if self.verbose:
+            print(f"  {name:<58} {result['value']:>12.3f} {unit}", flush=True)
+
+    def measure(self, name:str, group:str, fn:Callable[[], object], repeats:int|None=None, warmup:int=1,
+    **params)->List[float]:
+        """Median wall time of `fn` in milliseconds, with the garbage collector held off while timing"""
+        for _ in range(warmup):
+            fn()
+        samples = []
+        gc.collect()
+        gc.disable()
+        try:
+            for _ in range(repeats or self.profile.repeats):
+                start = time.perf_counter()
+                fn()
+                samples.append((time.perf_counter() - start) * 1000)
+        finally:
+            gc.enable()
+        self.record(name, group, samples, "ms", **params)
+        return samples
+
+
+def source_image(photo:Image.Image, mode:str)->Image.Image:
+    """The photo as it arrives from an upload: decoded JPEG, RGBA PNG or greyscale"""
+    buffer = io.BytesIO()
+    if mode == "RGB":
+        photo.save(buffer, format="JPEG", quality=92)
+    else:
+        photo.convert(mode).save(buffer, format="PNG")
+    image = Image.open(io.BytesIO(buffer.getvalue()))
+    image.load()
+    return image
+
+
+def bench_encode(suite:Suite):
+    cases = [("RGB", fmt) for fmt in ("JPEG", "WEBP", "PNG")] + [("RGBA", "JPEG"), ("L", "JPEG")]
+    for size in suite.profile.encode_sizes:
+        photo = synthetic_photo(size, size * 3 // 4, seed=suite.seed + size)
+        for mode, fmt in cases:
+            image = source_image(photo, mode)
+            generator = MultiModalCaptionGenerator(cache=CaptionCache(None), use_cache=False,
+                preprocess_config=PreprocessConfig(format=fmt))
+            # A fresh PreparedImage on every call, so nothing is memoized between samples
+            encode = lambda: generator.encode_image_base64(image, "openai")
+            name = f"encode/{mode.lower()}-to-{fmt.lower()}/{size}"
+            suite.measure(name, "encode", encode, size=size, source_mode=mode, format=fmt)
+            suite.record(f"{name}/payload", "encode", [len(encode())], "bytes", size=size, source_mode=mode,
+                format=fmt)
+
+
+def random_caption(words:int, seed:int)->str:
+    rng = random.Random(seed)
+    return " ".join("".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9)))
+        for _ in range(words))
+
+
+def bench_overlay(suite:Suite, font_path:str|None):
+    backends = [("cv2", None, 1.0)]
+    if font_path:
+        backends.append(("truetype", font_path, 1.5))
+    elif suite.verbose:
+        print("  No TrueType font found; pass --font to benchmark the PIL path")
+
+    for width, height in suite.profile.overlay_sizes:
+        frame = np.asarray(synthetic_photo(width, height, seed=suite.seed + width))[:, :, ::-1].copy()
+        for words in suite.profile.caption_words:
+            caption = random_caption(words, suite.seed + words)
+            for backend, path, font_size in backends:
+                suite.measure(f"overlay/{backend}/{width}x{height}/{words}w", "overlay",
+                    lambda: ImageCaptionOverlay.add_caption_overlay(frame, caption, font_size=font_size,
+                        thickness=2, font_path=path),
+                    backend=backend, width=width, height=height, words=words)
+
+
+def open_history(engine:str, directory:str)->CaptionHistory:
+    if engine == "sqlite":
+        return CaptionHistory(use_file_history=False, storage="sqlite",
+            path=os.path.join(directory, "history.db"), legacy_path=None)
+    return CaptionHistory(use_file_history=False, storage="jsonl", path=os.path.join(directory, "history.jsonl"))
+
+
+def bench_history(suite:Suite):
+    random.seed(suite.seed)
+    adds = suite.profile.history_adds
+    for engine in ("sqlite", "jsonl"):
+        with tempfile.TemporaryDirectory() as directory:
+            history = open_history(engine, directory)
+            rows = 0
+            for size in suite.profile.history_sizes:
+                # Filled in chunks so a million records never sit in memory at once
+                while rows < size:
+                    chunk = min(100_000, size - rows)
+                    history.store.append_many(synthetic_records(rows, chunk))
+                    rows += chunk
+                # Big scans are slow enough that a few samples are plenty
+                repeats = suite.profile.repeats if size < 100_000 else min(suite.profile.repeats, 3)
+                prefix = f"history/{engine}/{size}"
+                params = {"engine": engine, "rows": size}
+
+                def add_batch():
+                    for i in range(adds):
+                        history.add_interaction(f"bench_{i % 100}.jpg", MODELS[i % len(MODELS)],
+                            f"Benchmark caption {i}", content_hash=f"{i:032x}")
+                    history.flush()
+                samples = suite.measure(f"{prefix}/add_{adds}", "history", add_batch, repeats=repeats, warmup=0,
+                    **params)
+                suite.record(f"{prefix}/add_per_record", "history", [sample * 1000 / adds for sample in samples],
+                    "us", **params)
+
+                queries = {
+                    "recent_10": lambda: history.get_recent_interactions(10),
+                    "search_image": lambda: history.search_by_image("image_00042.jpg"),
+                    "search_model": lambda: history.search_by_model(MODELS[1]),
+                    "query_model_page_50": lambda: history.query_history(model=MODELS[1], limit=50,
+                        newest_first=True),
+                    "count_model": lambda: history.count_interactions(model=MODELS[2])
+                }
+                for query, fn in queries.items():
+                    suite.measure(f"{prefix}/{query}", "history", fn, repeats=repeats, **params)
+            history.close()
+
+
+def bench_e2e(suite:Suite):
+    with tempfile.TemporaryDirectory() as directory:
+        image_dir = os.path.join(directory, "images")
+        os.makedirs(image_dir)
+        for i in range(suite.profile.e2e_images):
+            synthetic_photo(640, 480, seed=suite.seed + i).save(os.path.join(image_dir, f"image_{i:04d}.jpg"),
+                quality=90)
+
+        for scenario, (latency, failure_rate, concurrency) in E2E_SCENARIOS.items():
+            stub = StubProvider(latency, latency / 4, failure_rate=failure_rate, seed=suite.seed)
+            plugin = register_stub(stub)
+            # Quick retries, so a flaky provider costs latency rather than minutes of backoff
+            scheduler = RequestScheduler({"stub": ProviderLimits(max_retries=2, base_delay=0.01, max_delay=0.05)})
+            generator = MultiModalCaptionGenerator(cache=CaptionCache(None), use_cache=False, scheduler=scheduler,
+                max_concurrency=concurrency)
+            generator.configure_apis(plugin_keys={"stub": "unused"})
+            captioner = BatchCaptioner(generator, plugin.name, model=plugin.default_model,
+                concurrency=concurrency, use_cache=False)
+
+            summaries = []
+            for run in range(suite.profile.e2e_runs):
+                stub.reset()
+                summaries.append(captioner.run([image_dir], os.path.join(directory, f"{scenario}-{run}.jsonl")))
+
+            prefix = f"e2e/{scenario}"
+            params = {"latency_ms": latency * 1000, "failure_rate": failure_rate, "concurrency": concurrency,
+                "images": suite.profile.e2e_images}
+            suite.record(f"{prefix}/images_per_second", "e2e", [s["images_per_second"] for s in summaries],
+                "images/s", better="higher", **params)
+            suite.record(f"{prefix}/latency_p50", "e2e", [s["latency_p50"] * 1000 for s in summaries], "ms", **params)
+            suite.record(f"{prefix}/latency_p95", "e2e", [s["latency_p95"] * 1000 for s in summaries], "ms", **params)
+            suite.record(f"{prefix}/failed", "e2e", [s["failed"] for s in summaries], "images", **params)
+            suite.record(f"{prefix}/provider_calls", "e2e", [stub.calls], "calls", **params)
+
+
+def environment()->Dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "pillow": PIL.__version__,
+        "opencv_threads": cv2.getNumThreads(),
+        "commit": commit
+    }
+
+
+def run_suite(profile_name:str, groups:List[str], seed:int=0, font_path:str|None=None, verbose:bool=True)->Dict:
+    suite = Suite(PROFILES[profile_name], seed=seed, verbose=verbose)
+    benches = {
+        "encode": lambda: bench_encode(suite),
+        "overlay": lambda: bench_overlay(suite, font_path),
+        "history": lambda: bench_history(suite),
+        "e2e": lambda: bench_e2e(suite)
+    }
+    start = time.perf_counter()
+    for group in groups:
+        if verbose:
+            print(f"{group}", flush=True)
+        benches[group]()
+    return {
+        "schema": SCHEMA_VERSION,
+        "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "profile": profile_name,
+        "seed": seed,
+        "groups": groups,
+        "elapsed": round(time.perf_counter() - start, 3),
+        "environment": environment(),
+        "results": suite.results
+    }
+
+
+def compare_results(baseline:Dict, current:Dict, threshold:float=0.1)->List[Dict]:
+    """Per-case changes between two runs.
+
+    A case regresses when its median moved the wrong way by more than `threshold` and even its
+    best sample is worse than the baseline median, which keeps one noisy sample from tripping it.
+    """
+    rows = []
+    base_results, current_results = baseline["results"], current["results"]
+    for name in sorted(set(base_results) | set(current_results)):
+        base, now = base_results.get(name), current_results.get(name)
+        row = {"name": name, "baseline": base and base["value"], "current": now and now["value"],
+            "unit": (now or base)["unit"], "change": None}
+        if base is None or now is None:
+            row["status"] = "new" if base is None else "missing"
+            rows.append(row)
+            continue
+
+        lower_is_better = now["better"] == "lower"
+        if base["value"]:
+            row["change"] = (now["value"] - base["value"]) / abs(base["value"])
+        elif now["value"] != base["value"]:
+            row["change"] = float("inf") if now["value"] > base["value"] else float("-inf")
+        else:
+            row["change"] = 0.0
+        worse = row["change"] if lower_is_better else -row["change"]
+        best = now["min"] if lower_is_better else now["max"]
+        consistently_worse = best > base["value"] if lower_is_better else best < base["value"]
+
+        if worse > threshold and consistently_worse:
+            row["status"] = "regression"
+        elif worse < -threshold:
+            row["status"] = "improved"
+        else:
+            row["status"] = "ok"
+        rows.append(row)
+    return rows
+
+
+def environment_differences(baseline:Dict, current:Dict)->List[str]:
+    keys = ["python", "machine", "cpu_count", "numpy", "opencv", "pillow", "opencv_threads"]
+    base_env, current_env = baseline.get("environment", {}), current.get("environment", {})
+    differences = [f"{key}: {base_env.get(key)} -> {current_env.get(key)}" for key in keys
+        if base_env.get(key) != current_env.get(key)]
+    if baseline.get("profile") != current.get("profile"):
+        differences.append(f"profile: {baseline.get('profile')} -> {current.get('profile')}")
+    return differences
+
+
+def print_comparison(rows:List[Dict], differences:List[str], show_all:bool=False)->int:
+    """Print the comparison and return the number of regressions"""
+    for difference in differences:
+        print(f"warning: environment differs from the baseline ({difference})")
+
+    print(f"{'case':<60} {'baseline':>12} {'current':>12} {'change':>8}  status")
+    for row in rows:
+        if not show_all and row["status"] == "ok":
+            continue
+        baseline = f"{row['baseline']:.3f}" if row["baseline"] is not None else "-"
+        current = f"{row['current']:.3f}" if row["current"] is not None else "-"
+        change = f"{row['change']:+.1%}" if row["change"] is not None else "-"
+        print(f"{row['name']:<60} {baseline:>12} {current:>12} {change:>8}  {row['status']}")
+
+    counts: Dict[str, int] = {}
+    for row in rows:
+        counts[row["status"]] = counts.get(row["status"], 0) + 1
+    print(", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    return counts.get("regression", 0)
+
+
+def load_results(path:str)->Dict:
+    with open(path, mode="r") as f:
+        results = json.load(f)
+    if results.get("schema") != SCHEMA_VERSION:
+        raise ValueError(f"{path} has results schema {results.get('schema')}, expected {SCHEMA_VERSION}")
+    return results
+
+
+def main(argv:List[str]|None=None)->int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="Run the benchmarks")
+    run.add_argument("--profile", default="quick", choices=sorted(PROFILES))
+    run.add_argument("--groups", nargs="+", default=GROUPS, choices=GROUPS)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--font", default=next(iter(sorted(glob.glob("fonts/*.ttf"))), None))
+    run.add_argument("-o", "--output", default=None, help="Write results JSON here")
+    run.add_argument("--baseline", default=None, help="Compare against this results JSON")
+
+    compare = subparsers.add_parser("compare", help="Compare two results files")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    for sub in (run, compare):
+        sub.add_argument("--threshold", type=float, default=0.1, help="Relative change that counts (0.1 = 10%%)")
+        sub.add_argument("--all", action="store_true", help="List unchanged cases too")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        results = run_suite(args.profile, args.groups, seed=args.seed, font_path=args.font)
+        if args.output:
+            with open(args.output, mode="w") as f:
+                json.dump(results, f, indent=2)
+            print(f"Results written to {args.output}")
+        if not args.baseline:
+            return 0
+        baseline = load_results(args.baseline)
+    else:
+        baseline, results = load_results(args.baseline), load_results(args.current)
+
+    rows = compare_results(baseline, results, args.threshold)
+    regressions = print_comparison(rows, environment_differences(baseline, results), args.all)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,344 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field, replace
+from multiprocessing import shared_memory
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+import cv2
+import numpy as np
+
+from batch_caption import percentile
+from caption_overlay import ImageCaptionOverlay
+from render_cache import DOWNLOAD_FORMATS
+
+# (slot, shared memory name, shape, dtype) of a frame waiting in shared memory
+FrameRef = Tuple[int, str, Tuple[int, ...], str]
+
+
+@dataclass
+class RenderStyle:
+    method: str = "overlay"
+    position: str = "bottom"
+    font_size: float = 1.0
+    thickness: int = 2
+    font_path: str|None = None
+    # Used by the background method, which takes its font size in pixels
+    pil_font_size: int = 24
+    background_color: Tuple[int, int, int] = (33, 34, 69)
+    text_color: Tuple[int, int, int] = (183, 212, 225)
+    margin: int = 50
+
+
+@dataclass
+class RenderJob:
+    """One image to caption: a file path decoded in the worker, or a BGR frame already in memory"""
+    caption: str
+    path: str|None = None
+    frame: np.ndarray|None = field(default=None, repr=False)
+    output_name: str|None = None
+    style: RenderStyle|None = None
+
+
+def render_frame(frame:np.ndarray, caption:str, style:RenderStyle)->np.ndarray:
+    # The overlay draws straight onto the frame; it's a scratch copy in a worker either way
+    if style.method == "background":
+        return ImageCaptionOverlay.add_caption_background(
+            frame, caption, font_path=style.font_path, font_size=style.pil_font_size,
+            background_color=style.background_color, text_color=style.text_color, margin=style.margin
+        )
+    return ImageCaptionOverlay.add_caption_overlay(
+        frame, caption, position=style.position, font_size=style.font_size, thickness=style.thickness,
+        font_path=style.font_path, in_place=True
+    )
+
+
+def encode_frame(frame:np.ndarray, fmt:str, quality:int)->bytes:
+    extension = DOWNLOAD_FORMATS[fmt][1]
+    params = {
+        "JPEG": [cv2.IMWRITE_JPEG_QUALITY, quality],
+        "WebP": [cv2.IMWRITE_WEBP_QUALITY, quality]
+    }.get(fmt, [])
+    ok, buffer = cv2.imencode(f".{extension}", frame, params)
+    if not ok:
+        raise ValueError(f"Could not encode image as {fmt}")
+    return buffer.tobytes()
+
+
+# Worker-side attachments to the parent's shared memory slots, reused across jobs
+_attached: Dict[int, shared_memory.SharedMemory] = {}
+
+
+def _init_worker():
+    # The pool already runs one process per core; OpenCV's own threads would oversubscribe it
+    cv2.setNumThreads(1)
+
+
+def _attach(slot:int, name:str)->shared_memory.SharedMemory:
+    segment = _attached.get(slot)
+    if segment is None or segment.name != name:
+        # The parent replaced the slot with a bigger segment
+        if segment is not None:
+            segment.close()
+        segment = _attached[slot] = shared_memory.SharedMemory(name=name)
+    return segment
+
+
+def _render_job(index:int, caption:str, path:str|None, frame:np.ndarray|FrameRef|None, output_path:str,
+style:RenderStyle, fmt:str, quality:int)->Dict:
+    start = time.perf_counter()
+    record = {"index": index, "path": path, "output": output_path, "error": None}
+    try:
+        if isinstance(frame, tuple):
+            slot, name, shape, dtype = frame
+            frame = np.ndarray(shape, dtype=np.dtype(dtype), buffer=_attach(slot, name).buf)
+        elif frame is None:
+            frame = cv2.imread(path, cv2.IMREAD_COLOR)
+            if frame is None:
+                raise ValueError(f"Could not read image: {path}")
+
+        data = encode_frame(render_frame(frame, caption, style), fmt, quality)
+        del frame
+
+        # Written aside and renamed, so an interrupted export never leaves a truncated image
+        temp_path = f"{output_path}.partial"
+        with open(temp_path, mode="wb") as f:
+            f.write(data)
+        os.replace(temp_path, output_path)
+        record["bytes"] = len(data)
+    except Exception as e:
+        record["error"] = str(e)
+
+    record["elapsed"] = round(time.perf_counter() - start, 4)
+    return record
+
+
+class SharedFrameSlots:
+    """A fixed set of shared memory buffers that in-memory frames are copied into for the workers.
+
+    A slot is busy from put() until its job completes, so the slot count also bounds how many
+    frames are held at once.
+    """
+
+    def __init__(self, count:int) -> None:
+        self.free = list(range(count))
+        self._segments: List[shared_memory.SharedMemory|None] = [None] * count
+
+    def put(self, frame:np.ndarray)->FrameRef:
+        slot = self.free.pop()
+        segment = self._segments[slot]
+        if segment is None or segment.size < frame.nbytes:
+            if segment is not None:
+                segment.close()
+                segment.unlink()
+            segment = self._segments[slot] = shared_memory.SharedMemory(create=True, size=max(1, frame.nbytes))
+        np.ndarray(frame.shape, dtype=frame.dtype, buffer=segment.buf)[...] = frame
+        return (slot, segment.name, frame.shape, frame.dtype.str)
+
+    def release(self, slot:int):
+        self.free.append(slot)
+
+    def close(self):
+        for segment in self._segments:
+            if segment is not None:
+                segment.close()
+                segment.unlink()
+        self._segments = [None] * len(self._segments)
+
+
+class BulkRenderer:
+    """Burns captions into many images on a process pool, encoding and writing in the workers.
+
+    At most `max_in_flight` jobs are submitted or waiting to be yielded at any time, so a slow
+    consumer or a huge job list never piles up work in memory. With `ordered=True` results
+    come back in job order, otherwise as soon as each finishes.
+    """
+
+    def __init__(self, output_dir:str, style:RenderStyle|None=None, workers:int|None=None, fmt:str="JPEG",
+    quality:int=90, ordered:bool=True, max_in_flight:int|None=None, share_frames:bool=True,
+    skip_existing:bool=False, mp_context:str|None=None) -> None:
+        if fmt not in DOWNLOAD_FORMATS:
+            raise ValueError(f"Unknown output format: {fmt}")
+        self.output_dir = output_dir
+        self.style = style or RenderStyle()
+        self.workers = workers or os.cpu_count() or 1
+        self.fmt = fmt
+        self.quality = quality
+        self.ordered = ordered
+        self.max_in_flight = max_in_flight or self.workers * 2
+        self.share_frames = share_frames
+        self.skip_existing = skip_existing
+        self.mp_context = multiprocessing.get_context(mp_context) if mp_context else None
+
+    def output_path(self, index:int, job:RenderJob, used:Set[str]|None=None)->str:
+        """Where the job's image goes; derived names already in `used` get a numeric suffix"""
+        name = job.output_name
+        if name is None:
+            stem = os.path.splitext(os.path.basename(job.path))[0] if job.path else f"frame_{index:06d}"
+            extension = DOWNLOAD_FORMATS[self.fmt][1]
+            name = f"captioned_{stem}.{extension}"
+            # Same-named inputs from different folders would otherwise overwrite each other
+            suffix = 1
+            while used is not None and name in used:
+                suffix += 1
+                name = f"captioned_{stem}_{suffix}.{extension}"
+        if used is not None:
+            used.add(name)
+        return os.path.join(self.output_dir, name)
+
+    def iter_render(self, jobs:Iterable[RenderJob])->Iterator[Dict]:
+        os.makedirs(self.output_dir, exist_ok=True)
+        pending: Dict[Future, Tuple[int, int|None]] = {}
+        finished: Dict[int, Dict] = {}
+        next_index = 0
+        slots = SharedFrameSlots(self.max_in_flight)
+        used_names: Set[str] = set()
+
+        def collect(block:bool)->List[Dict]:
+            nonlocal next_index
+            if pending:
+                done, _ = wait(pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, slot = pending.pop(future)
+                    if slot is not None:
+                        slots.release(slot)
+                    finished[index] = future.result()
+
+            if not self.ordered:
+                ready = list(finished.values())
+                finished.clear()
+                return ready
+            ready = []
+            while next_index in finished:
+                ready.append(finished.pop(next_index))
+                next_index += 1
+            return ready
+
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context,
+                    initializer=_init_worker) as pool:
+                for index, job in enumerate(jobs):
+                    # Backpressure: wait for room before taking on another job
+                    while len(pending) + len(finished) >= self.max_in_flight:
+                        yield from collect(block=True)
+
+                    output_path = self.output_path(index, job, used_names)
+                    if self.skip_existing and os.path.exists(output_path):
+                        finished[index] = {"index": index, "path": job.path, "output": output_path,
+                            "error": None, "skipped": True, "elapsed": 0.0}
+                        yield from collect(block=False)
+                        continue
+
+                    frame, slot = job.frame, None
+                    if frame is not None and self.share_frames:
+                        frame = slots.put(np.ascontiguousarray(frame))
+                        slot = frame[0]
+                    future = pool.submit(_render_job, index, job.caption, job.path, frame, output_path,
+                        job.style or self.style, self.fmt, self.quality)
+                    pending[future] = (index, slot)
+                    yield from collect(block=False)
+
+                while pending or finished:
+                    yield from collect(block=True)
+        finally:
+            slots.close()
+
+    def run(self, jobs:Iterable[RenderJob])->Dict:
+        latencies = []
+        succeeded = failed = skipped = 0
+        start = time.perf_counter()
+        for record in self.iter_render(jobs):
+            if record.get("skipped"):
+                skipped += 1
+                continue
+            latencies.append(record["elapsed"])
+            if record["error"] is None:
+                succeeded += 1
+            else:
+                failed += 1
+
+        elapsed = time.perf_counter() - start
+        return {
+            "succeeded": succeeded,
+            "failed": failed,
+            "skipped": skipped,
+            "elapsed": round(elapsed, 3),
+            "images_per_second": round((succeeded + failed) / elapsed, 3) if elapsed else 0.0,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95)
+        }
+
+
+def iter_caption_records(path:str)->Iterator[RenderJob]:
+    """Jobs from a JSONL file of {"path", "caption"} records, such as batch_caption.py output"""
+    with open(path, mode="r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("caption"):
+                yield RenderJob(record["caption"], path=record["path"])
+
+
+def iter_history_jobs(records:Iterable[Dict], image_dir:str)->Iterator[RenderJob]:
+    """Jobs from caption history records; an image captioned several times uses its newest caption"""
+    latest: Dict[str, Dict] = {}
+    for record in records:
+        previous = latest.get(record["image_name"])
+        if previous is None or record["timestamp"] >= previous["timestamp"]:
+            latest[record["image_name"]] = record
+    for image_name, record in latest.items():
+        yield RenderJob(record["caption"], path=os.path.join(image_dir, image_name))
+
+
+def main(argv:List[str]|None=None)->int:
+    parser = argparse.ArgumentParser(description="Burn captions into many images using every CPU core")
+    parser.add_argument("source", nargs="?", help="JSONL of {path, caption} records, e.g. from batch_caption.py")
+    parser.add_argument("-o", "--output-dir", required=True)
+    parser.add_argument("--from-history", action="store_true", help="Use the newest caption of each image in the history")
+    parser.add_argument("--storage", default="jsonl", choices=["json", "jsonl", "sqlite"])
+    parser.add_argument("--image-dir", default=".", help="Directory holding the history's images")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Worker processes (defaults to the CPU count)")
+    parser.add_argument("--method", default="overlay", choices=["overlay", "background"])
+    parser.add_argument("--position", default="bottom", choices=["bottom", "center", "top"])
+    parser.add_argument("--font-size", type=float, default=None,
+        help="Overlay scale (default 1.0) or background font size in pixels (default 24)")
+    parser.add_argument("--thickness", type=int, default=2)
+    parser.add_argument("--font", default=None, help="TrueType font path")
+    parser.add_argument("--format", default="JPEG", choices=sorted(DOWNLOAD_FORMATS))
+    parser.add_argument("--quality", type=int, default=90)
+    parser.add_argument("--unordered", action="store_true", help="Report results as they finish rather than in order")
+    parser.add_argument("--skip-existing", action="store_true", help="Leave images already exported untouched")
+    args = parser.parse_args(argv)
+
+    if args.from_history:
+        from caption_history import CaptionHistory
+        history = CaptionHistory(use_file_history=False, storage=args.storage)
+        jobs = iter_history_jobs(history.get_history(), args.image_dir)
+    elif args.source:
+        jobs = iter_caption_records(args.source)
+    else:
+        parser.error("a JSONL source or --from-history is required")
+
+    style = RenderStyle(method=args.method, position=args.position, thickness=args.thickness, font_path=args.font)
+    if args.font_size is not None:
+        style = replace(style, font_size=args.font_size, pil_font_size=int(args.font_size))
+
+    renderer = BulkRenderer(args.output_dir, style=style, workers=args.workers, fmt=args.format,
+        quality=args.quality, ordered=not args.unordered, skip_existing=args.skip_existing)
+    summary = renderer.run(jobs)
+
+    print(
+        f"Rendered {summary['succeeded']} images ({summary['failed']} failed, {summary['skipped']} skipped) "
+        f"with {renderer.workers} workers in {summary['elapsed']:.1f}s: {summary['images_per_second']:.2f} images/s"
+    )
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+from PIL import Image
+
+
+def image_fingerprint(image:Image.Image)->str:
+    """Hash of the decoded pixels, so re-saved copies of the same image share a key"""
+    normalized = image if image.mode == "RGB" else image.convert("RGB")
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{normalized.width}x{normalized.height}".encode())
+    digest.update(normalized.tobytes())
+    return digest.hexdigest()
+
+
+def make_cache_key(fingerprint:str, provider:str, model:str, prompt:str, params:Dict|None=None)->str:
+    payload = json.dumps({
+        "image": fingerprint,
+        "provider": provider,
+        "model": model,
+        "prompt": prompt,
+        "params": params or {}
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class CaptionCache:
+    """Two-tier caption cache: an in-memory LRU in front of a JSON-file store on disk"""
+
+    def __init__(self, cache_dir:str|None=".caption_cache", max_memory_entries:int=512,
+    max_disk_entries:int=100_000, ttl_seconds:float|None=7 * 24 * 3600) -> None:
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+
+        self._memory: OrderedDict[str, Dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_count: int|None = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _is_expired(self, entry:Dict)->bool:
+        if self.ttl_seconds is None:
+            return False
+        return time.time() - entry["created"] > self.ttl_seconds
+
+    def _disk_path(self, key:str)->str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_disk(self, key:str)->Dict|None:
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(key), mode="r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write_disk(self, key:str, entry:Dict):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._disk_path(key)
+        is_new = not os.path.exists(path)
+
+        # Write to a temp file first so a crash never leaves a half-written entry
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, mode="w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+        if is_new:
+            if self._disk_count is None:
+                self._disk_count = self._count_disk_entries()
+            else:
+                self._disk_count += 1
+            if self._disk_count > self.max_disk_entries:
+                self._evict_disk()
+
+    def _remove_disk(self, key:str):
+        if not self.cache_dir:
+            return
+        try:
+            os.remove(self._disk_path(key))
+            if self._disk_count is not None:
+                self._disk_count -= 1
+        except FileNotFoundError:
+            pass
+
+    def _count_disk_entries(self)->int:
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return 0
+        return sum(1 for name in os.listdir(self.cache_dir) if name.endswith(".json"))
+
+    def _evict_disk(self):
+        # Drop the oldest entries down to 90% of the limit so eviction isn't run on every put
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except FileNotFoundError:
+                    continue
+        entries.sort()
+
+        target = int(self.max_disk_entries * 0.9)
+        for _, path in entries[:max(len(entries) - target, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._disk_count = self._count_disk_entries()
+
+    def _remember(self, key:str, entry:Dict):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key:str)->str|None:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._is_expired(entry):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry["caption"]
+                del self._memory[key]
+
+            entry = self._read_disk(key)
+            if entry is not None:
+                if not self._is_expired(entry):
+                    self._remember(key, entry)
+                    self.disk_hits += 1
+                    return entry["caption"]
+                self._remove_disk(key)
+
+            self.misses += 1
+            return None
+
+    def put(self, key:str, caption:str):
+        entry = {"caption": caption, "created": time.time()}
+        with self._lock:
+            self._remember(key, entry)
+            self._write_disk(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self.cache_dir and os.path.isdir(self.cache_dir):
+                for name in os.listdir(self.cache_dir):
+                    if name.endswith(".json"):
+                        os.remove(os.path.join(self.cache_dir, name))
+            self._disk_count = 0
+
+    def stats(self)->Dict:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+            "memory_entries": len(self._memory)
+        }
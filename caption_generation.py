@@ -1,93 +1,707 @@
-import io
-import base64
+import re
+import json
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, TypeVar
 from PIL import Image, ImageDraw, ImageFont
 
-# API Clients
-import openai
-import google.generativeai as genai
-from groq import Groq
+from caption_cache import CaptionCache, make_cache_key
+from image_preprocessing import EncodedImage, PreparedImage, PreprocessConfig, prepare_image
+from perceptual_hash import NearDuplicateIndex
+from provider_clients import ProviderClientRegistry, default_registry
+from provider_registry import ProviderPlugin, default_model, get_provider
+from rate_limiting import PRIORITY_INTERACTIVE, RequestScheduler, default_scheduler, estimate_tokens
+from telemetry import BYTE_BUCKETS, TOKEN_BUCKETS, Tracer, default_tracer, in_context
+
+T = TypeVar("T")
+
+CAPTION_PROMPT = "Generate an engaging caption for this image. Be concise in your choice of words. Maximum word limit: 20."
+
+CANDIDATES_PROMPT = (
+    "Generate {n} distinct, engaging captions for this image, best first. Be concise in your choice of words. "
+    "Maximum word limit per caption: 20. Respond with JSON only, in the form {{\"captions\": [\"...\"]}}."
+)
+
+DEFAULT_MODELS = {name: default_model(name) for name in ("openai", "groq", "gemini")}
+
+
+def vision_messages(prompt:str, data_url:str)->List[Dict]:
+    return [
+        {
+            "role": "user",
+            "content": [{
+                "type": "text",
+                "text": prompt
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": data_url
+                }
+            }]
+        }
+    ]
+
+
+def rank_candidates(candidates:List[str|None], scores:List[float|None]|None=None)->List[str]:
+    """Distinct non-empty captions, highest score first when the provider scored them"""
+    order = list(range(len(candidates)))
+    if scores and all(score is not None for score in scores):
+        order.sort(key=lambda index: -scores[index])
+
+    ranked, seen = [], set()
+    for index in order:
+        caption = (candidates[index] or "").strip()
+        normalized = " ".join(caption.lower().split())
+        if caption and normalized not in seen:
+            seen.add(normalized)
+            ranked.append(caption)
+    return ranked
+
+
+def parse_candidates(text:str, n:int)->List[str]:
+    """Captions from a structured-output reply, falling back to one caption per line"""
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", (text or "").strip())
+    try:
+        data = json.loads(text)
+        captions = data.get("captions", []) if isinstance(data, dict) else data
+        captions = [caption for caption in captions if isinstance(caption, str)]
+    except (json.JSONDecodeError, AttributeError, TypeError):
+        captions = [re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", line).strip().strip('"') for line in text.splitlines()]
+    return rank_candidates(captions)[:n]
+
+
+@dataclass
+class CaptionResult:
+    provider: str
+    model: str
+    caption: str|None = None
+    error: str|None = None
+    elapsed: float = 0.0
+    # Served from the cache, so `elapsed` says nothing about the provider's latency
+    cached: bool = False
+
+    @property
+    def ok(self)->bool:
+        return self.error is None
+
+
+class StreamTimings:
+    """Time-to-first-token and total generation time of streamed captions, per provider and model"""
+
+    def __init__(self, window:int=200) -> None:
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: Dict[tuple, List[tuple]] = {}
+
+    def record(self, provider:str, model:str, first_token:float, total:float):
+        with self._lock:
+            samples = self._samples.setdefault((provider, model), [])
+            samples.append((first_token, total))
+            del samples[:-self.window]
+
+    def stats(self)->Dict[str, Dict]:
+        def median(values:List[float])->float:
+            ordered = sorted(values)
+            return ordered[len(ordered) // 2]
+
+        with self._lock:
+            samples = {key: list(values) for key, values in self._samples.items()}
+        return {
+            f"{provider}/{model}": {
+                "streams": len(values),
+                "ttft_p50": median([first for first, _ in values]),
+                "total_p50": median([total for _, total in values]),
+                "ttft_last": values[-1][0],
+                "total_last": values[-1][1]
+            }
+            for (provider, model), values in samples.items()
+        }
 
 
 class MultiModalCaptionGenerator:
-    def __init__(self) -> None:
+    def __init__(self, cache:CaptionCache|None=None, use_cache:bool=True,
+    preprocess_config:PreprocessConfig|None=None, max_concurrency:int=8,
+    scheduler:RequestScheduler|None=None, clients:ProviderClientRegistry|None=None,
+    duplicate_index:NearDuplicateIndex|None=None, tracer:Tracer|None=None) -> None:
         self.openai_client = None
         self.groq_client = None
         self.gemini_configured = False
+        self.plugin_keys: Dict[str, str] = {}
 
-    def configure_apis(self, openai_key:str|None=None, groq_key:str|None=None, gemini_key:str|None=None):
+        self.cache = cache if cache is not None else CaptionCache()
+        self.use_cache = use_cache
+        # Whether each thread's last caption call was a cache hit; see served_from_cache
+        self._cache_hits = threading.local()
+        self.preprocess_config = preprocess_config or PreprocessConfig()
+        # Shared process-wide by default so concurrent sessions respect one quota
+        self.scheduler = scheduler if scheduler is not None else default_scheduler()
+        self.stream_timings = StreamTimings()
+        # Perceptual hashes of everything captioned, to offer captions for near-identical images
+        self.duplicate_index = duplicate_index if duplicate_index is not None else NearDuplicateIndex()
+        # Pooled SDK clients are shared process-wide too, so connections are reused across sessions
+        self.clients = clients if clients is not None else default_registry()
+        # Stage timings and per-provider metrics go to the process-wide registry unless given one
+        self.tracer = tracer if tracer is not None else default_tracer()
+        self.metrics = self.tracer.metrics
+
+        # Shared by every async call so the limit holds across concurrent fan-outs
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="caption")
+
+    def configure_apis(self, openai_key:str|None=None, groq_key:str|None=None, gemini_key:str|None=None,
+    plugin_keys:Dict[str, str]|None=None):
         if openai_key:
-            self.openai_client = openai.OpenAI(api_key=openai_key)
+            self.openai_client = self.clients.openai(openai_key)
         if groq_key:
-            self.groq_client = Groq(api_key=groq_key)
+            self.groq_client = self.clients.groq(groq_key)
         if gemini_key:
+            self.clients.configure_gemini(gemini_key)
             self.gemini_configured = True
-            genai.configure(api_key=gemini_key)
+        for provider, api_key in (plugin_keys or {}).items():
+            plugin = get_provider(provider)
+            if plugin.configure is not None:
+                plugin.configure(self, api_key)
+            self.plugin_keys[provider] = api_key
+
+    def prepare_image(self, image:Image.Image|PreparedImage)->PreparedImage:
+        return prepare_image(image, self.preprocess_config)
+
+    def encode_image_base64(self, image:Image.Image|PreparedImage, provider:str|None=None)->str:
+        return self.prepare_image(image).encode(provider).base64
+
+    def served_from_cache(self)->bool:
+        """Whether this thread's last caption or candidates call was answered from the cache"""
+        return getattr(self._cache_hits, "value", False)
+
+    def _cache_key(self, provider:str, model:str, image:PreparedImage, params:Dict)->str:
+        # The payload settings change what the model sees, so they are part of the key
+        key_params = {**params, **image.config.cache_params(provider)}
+        return make_cache_key(image.fingerprint, provider, model, CAPTION_PROMPT, key_params)
 
-    def encode_image_base64(self, image:Image.Image)->str:
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue()).decode()
+    def _cached_caption(self, provider:str, model:str, image:PreparedImage, params:Dict,
+    generate:Callable[[], str], use_cache:bool|None)->str:
+        if use_cache is None:
+            use_cache = self.use_cache
+
+        def checked()->str:
+            caption = generate()
+            # OpenAI can return content=None; caching it would hand "" back to every matching image
+            if caption is None or not caption.strip():
+                raise ValueError(f"{provider} returned no caption")
+            return caption
+
+        self._cache_hits.value = False
+        if not use_cache:
+            caption = checked()
+        else:
+            key = self._cache_key(provider, model, image, params)
+            caption = self._cache_lookup(provider, model, key)
+            self._cache_hits.value = caption is not None
+            if caption is None:
+                caption = checked()
+                self.cache.put(key, caption)
+        self._remember(provider, model, image, caption)
+        return caption
+
+    def _cached_candidates(self, provider:str, model:str, image:PreparedImage, params:Dict,
+    generate:Callable[[], List[str]], use_cache:bool|None)->List[str]:
+        if use_cache is None:
+            use_cache = self.use_cache
+        # Candidate lists are cached as JSON under their own keys, apart from single captions
+        key = self._cache_key(provider, model, image, {**params, "candidates": True}) if use_cache else None
+        cached = self._cache_lookup(provider, model, key) if key is not None else None
+        self._cache_hits.value = cached is not None
+        if cached is not None:
+            candidates = json.loads(cached)
+        else:
+            candidates = generate()
+            if not candidates:
+                raise ValueError(f"{provider} returned no captions")
+            if key is not None:
+                self.cache.put(key, json.dumps(candidates))
+        self._remember(provider, model, image, candidates[0])
+        return candidates
+
+    def _cache_lookup(self, provider:str, model:str, key:str)->str|None:
+        with self.tracer.span("cache", provider=provider):
+            caption = self.cache.get(key)
+        self.metrics.inc("icg_cache_requests_total", provider=provider, model=model,
+            result="miss" if caption is None else "hit")
+        return caption
+
+    def _record_request(self, provider:str, model:str, payload_bytes:int|None, elapsed:float, ok:bool,
+    tokens:int|None):
+        labels = {"provider": provider, "model": model}
+        self.metrics.observe("icg_provider_request_seconds", elapsed, **labels)
+        self.metrics.inc("icg_provider_requests_total", outcome="ok" if ok else "error", **labels)
+        if payload_bytes is not None:
+            self.metrics.observe("icg_payload_bytes", payload_bytes, buckets=BYTE_BUCKETS, **labels)
+        if tokens:
+            self.metrics.inc("icg_tokens_total", tokens, **labels)
+            self.metrics.observe("icg_tokens", tokens, buckets=TOKEN_BUCKETS, **labels)
+
+    def _remember(self, provider:str, model:str, image:PreparedImage, caption:str|None):
+        if caption:
+            # Hashed with the index's own method; mixing methods would make every distance meaningless
+            value = image.hash_for(self.duplicate_index.method)
+            self.duplicate_index.add(value, {
+                "provider": provider, "model": model, "caption": caption, self.duplicate_index.hash_field: value
+            })
+
+    def find_similar(self, image:Image.Image|PreparedImage, threshold:int|None=None)->List[Dict]:
+        """Earlier captions of perceptually similar images, closest first, each with its `distance`"""
+        image = self.prepare_image(image)
+        value = image.hash_for(self.duplicate_index.method)
+        return [{**record, "distance": distance} for distance, record in self.duplicate_index.lookup(value, threshold)]
+
+    def cache_stats(self)->Dict:
+        return self.cache.stats()
+
+    def connection_stats(self)->Dict[str, Dict]:
+        return self.clients.metrics()
+
+    def _scheduled(self, provider:str, model:str, encoded:EncodedImage|None, request:Callable[[], T],
+    usage:Callable[[T], int|None], priority:int, max_output_tokens:int=60)->T:
+        # Plugins encode their own payloads, so they are charged one request without an estimate
+        tokens = estimate_tokens(encoded.size, CAPTION_PROMPT, max_output_tokens) if encoded is not None else 1
+        payload_bytes = len(encoded.data) if encoded is not None else None
+        start = time.perf_counter()
+        try:
+            with self.tracer.span("provider", provider=provider, model=model):
+                response = self.scheduler.call(provider, request, tokens=tokens, priority=priority)
+        except Exception:
+            self._record_request(provider, model, payload_bytes, time.perf_counter() - start, False, None)
+            raise
+
+        used_tokens = None
+        try:
+            used_tokens = usage(response)
+        except AttributeError:
+            pass
+        self.scheduler.reconcile(provider, tokens, used_tokens)
+        self._record_request(provider, model, payload_bytes, time.perf_counter() - start, True, used_tokens)
+        return response
     
-    def generate_caption_openai(self, image:Image.Image, model:str="gpt-5-nano")->str:
+    def _streamed_caption(self, provider:str, model:str, image:PreparedImage, params:Dict,
+    open_stream:Callable[[EncodedImage], Iterable[Any]], delta:Callable[[Any], str|None],
+    usage:Callable[[Any], int|None], use_cache:bool|None, priority:int)->Iterator[str]:
+        if use_cache is None:
+            use_cache = self.use_cache
+        key = None
+        if use_cache:
+            # Streaming and non-streaming calls share cache entries
+            key = self._cache_key(provider, model, image, params)
+            caption = self._cache_lookup(provider, model, key)
+            if caption is not None:
+                self._remember(provider, model, image, caption)
+                yield caption
+                return
+
+        encoded = image.encode(provider)
+        tokens = estimate_tokens(encoded.size, CAPTION_PROMPT)
+        start = time.perf_counter()
+        first_token = None
+        used_tokens = None
+        parts = []
+        try:
+            # Only opening the stream is scheduled and retried; a stream that breaks midway raises
+            stream = self.scheduler.call(provider, lambda: open_stream(encoded), tokens=tokens, priority=priority)
+            for chunk in stream:
+                try:
+                    used_tokens = usage(chunk) or used_tokens
+                except (AttributeError, IndexError, TypeError):
+                    pass
+                try:
+                    text = delta(chunk)
+                except (AttributeError, IndexError, ValueError):
+                    text = None
+                if text:
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    parts.append(text)
+                    yield text
+        except Exception:
+            self.tracer.record("provider", start, time.perf_counter() - start, provider=provider, model=model)
+            self._record_request(provider, model, len(encoded.data), time.perf_counter() - start, False, None)
+            raise
+
+        total = time.perf_counter() - start
+        caption = "".join(parts)
+        if not caption.strip():
+            # Counted as a failure and never cached, or later calls would get it back for the whole TTL
+            self.tracer.record("provider", start, total, provider=provider, model=model)
+            self._record_request(provider, model, len(encoded.data), total, False, used_tokens)
+            raise ValueError(f"{provider} returned no caption")
+        first_token = first_token if first_token is not None else total
+        self.tracer.record("provider", start, total, provider=provider, model=model, first_token=first_token)
+        self.metrics.observe("icg_time_to_first_token_seconds", first_token, provider=provider, model=model)
+        self._record_request(provider, model, len(encoded.data), total, True, used_tokens)
+        self.stream_timings.record(provider, model, first_token, total)
+        self.scheduler.reconcile(provider, tokens, used_tokens)
+        if key is not None:
+            self.cache.put(key, caption)
+        self._remember(provider, model, image, caption)
+
+    def stream_caption_openai(self, image:Image.Image|PreparedImage, model:str="gpt-5-nano", use_cache:bool|None=None,
+    priority:int=PRIORITY_INTERACTIVE)->Iterator[str]:
+        if not self.openai_client:
+            raise ValueError("OpenAI API key is not configured!")
+
+        image = self.prepare_image(image)
+        params = {"max_completion_tokens": 20000}
+
+        def open_stream(encoded:EncodedImage):
+            return self.openai_client.chat.completions.create(
+                model=model,
+                messages=vision_messages(CAPTION_PROMPT, encoded.data_url),
+                stream=True,
+                stream_options={"include_usage": True},
+                **params
+            )
+
+        return self._streamed_caption("openai", model, image, params, open_stream,
+            lambda chunk: chunk.choices[0].delta.content, lambda chunk: chunk.usage.total_tokens,
+            use_cache, priority)
+
+    def stream_caption_groq(self, image:Image.Image|PreparedImage, model:str="meta-llama/llama-4-scout-17b-16e-instruct", use_cache:bool|None=None,
+    priority:int=PRIORITY_INTERACTIVE)->Iterator[str]:
+        if not self.groq_client:
+            raise ValueError("GROQ API key is not configured!")
+
+        image = self.prepare_image(image)
+        params = {"max_tokens": 500, "temperature": 0.7}
+
+        def open_stream(encoded:EncodedImage):
+            return self.groq_client.chat.completions.create(
+                model=model,
+                messages=vision_messages(CAPTION_PROMPT, encoded.data_url),
+                stream=True,
+                **params
+            )
+
+        # Groq reports usage on the final chunk under x_groq
+        return self._streamed_caption("groq", model, image, params, open_stream,
+            lambda chunk: chunk.choices[0].delta.content, lambda chunk: chunk.x_groq.usage.total_tokens,
+            use_cache, priority)
+
+    def stream_caption_gemini(self, image:Image.Image|PreparedImage, model:str="gemini-2.5-flash-lite", use_cache:bool|None=None,
+    priority:int=PRIORITY_INTERACTIVE)->Iterator[str]:
+        if not self.gemini_configured:
+            raise ValueError("Gemini API key is not configured!")
+
+        image = self.prepare_image(image)
+
+        def open_stream(encoded:EncodedImage):
+            return self.clients.gemini_model(model).generate_content([
+                CAPTION_PROMPT,
+                {"mime_type": encoded.mime_type, "data": encoded.data}
+            ], stream=True)
+
+        return self._streamed_caption("gemini", model, image, {}, open_stream,
+            lambda chunk: chunk.text, lambda chunk: chunk.usage_metadata.total_token_count,
+            use_cache, priority)
+
+    def generate_caption_openai(self, image:Image.Image|PreparedImage, model:str="gpt-5-nano", use_cache:bool|None=None,
+    priority:int=PRIORITY_INTERACTIVE)->str:
         if not self.openai_client:
             raise ValueError("OpenAI API key is not configured!")
-        
-        base64_image = self.encode_image_base64(image)
-
-        response = self.openai_client.chat.completions.create(
-            model=model, 
-            messages=[
-               { "role": "user",
-                "content": [{
-                    "type": "text",
-                    "text": "Generate an engaging caption for this image. Be concise in your choice of words. Maximum word limit: 20."
-                },
-                {
-                    "type": "image_url", 
-                    "image_url": {
-                        "url": f"data:image/png;base64,{base64_image}"
-                    }
-                }]}
-            ],
-            max_completion_tokens=20000
-        )
-        return response.choices[0].message.content
+
+        image = self.prepare_image(image)
+        params = {"max_completion_tokens": 20000}
+
+        def generate()->str:
+            encoded = image.encode("openai")
+
+            response = self._scheduled("openai", model, encoded, lambda: self.openai_client.chat.completions.create(
+                model=model, 
+                messages=vision_messages(CAPTION_PROMPT, encoded.data_url),
+                **params
+            ), lambda response: response.usage.total_tokens, priority)
+            return response.choices[0].message.content
+
+        return self._cached_caption("openai", model, image, params, generate, use_cache)
     
-    def generate_caption_groq(self, image:Image.Image, model:str="meta-llama/llama-4-scout-17b-16e-instruct")->str:
+    def generate_caption_groq(self, image:Image.Image|PreparedImage, model:str="meta-llama/llama-4-scout-17b-16e-instruct", use_cache:bool|None=None,
+    priority:int=PRIORITY_INTERACTIVE)->str:
         if not self.groq_client:
             raise ValueError("GROQ API key is not configured!")
-        
-        base64_image = self.encode_image_base64(image)
-
-        completion = self.groq_client.chat.completions.create(
-            model = model, 
-            messages = [
-                {
-                    "role": "user", 
-                    "content": [{
-                        "type": "text",
-                        "text": "Generate an engaging caption for this image. Be concise in your choice of words. Maximum word limit: 20."
-                    },
-                    {
-                        "type":"image_url",
-                        "image_url": {
-                            "url": f"data:image/png;base64,{base64_image}"
-                        }
-                    }
-                    ]
-                }
-            ],
-            max_tokens=500,
-            temperature=0.7
-        )
-        return completion.choices[0].message.content
+
+        image = self.prepare_image(image)
+        params = {"max_tokens": 500, "temperature": 0.7}
+
+        def generate()->str:
+            encoded = image.encode("groq")
+
+            completion = self._scheduled("groq", model, encoded, lambda: self.groq_client.chat.completions.create(
+                model = model, 
+                messages = vision_messages(CAPTION_PROMPT, encoded.data_url),
+                **params
+            ), lambda completion: completion.usage.total_tokens, priority)
+            return completion.choices[0].message.content
+
+        return self._cached_caption("groq", model, image, params, generate, use_cache)
     
-    def generate_caption_gemini(self, image:Image.Image, model:str="gemini-2.5-flash-lite")->str:
+    def generate_caption_gemini(self, image:Image.Image|PreparedImage, model:str="gemini-2.5-flash-lite", use_cache:bool|None=None,
+    priority:int=PRIORITY_INTERACTIVE)->str:
+        if not self.gemini_configured:
+            raise ValueError("Gemini API key is not configured!")
+
+        image = self.prepare_image(image)
+
+        def generate()->str:
+            encoded = image.encode("gemini")
+            model_instance = self.clients.gemini_model(model)
+            response = self._scheduled("gemini", model, encoded, lambda: model_instance.generate_content([
+                CAPTION_PROMPT,
+                {"mime_type": encoded.mime_type, "data": encoded.data}
+            ]), lambda response: response.usage_metadata.total_token_count, priority)
+            return response.text
+
+        return self._cached_caption("gemini", model, image, {}, generate, use_cache)
+
+    def generate_candidates_openai(self, image:Image.Image|PreparedImage, n:int=3, model:str="gpt-5-nano",
+    use_cache:bool|None=None, priority:int=PRIORITY_INTERACTIVE)->List[str]:
+        if not self.openai_client:
+            raise ValueError("OpenAI API key is not configured!")
+
+        image = self.prepare_image(image)
+        # Native choices: the image and prompt are sent and billed once for all n captions
+        params = {"max_completion_tokens": 20000, "n": n}
+
+        def generate()->List[str]:
+            encoded = image.encode("openai")
+            response = self._scheduled("openai", model, encoded, lambda: self.openai_client.chat.completions.create(
+                model=model,
+                messages=vision_messages(CAPTION_PROMPT, encoded.data_url),
+                **params
+            ), lambda response: response.usage.total_tokens, priority, max_output_tokens=60 * n)
+            return rank_candidates([choice.message.content for choice in response.choices])
+
+        return self._cached_candidates("openai", model, image, params, generate, use_cache)
+
+    def generate_candidates_groq(self, image:Image.Image|PreparedImage, n:int=3,
+    model:str="meta-llama/llama-4-scout-17b-16e-instruct", use_cache:bool|None=None,
+    priority:int=PRIORITY_INTERACTIVE)->List[str]:
+        if not self.groq_client:
+            raise ValueError("GROQ API key is not configured!")
+
+        image = self.prepare_image(image)
+        # Groq only accepts n=1, so all candidates come from one structured-output reply
+        params = {"max_tokens": 500, "temperature": 0.7, "response_format": {"type": "json_object"}}
+
+        def generate()->List[str]:
+            encoded = image.encode("groq")
+            completion = self._scheduled("groq", model, encoded, lambda: self.groq_client.chat.completions.create(
+                model=model,
+                messages=vision_messages(CANDIDATES_PROMPT.format(n=n), encoded.data_url),
+                **params
+            ), lambda completion: completion.usage.total_tokens, priority, max_output_tokens=60 * n)
+            return parse_candidates(completion.choices[0].message.content, n)
+
+        return self._cached_candidates("groq", model, image, {**params, "n": n}, generate, use_cache)
+
+    def generate_candidates_gemini(self, image:Image.Image|PreparedImage, n:int=3, model:str="gemini-2.5-flash-lite",
+    use_cache:bool|None=None, priority:int=PRIORITY_INTERACTIVE)->List[str]:
         if not self.gemini_configured:
             raise ValueError("Gemini API key is not configured!")
-        
-        model_instance = genai.GenerativeModel(model_name=model)
-        prompt = "Generate an engaging caption for this image. Be concise in your choice of words. Maximum word limit: 20."
 
-        response = model_instance.generate_content([prompt, image])
-        return response.text
\ No newline at end of file
+        image = self.prepare_image(image)
+        params = {"candidate_count": n}
+
+        def generate()->List[str]:
+            encoded = image.encode("gemini")
+            model_instance = self.clients.gemini_model(model)
+            response = self._scheduled("gemini", model, encoded, lambda: model_instance.generate_content([
+                CAPTION_PROMPT,
+                {"mime_type": encoded.mime_type, "data": encoded.data}
+            ], generation_config=params), lambda response: response.usage_metadata.total_token_count,
+                priority, max_output_tokens=60 * n)
+            # Candidates carry their mean token log-probability, which ranks them
+            return rank_candidates(
+                ["".join(part.text for part in candidate.content.parts) for candidate in response.candidates],
+                [getattr(candidate, "avg_logprobs", None) for candidate in response.candidates]
+            )
+
+        return self._cached_candidates("gemini", model, image, params, generate, use_cache)
+
+    def configured_providers(self)->List[str]:
+        configured = {
+            "openai": self.openai_client is not None,
+            "groq": self.groq_client is not None,
+            "gemini": self.gemini_configured
+        }
+        # Plugins count once configure_apis has given them a key; listing them doesn't import them
+        configured.update({provider: True for provider in self.plugin_keys})
+        return [provider for provider, ready in configured.items() if ready]
+
+    def _plugin(self, provider:str):
+        plugin = get_provider(provider)
+        if not plugin.builtin and provider not in self.plugin_keys:
+            raise ValueError(f"{provider} API key is not configured!")
+        return plugin
+
+    def _plugin_caption(self, plugin:ProviderPlugin, image:PreparedImage, model:str, priority:int)->str:
+        if plugin.caption is not None:
+            caption = plugin.caption(self, image, model, priority)
+        else:
+            # Stream-only providers: the whole stream is the caption
+            caption = "".join(plugin.stream(self, image, model, priority))
+        if not caption or not caption.strip():
+            raise ValueError(f"{plugin.name} returned no caption")
+        return caption
+
+    def generate_caption(self, image:Image.Image|PreparedImage, provider:str, model:str|None=None,
+    use_cache:bool|None=None, priority:int=PRIORITY_INTERACTIVE)->str:
+        plugin = self._plugin(provider)
+        model = model or plugin.default_model
+        if not plugin.builtin:
+            image = self.prepare_image(image)
+            return self._cached_caption(provider, model, image, {}, lambda: self._scheduled(
+                provider, model, None, lambda: self._plugin_caption(plugin, image, model, priority),
+                lambda caption: None, priority
+            ), use_cache)
+
+        generators = {
+            "openai": self.generate_caption_openai,
+            "groq": self.generate_caption_groq,
+            "gemini": self.generate_caption_gemini
+        }
+        return generators[provider](image, model=model, use_cache=use_cache, priority=priority)
+
+    def generate_candidates(self, image:Image.Image|PreparedImage, provider:str, n:int=3, model:str|None=None,
+    use_cache:bool|None=None, priority:int=PRIORITY_INTERACTIVE)->List[str]:
+        """Up to n distinct captions, best first, from a single provider request where possible"""
+        if n <= 1:
+            return [self.generate_caption(image, provider, model=model, use_cache=use_cache, priority=priority)]
+
+        plugin = self._plugin(provider)
+        model = model or plugin.default_model
+        if not plugin.builtin:
+            image = self.prepare_image(image)
+            if plugin.candidates is not None:
+                generate = lambda: rank_candidates(self._scheduled(
+                    provider, model, None, lambda: plugin.candidates(self, image, model, n, priority),
+                    lambda candidates: None, priority
+                ))[:n]
+            else:
+                generate = lambda: rank_candidates([self._scheduled(
+                    provider, model, None, lambda: self._plugin_caption(plugin, image, model, priority),
+                    lambda caption: None, priority
+                ) for _ in range(n)])
+            return self._cached_candidates(provider, model, image, {"n": n}, generate, use_cache)
+
+        generators = {
+            "openai": self.generate_candidates_openai,
+            "groq": self.generate_candidates_groq,
+            "gemini": self.generate_candidates_gemini
+        }
+        return generators[provider](image, n=n, model=model, use_cache=use_cache, priority=priority)
+
+    def stream_caption(self, image:Image.Image|PreparedImage, provider:str, model:str|None=None,
+    use_cache:bool|None=None, priority:int=PRIORITY_INTERACTIVE)->Iterator[str]:
+        """Yield the caption as text deltas; the full caption is cached once the stream completes"""
+        plugin = self._plugin(provider)
+        model = model or plugin.default_model
+        if not plugin.builtin:
+            image = self.prepare_image(image)
+            if plugin.stream is not None:
+                open_stream = lambda encoded: plugin.stream(self, image, model, priority)
+            else:
+                # Providers without streaming arrive as one chunk
+                open_stream = lambda encoded: [self._plugin_caption(plugin, image, model, priority)]
+            return self._streamed_caption(provider, model, image, {}, open_stream,
+                lambda chunk: chunk, lambda chunk: None, use_cache, priority)
+
+        streams = {
+            "openai": self.stream_caption_openai,
+            "groq": self.stream_caption_groq,
+            "gemini": self.stream_caption_gemini
+        }
+        return streams[provider](image, model=model, use_cache=use_cache, priority=priority)
+
+    async def astream_caption(self, image:Image.Image|PreparedImage, provider:str, model:str|None=None,
+    use_cache:bool|None=None, priority:int=PRIORITY_INTERACTIVE)->AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        finished = object()
+        stopped = threading.Event()
+
+        def post(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # The event loop has gone away; nobody is listening any more
+                stopped.set()
+
+        def pump():
+            try:
+                for delta in self.stream_caption(image, provider, model=model, use_cache=use_cache, priority=priority):
+                    if stopped.is_set():
+                        return
+                    post(delta)
+                post(finished)
+            except Exception as e:
+                post(e)
+
+        # The SDK streams block, so they are consumed on the shared bounded pool
+        loop.run_in_executor(self._executor, in_context(pump))
+        try:
+            while True:
+                item = await queue.get()
+                if item is finished:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+
+    def stream_stats(self)->Dict[str, Dict]:
+        return self.stream_timings.stats()
+
+    async def agenerate_caption(self, image:Image.Image|PreparedImage, provider:str, model:str|None=None,
+    use_cache:bool|None=None, timeout:float|None=60.0, priority:int=PRIORITY_INTERACTIVE)->CaptionResult:
+        model = model or default_model(provider)
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+
+        def call()->tuple:
+            caption = self.generate_caption(image, provider, model=model, use_cache=use_cache, priority=priority)
+            return caption, self.served_from_cache()
+
+        # Provider SDK calls block, so they run on the shared bounded pool
+        future = loop.run_in_executor(self._executor, in_context(call))
+        try:
+            caption, cached = await asyncio.wait_for(future, timeout=timeout)
+            return CaptionResult(provider, model, caption=caption, elapsed=time.perf_counter() - start, cached=cached)
+        except asyncio.TimeoutError:
+            return CaptionResult(provider, model, error=f"Timed out after {timeout:g}s",
+                elapsed=time.perf_counter() - start)
+        except Exception as e:
+            return CaptionResult(provider, model, error=str(e), elapsed=time.perf_counter() - start)
+
+    async def agenerate(self, image:Image.Image|PreparedImage, providers:List[str]|None=None,
+    models:Dict[str, str]|None=None, timeouts:Dict[str, float]|None=None, timeout:float|None=60.0,
+    use_cache:bool|None=None)->AsyncIterator[CaptionResult]:
+        """Caption the image with several providers concurrently, yielding results as they finish"""
+        image = self.prepare_image(image)
+        providers = providers or self.configured_providers()
+        models = models or {}
+        timeouts = timeouts or {}
+
+        tasks = [
+            asyncio.create_task(self.agenerate_caption(
+                image, provider, model=models.get(provider), use_cache=use_cache,
+                timeout=timeouts.get(provider, timeout)
+            ))
+            for provider in providers
+        ]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield await next_result
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -1,118 +1,240 @@
 import os 
-import json
 import datetime
 from langchain_core.messages import AIMessage, HumanMessage, BaseMessage 
-from langchain_core.chat_history import BaseChatMessageHistory, InMemoryChatMessageHistory
-from langchain_community.chat_message_histories import FileChatMessageHistory 
-from typing import Dict, List
+from langchain_core.chat_history import BaseChatMessageHistory
+from typing import Dict, List, Tuple
+
+from history_storage import HistoryStore, create_store
+from history_writer import BufferedHistoryWriter
+from telemetry import timed
+
+# (timestamp, image_name, model, caption): what a stored interaction needs to become messages
+InteractionTuple = Tuple[str, str, str, str]
+
+# Interactions `messages` covers by default, so reading it never materializes the whole history
+DEFAULT_MESSAGE_WINDOW = 50
+
+
+def interaction_messages(record:InteractionTuple)->List[BaseMessage]:
+    timestamp, image_name, model, caption = record
+    metadata = {
+        "image_name": image_name, 
+        "model": model,
+        "timestamp": timestamp
+    }
+    return [
+        HumanMessage(content=f"Generate caption for {image_name} using {model}", additional_kwargs=dict(metadata)),
+        AIMessage(content=caption, additional_kwargs=dict(metadata))
+    ]
+
+
+class LazyChatMessageHistory(BaseChatMessageHistory):
+    """Chat history view that builds LangChain messages from stored interactions only when read.
+
+    Nothing is loaded at construction. `messages` covers the last window_size interactions
+    and/or the last window_hours hours, which is what should feed model context; pass
+    window_size=None for no count limit. all_messages() reads everything.
+    """
+
+    def __init__(self, caption_history:"CaptionHistory", window_size:int|None=DEFAULT_MESSAGE_WINDOW,
+    window_hours:float|None=None) -> None:
+        self.caption_history = caption_history
+        self.window_size = window_size
+        self.window_hours = window_hours
+        self._extra_messages: List[BaseMessage] = []
+
+    def records(self, last_n:int|None=None, hours:float|None=None)->List[InteractionTuple]:
+        history = self.caption_history
+        if hours is not None:
+            since = (datetime.datetime.now() - datetime.timedelta(hours=hours)).strftime("%Y-%m-%d %H:%M:%S")
+            items = [item for item in history._read_with_pending(lambda: history.store.query(since=since))
+                if item.get("timestamp", "") >= since]
+            if last_n is not None:
+                items = items[-last_n:]
+        elif last_n is not None:
+            items = history.get_recent_interactions(last_n)
+        else:
+            items = history.get_history()
+        return [(item["timestamp"], item["image_name"], item["model"], item["caption"]) for item in items]
+
+    def window(self, last_n:int|None=None, hours:float|None=None)->List[BaseMessage]:
+        messages = []
+        for record in self.records(last_n, hours):
+            messages.extend(interaction_messages(record))
+        return messages + self._extra_messages
+
+    @property
+    def messages(self)->List[BaseMessage]:  # type: ignore[override]
+        return self.window(self.window_size, self.window_hours)
+
+    def all_messages(self)->List[BaseMessage]:
+        return self.window()
+
+    def add_message(self, message:BaseMessage):
+        self._extra_messages.append(message)
+
+    def clear(self):
+        self._extra_messages = []
+
 
 class CaptionHistory:
-    def __init__(self, use_file_history:bool=True) -> None:
+    def __init__(self, use_file_history:bool=True, storage:str="jsonl", group_commit:bool=True,
+    flush_every:int=20, flush_interval:float|None=1.0, message_window:int|None=DEFAULT_MESSAGE_WINDOW,
+    message_window_hours:float|None=None, **storage_options) -> None:
         self.history_file = "caption_history.json"
-        self.metadata_file = "caption_metadata.json"
+        self.writer: BufferedHistoryWriter|None = None
+        self.store: HistoryStore = create_store(storage, **storage_options)
+        self.metadata_file = self.store.path
 
         if use_file_history:
+            # langchain_community is only needed for file-backed history
+            from langchain_community.chat_message_histories import FileChatMessageHistory
+
             self.chat_history = FileChatMessageHistory(file_path=self.history_file)
 
         else:
-            # Use in-memory history with manual persistance 
-            self.chat_history = InMemoryChatMessageHistory()
-            self.load_history()
+            # Use in-memory history with manual persistance; messages are built lazily from the store
+            self.chat_history = LazyChatMessageHistory(self, message_window, message_window_hours)
 
-    def add_interaction(self, image_name:str, model:str, caption:str, timestamp:str=None):
+        # Buffer writes into group commits; only the file-backed chat history is worth buffering
+        if group_commit:
+            self.writer = BufferedHistoryWriter(
+                self.store,
+                chat_history=self.chat_history if use_file_history else None,
+                flush_every=flush_every,
+                flush_interval=flush_interval
+            )
+
+    @timed("history.write")
+    def add_interaction(self, image_name:str, model:str, caption:str, timestamp:str=None,
+    content_hash:str|None=None, perceptual_hash:str|None=None, candidates:List[str]|None=None,
+    request_id:str|None=None):
         if not timestamp:
             timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
 
-            # Create message with metadata 
-            human_msg = HumanMessage(content=f"Generate caption for {image_name} using {model}.", 
-            additional_kwargs={
-                "image_name": image_name, 
-                "model": model, 
+        # Create message with metadata 
+        human_msg = HumanMessage(content=f"Generate caption for {image_name} using {model}.", 
+        additional_kwargs={
+            "image_name": image_name, 
+            "model": model, 
+            "timestamp": timestamp
+        })
+
+        ai_msg = AIMessage(content=caption, 
+        additional_kwargs={
+                "image_name": image_name,
+                "model": model,
                 "timestamp": timestamp
-            })
+        })
 
-            ai_msg = AIMessage(content=caption, 
-            additional_kwargs={
-                    "image_name": image_name,
-                    "model": model,
-                    "timestamp": timestamp
-            })
+        # Save metadata separately for easy querying 
+        interaction = {
+            "timestamp": timestamp,
+            "image_name": image_name,
+            "model": model,
+            "caption": caption
+        }
+        if content_hash:
+            interaction["content_hash"] = content_hash
+        if perceptual_hash:
+            interaction["perceptual_hash"] = perceptual_hash
+        if candidates and len(candidates) > 1:
+            # Alternatives from the same request stay with the one interaction; `caption` is the top-ranked one
+            interaction["candidates"] = list(candidates)
+        if request_id:
+            # Batch jobs merge by this, so a rerun doesn't add the same result twice
+            interaction["request_id"] = request_id
 
+        if self.writer is not None and self.writer.chat_history is not None:
+            # Messages and metadata go out together in the next group commit
+            self.writer.add(interaction, messages=[human_msg, ai_msg])
+        elif not isinstance(self.chat_history, LazyChatMessageHistory):
             # Add to Langchain chat history 
             self.chat_history.add_message(human_msg)
             self.chat_history.add_message(ai_msg)
-
-            # Save metadata separately for easy querying 
-            self.save_metadata({
-                "timestamp": timestamp,
-                "image_name": image_name,
-                "model": model,
-                "caption": caption
-            })
+            self.save_metadata(interaction)
+        else:
+            # The lazy history derives its messages from the saved metadata
+            self.save_metadata(interaction)
 
     def get_messages(self)->List[BaseMessage]:
+        if self.writer is not None and self.writer.chat_history is not None:
+            return self.writer.read_with_pending(lambda: self.chat_history.messages, pending="messages")
         return self.chat_history.messages
     
     def get_history(self)->List[Dict]:
-        try:
-            with open(self.metadata_file, mode="r") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            return []
+        return self._read_with_pending(self.store.read_all)
         
     def save_metadata(self, interaction:Dict):
-        history = self.get_history()
-        history.append(interaction)
+        if self.writer is not None:
+            self.writer.add(interaction)
+        else:
+            self.store.append(interaction)
 
-        with open(self.metadata_file, mode="w") as f:
-            json.dump(history, f, indent=2)
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
 
     def load_history(self):
-        if isinstance(self.chat_history, FileChatMessageHistory):
-            return
-        
-        history = self.get_history()
-        for item in history:
-            human_msg = HumanMessage(
-                content=f"Generate caption for {item['image_name']} using {item['model']}",
-                additional_kwargs={
-                    "image_name": item["image_name"], 
-                    "model": item["model"],
-                    "timestamp": item["timestamp"]
-                }
-            )
-            ai_msg = AIMessage(
-                content=item["caption"], 
-                additional_kwargs= {
-                    "image_name": item["image_name"], 
-                    "model": item["model"],
-                    "timestamp": item["timestamp"]
-                }
-            )
-            self.chat_history.add_message(human_msg)
-            self.chat_history.add_message(ai_msg)
+        # Kept for compatibility: the in-memory history now materializes messages on demand
+        return
 
     def clear_history(self):
+        if self.writer is not None:
+            self.writer.discard()
         self.chat_history.clear()
 
         # Remove metadata file 
-        if os.path.exists(self.metadata_file):
-            os.remove(self.metadata_file)
+        self.store.clear()
 
         # Remove history file if using manual persistance 
-        if isinstance(self.chat_history, FileChatMessageHistory):
+        if not isinstance(self.chat_history, LazyChatMessageHistory):
             if os.path.exists(self.history_file):
                 os.remove(self.history_file) 
 
+    def _read_with_pending(self, read, field:str|None=None, value:str|None=None)->List[Dict]:
+        # Readers see their own unflushed writes, merged atomically with respect to a flush
+        history = self.writer.read_with_pending(read) if self.writer is not None else read()
+        if field is None:
+            return history
+        return [item for item in history if item.get(field, None) == value]
+
     def get_recent_interactions(self, n:int=10)->List[Dict]:
-        history = self.get_history()
+        history = self._read_with_pending(lambda: self.store.recent(n))
         return history[-n:] if len(history) > n else history
     
     def search_by_model(self, model:str)->List[Dict]:
-        history = self.get_history()
-        return [item for item in history if item.get("model", None) == model]
+        return self._read_with_pending(lambda: self.store.search("model", model), "model", model)
     
     def search_by_image(self, image_name:str)->List[Dict]:
-        history = self.get_history()
-        return [item for item in history if item.get("image_name", None) == image_name]
+        return self._read_with_pending(lambda: self.store.search("image_name", image_name), "image_name", image_name)
+
+    def query_history(self, model:str|None=None, image_name:str|None=None, since:str|None=None,
+    until:str|None=None, limit:int|None=None, offset:int=0, newest_first:bool=False)->List[Dict]:
+        self.flush()
+        return self.store.query(model=model, image_name=image_name, since=since, until=until,
+            limit=limit, offset=offset, newest_first=newest_first)
+
+    def count_interactions(self, model:str|None=None, image_name:str|None=None, since:str|None=None,
+    until:str|None=None)->int:
+        self.flush()
+        return self.store.count(model=model, image_name=image_name, since=since, until=until)
+
+    def model_summary(self)->Dict[str, Dict]:
+        self.flush()
+        return self.store.model_counts()
+
+    def compact_history(self, max_records:int|None=None, background:bool=False):
+        if not hasattr(self.store, "compact"):
+            return
+        self.flush()
+        if background:
+            self.store.compact_in_background(max_records=max_records)
+        else:
+            self.store.compact(max_records=max_records)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.store.close()
     
\ No newline at end of file
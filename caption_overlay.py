@@ -2,56 +2,68 @@ import os
 import cv2 
 import numpy as np 
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 from typing import Tuple
 
+from telemetry import timed
+from text_layout import cv2_measurer, cv2_text_size, load_font, pil_measurer, pil_text_bbox, pil_text_height
+
+COLOR_ORDERS = ("BGR", "RGB")
+
+# Images are accepted as PIL (always RGB) or as NumPy arrays in a declared colour order
+CaptionImage = np.ndarray | Image.Image
+
+
+def _check_color_order(color_order:str):
+    if color_order not in COLOR_ORDERS:
+        raise ValueError(f"color_order must be one of {COLOR_ORDERS}, got {color_order!r}")
+
+
+def _prepare_target(image:CaptionImage, in_place:bool)->CaptionImage:
+    # The only full-frame copy on the overlay path, and only when the caller needs the input intact
+    if isinstance(image, Image.Image):
+        if image.mode != "RGB":
+            return image.convert("RGB")
+        return image if in_place else image.copy()
+    return image if in_place else image.copy()
+
+
+def _image_size(image:CaptionImage)->Tuple[int, int]:
+    if isinstance(image, Image.Image):
+        return image.size
+    return image.shape[1], image.shape[0]
+
+
+def _band_rows(start:int, end:int, height:int)->Tuple[int, int]:
+    return max(0, start), min(height, end)
+
+
 class ImageCaptionOverlay:
     @staticmethod
-    def add_caption_overlay(image: np.ndarray, caption:str, position:str="bottom",
-    font_size:int=1, thickness: int=2, font_path:str|None=None)-> np.ndarray:
-        img_copy = image.copy()
-        height, width = img_copy.shape[:2]
+    @timed("render")
+    def add_caption_overlay(image: CaptionImage, caption:str, position:str="bottom",
+    font_size:int=1, thickness: int=2, font_path:str|None=None, color_order:str="BGR",
+    in_place:bool=False)-> CaptionImage:
+        """Draw the caption over the image.
+
+        PIL input returns PIL; NumPy input returns NumPy in the same `color_order`. Only the
+        horizontal band holding the caption is converted between PIL and NumPy, and with
+        `in_place=True` the input itself is drawn on.
+        """
+        _check_color_order(color_order)
+        img_copy = _prepare_target(image, in_place)
+        width, height = _image_size(img_copy)
 
         # If custom font is provided, use PIL for rendering
         if font_path and os.path.exists(font_path):
-            # Convert to PIL for custom font rendering
-            pil_image = Image.fromarray(cv2.cvtColor(img_copy, cv2.COLOR_BGR2RGB))
-            draw = ImageDraw.Draw(pil_image)
-
-            try:
-                # Scale font_size appropriately (convert from CV2 scale to pixel size)
-                pil_font_size = int(font_size * 20)
-                pil_font = ImageFont.truetype(font_path, pil_font_size)
-            except Exception:
-                pil_font = ImageFont.load_default()
+            # Scale font_size appropriately (convert from CV2 scale to pixel size)
+            pil_font_size = int(font_size * 20)
+            pil_font = load_font(font_path, pil_font_size)
 
             # Calculate text dimensions and wrap if needed
             max_width = width - 40
-            bbox = draw.textbbox((0, 0), caption, font=pil_font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-
-            if text_width > max_width:
-                words = caption.split()
-                lines = []
-                current_line = ""
-
-                for word in words:
-                    test_line = current_line + " " + word if current_line else word
-                    test_bbox = draw.textbbox((0, 0), test_line, font=pil_font)
-                    test_width = test_bbox[2] - test_bbox[0]
-
-                    if test_width <= max_width:
-                        current_line = test_line
-                    else:
-                        if current_line:
-                            lines.append(current_line)
-                        current_line = word
-
-                if current_line:
-                    lines.append(current_line)
-            else:
-                lines = [caption]
+            lines = pil_measurer(pil_font).wrap(caption, max_width)
+            text_height = pil_text_height(pil_font, caption, lines)
 
             # Calculate positions
             line_height = text_height + 10
@@ -64,13 +76,22 @@ class ImageCaptionOverlay:
             else:  # Center
                 start_y = (height - total_height) // 2
 
+            # Only the rows the caption can touch are converted for PIL drawing
+            if isinstance(img_copy, Image.Image):
+                band_top, region = 0, img_copy
+            else:
+                band_top, band_bottom = _band_rows(start_y - pil_font_size - 5, start_y + total_height + pil_font_size, height)
+                band = img_copy[band_top:band_bottom]
+                region = Image.fromarray(cv2.cvtColor(band, cv2.COLOR_BGR2RGB) if color_order == "BGR" else band)
+            draw = ImageDraw.Draw(region)
+
             # Draw text with background
             for i, line in enumerate(lines):
-                bbox = draw.textbbox((0, 0), line, font=pil_font)
+                bbox = pil_text_bbox(pil_font, line)
                 line_width = bbox[2] - bbox[0]
                 line_height_actual = bbox[3] - bbox[1]
                 text_x = (width - line_width) // 2
-                text_y = start_y + (i * line_height)
+                text_y = start_y + (i * line_height) - band_top
 
                 # Draw background rectangle
                 draw.rectangle(
@@ -81,41 +102,26 @@ class ImageCaptionOverlay:
                 # Draw text
                 draw.text((text_x, text_y), line, fill=(66, 140, 255), font=pil_font)
 
-            # Convert back to OpenCV format
-            return cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+            # Write the band back in the caller's colour order
+            if region is not img_copy and band.size:
+                if color_order == "BGR":
+                    cv2.cvtColor(np.asarray(region), cv2.COLOR_RGB2BGR, dst=band)
+                else:
+                    band[...] = np.asarray(region)
+            return img_copy
 
         else:
             # Use OpenCV's built-in font (original implementation)
             font = cv2.FONT_HERSHEY_SIMPLEX
-
-            # Calculate text size and position
-            text_size = cv2.getTextSize(caption, font, font_size, thickness)[0]
+            is_rgb = isinstance(img_copy, Image.Image) or color_order == "RGB"
+            text_color = (66, 140, 255) if is_rgb else (255, 140, 66)
 
             # Wrap the text if too long
             max_width = width - 40
-            if text_size[0] > max_width:
-                words = caption.split()
-                lines = []
-                current_line = ""
-
-                for word in words:
-                    test_line = current_line + " " + word if current_line else word
-                    test_size = cv2.getTextSize(test_line, font, font_size, thickness)[0]
-
-                    if test_size[0] <= max_width:
-                        current_line = test_line
-                    else:
-                        if current_line:
-                            lines.append(current_line)
-                        current_line = word
-
-                if current_line:
-                    lines.append(current_line)
-            else:
-                lines = [caption]
+            lines = cv2_measurer(font, font_size, thickness).wrap(caption, max_width)
 
             # Calculate Positions
-            line_height = cv2.getTextSize("A", font, font_size, thickness)[0][1] + 10
+            line_height = cv2_text_size("A", font, font_size, thickness)[1] + 10
             total_height = len(lines) * line_height
 
             if position.lower() == "bottom":
@@ -125,95 +131,89 @@ class ImageCaptionOverlay:
             else:  # Center
                 start_y = (height - total_height) // 2
 
+            # OpenCV draws on a NumPy view of just the caption rows
+            band_top, band_bottom = _band_rows(start_y - line_height - 2 * thickness,
+                start_y + total_height + line_height + 2 * thickness, height)
+            if isinstance(img_copy, Image.Image):
+                band = np.array(img_copy.crop((0, band_top, width, band_bottom)))
+            else:
+                band = img_copy[band_top:band_bottom]
+
             # Add background rectangle for better readability
             for i, line in enumerate(lines):
-                text_size = cv2.getTextSize(line, font, font_size, thickness)[0]
+                text_size = cv2_text_size(line, font, font_size, thickness)
                 text_x = (width - text_size[0]) // 2
-                text_y = start_y + (i * line_height) + text_size[1]
+                text_y = start_y + (i * line_height) + text_size[1] - band_top
 
                 # Background Rectangle
                 cv2.rectangle(
-                    img_copy, (text_x - 10, text_y - text_size[1] - 5),
+                    band, (text_x - 10, text_y - text_size[1] - 5),
                     (text_x + text_size[0] + 10, text_y + 5),
                     (0, 0, 0), -1
                 )
 
                 # Text
-                cv2.putText(img_copy, line, (text_x, text_y), font, font_size, (255, 140, 66), thickness)
+                cv2.putText(band, line, (text_x, text_y), font, font_size, text_color, thickness)
 
+            if isinstance(img_copy, Image.Image) and band.size:
+                img_copy.paste(Image.fromarray(band), (0, band_top))
             return img_copy
     
     @staticmethod
-    def add_caption_background(image:np.ndarray, caption:str, font_path:str|None=None, font_size:int=24,
-    background_color: Tuple=(33, 34, 69), text_color: Tuple=(183, 212, 225), margin:int=50)->np.ndarray:
-        height, width = image.shape[:2]
-
-        # Use PIL for better text rendering 
-        pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    @timed("render")
+    def add_caption_background(image:CaptionImage, caption:str, font_path:str|None=None, font_size:int=24,
+    background_color: Tuple=(33, 34, 69), text_color: Tuple=(183, 212, 225), margin:int=50,
+    color_order:str="BGR")->CaptionImage:
+        """Place the caption on a band above the image; colours are RGB tuples.
+
+        PIL input returns PIL; NumPy input returns NumPy in the same `color_order`. The text
+        band is rendered on its own and the image is copied into the output exactly once.
+        """
+        _check_color_order(color_order)
+        width, height = _image_size(image)
 
         # Try to use custom font or default
-        try:
-            if font_path and os.path.exists(font_path):
-                font = ImageFont.truetype(font_path, font_size)
-            elif os.path.exists("fonts/Poppins-Regular.ttf"):
-                font = ImageFont.truetype("fonts/Poppins-Regular.ttf", font_size)
-            else:
-                # Fallback to default font
-                font = ImageFont.load_default()
-        except Exception:
-            font = ImageFont.load_default()
-
-        # Calculate text dimensions 
-        draw = ImageDraw.Draw(pil_image)
-        bbox = draw.textbbox((0, 0), caption, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-
-        # Wrap text if necessary 
-        max_width = width - (2 * margin)
-        if text_width > max_width:
-            words = caption.split()
-            lines = []
-            current_line = ""
-
-            for word in words:
-                test_line = current_line + " " + word if current_line else word 
-                test_bbox = draw.textbbox((0, 0), test_line, font=font)
-                test_width = test_bbox[2] - test_bbox[0]
-
-                if test_width <= max_width:
-                    current_line = test_line
-                else:
-                    if current_line:
-                        lines.append(current_line)
-                    current_line = word
-
-            if current_line:
-                lines.append(current_line)
+        if font_path and os.path.exists(font_path):
+            font = load_font(font_path, font_size)
+        elif os.path.exists("fonts/Poppins-Regular.ttf"):
+            font = load_font("fonts/Poppins-Regular.ttf", font_size)
         else:
-            lines = [caption]
+            # Fallback to default font
+            font = load_font(None, font_size)
+
+        # Wrap text if necessary and calculate text dimensions 
+        max_width = width - (2 * margin)
+        lines = pil_measurer(font).wrap(caption, max_width)
+        text_height = pil_text_height(font, caption, lines)
 
         # Calculate total text height 
         total_text_height = len(lines) * text_height + (len(lines) - 1) * 10
+        band_height = int(total_text_height + (2 * margin))
 
-        # Create new image with space for text 
-        new_height = height + total_text_height + (2 * margin)
-        new_image = Image.new("RGB", (width, new_height), background_color)
-
-        # Paste original image 
-        new_image.paste(pil_image, (0, int(total_text_height + (2 * margin))))
+        # Use PIL for better text rendering, on the text band only
+        band = Image.new("RGB", (width, band_height), background_color)
 
         # Add Text
-        draw = ImageDraw.Draw(new_image)
+        draw = ImageDraw.Draw(band)
         y_offset = margin
 
         for line in lines:
-            bbox = draw.textbbox((0, 0), line, font=font)
+            bbox = pil_text_bbox(font, line)
             line_width = bbox[2] - bbox[0]
             x_position = (width - line_width)//2
 
             draw.text((x_position, y_offset), line, fill=text_color, font=font)
             y_offset += text_height + 10
 
-        # Convert back to OpenCV format 
-        return cv2.cvtColor(np.array(new_image), cv2.COLOR_RGB2BGR)
\ No newline at end of file
+        if isinstance(image, Image.Image):
+            # Create new image with space for text and paste the original below it
+            new_image = Image.new("RGB", (width, height + band_height))
+            new_image.paste(band, (0, 0))
+            new_image.paste(image if image.mode == "RGB" else image.convert("RGB"), (0, band_height))
+            return new_image
+
+        new_image = np.empty((height + band_height, width, 3), dtype=image.dtype)
+        band_array = np.asarray(band)
+        new_image[:band_height] = band_array[..., ::-1] if color_order == "BGR" else band_array
+        new_image[band_height:] = image
+        return new_image
@@ -0,0 +1,330 @@
+import os
+import sys
+import glob
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from caption_generation import CAPTION_PROMPT, CaptionResult, MultiModalCaptionGenerator
+from caption_history import CaptionHistory
+from caption_overlay import ImageCaptionOverlay
+from image_ingest import IngestedImage
+from image_preprocessing import PreparedImage
+from provider_registry import default_model, get_provider
+from provider_router import ProviderRouter
+from render_cache import DOWNLOAD_FORMATS, encode_image
+from telemetry import in_context
+
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers with the same key share its result"""
+
+    def __init__(self) -> None:
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key:Tuple, fn:Callable[[], Awaitable])->Tuple[object, bool]:
+        """Returns (result, shared) where shared is True for callers that joined an existing call"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # Shielded so one caller disconnecting doesn't cancel the call for everyone else
+            return await asyncio.shield(future), True
+
+        self.calls += 1
+        future = asyncio.ensure_future(fn())
+        self._inflight[key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future), False
+
+
+FONTS_DIR = "fonts"
+
+
+def available_fonts()->Dict[str, str]:
+    """Font name to path for the TrueType fonts in the fonts folder, the only ones clients may pick"""
+    paths = glob.glob(os.path.join(FONTS_DIR, "*.ttf")) + glob.glob(os.path.join(FONTS_DIR, "*.TTF"))
+    return {os.path.splitext(os.path.basename(path))[0]: path for path in paths}
+
+
+def _number(query, name:str, default:float, cast:Callable=int, minimum:float|None=None,
+maximum:float|None=None, clamp:bool=False):
+    """A numeric query parameter; malformed values are a 400, out-of-range ones a 400 or clamped"""
+    if name not in query:
+        return default
+    try:
+        value = cast(query[name])
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"'{name}' must be a number")
+    # Written so NaN fails the range check too
+    if minimum is not None and not value >= minimum:
+        if not clamp or value != value:
+            raise web.HTTPBadRequest(text=f"'{name}' must be at least {minimum}")
+        value = cast(minimum)
+    if maximum is not None and not value <= maximum:
+        if not clamp:
+            raise web.HTTPBadRequest(text=f"'{name}' must be at most {maximum}")
+        value = cast(maximum)
+    return value
+
+
+def _flag(value:str|None, default:bool|None=None)->bool|None:
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+class CaptionService:
+    """Async HTTP front end for the caption generator, the overlay renderer and the history.
+
+    Decoding and rendering run on a bounded thread pool so they never block the event loop,
+    and identical in-flight caption requests (same image, provider, model and prompt) are
+    coalesced into one upstream call.
+    """
+
+    def __init__(self, generator:MultiModalCaptionGenerator, history:CaptionHistory|None=None,
+    render_workers:int=4, timeout:float=60.0, max_upload_bytes:int=25 * 1024 * 1024) -> None:
+        self.generator = generator
+        self.history = history
+        self.router = ProviderRouter(generator)
+        self.timeout = timeout
+        self.max_upload_bytes = max_upload_bytes
+        self.render_pool = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix="render")
+        self.single_flight = SingleFlight()
+        self.started = time.time()
+        self.requests = 0
+
+    async def _in_pool(self, fn:Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.render_pool, in_context(fn, *args))
+
+    def _decode(self, data:bytes)->Tuple[PreparedImage, IngestedImage]:
+        # Captions use the working resolution; full resolution is only decoded to render
+        ingested = IngestedImage(data)
+        prepared = self.generator.prepare_image(ingested.working)
+        # Decode and hash here, so it happens on the pool rather than on the event loop
+        _ = prepared.fingerprint
+        return prepared, ingested
+
+    async def _read_image(self, request:web.Request)->Tuple[PreparedImage, IngestedImage, str]:
+        """Accepts a multipart form with an `image` field, or the raw image as the body"""
+        name = request.query.get("image_name", "upload")
+        if request.content_type.startswith("multipart/"):
+            data = None
+            async for part in (await request.multipart()):
+                if part.name == "image":
+                    name = part.filename or name
+                    data = await part.read(decode=False)
+                    break
+            if data is None:
+                raise web.HTTPBadRequest(text="Missing multipart field 'image'")
+        else:
+            data = await request.read()
+        if not data:
+            raise web.HTTPBadRequest(text="Empty image")
+
+        try:
+            prepared, ingested = await self._in_pool(self._decode, data)
+            return prepared, ingested, name
+        except Exception as e:
+            raise web.HTTPBadRequest(text=f"Could not decode image: {e}")
+
+    async def _caption(self, prepared:PreparedImage, image_name:str, provider:str, model:str|None,
+    use_cache:bool|None)->Tuple[CaptionResult, bool]:
+        model = model or (default_model(provider) if provider != "auto" else "")
+
+        async def call()->CaptionResult:
+            if provider == "auto":
+                result = await self.router.aroute(prepared, use_cache=use_cache)
+            else:
+                result = await self.generator.agenerate_caption(
+                    prepared, provider, model=model, use_cache=use_cache, timeout=self.timeout
+                )
+            # Only the call that went upstream records the interaction
+            if result.ok and self.history is not None:
+                self.history.add_interaction(image_name, result.model or result.provider, result.caption,
+                    content_hash=prepared.fingerprint, perceptual_hash=prepared.perceptual_hash)
+            return result
+
+        key = (prepared.fingerprint, provider, model, CAPTION_PROMPT, use_cache)
+        return await self.single_flight.do(key, call)
+
+    def _provider(self, query)->str:
+        """Unknown providers are the client's mistake, not an upstream failure"""
+        provider = query.get("provider", "auto")
+        if provider != "auto":
+            try:
+                get_provider(provider)
+            except ValueError as e:
+                raise web.HTTPBadRequest(text=str(e))
+        return provider
+
+    async def handle_caption(self, request:web.Request)->web.Response:
+        self.requests += 1
+        provider = self._provider(request.query)
+        with self.generator.tracer.trace("POST /caption", provider=provider) as trace:
+            prepared, ingested, image_name = await self._read_image(request)
+            result, shared = await self._caption(prepared, image_name, provider, request.query.get("model"),
+                _flag(request.query.get("use_cache")))
+            trace.attributes["coalesced"] = shared
+        return web.json_response({
+            "caption": result.caption,
+            "error": result.error,
+            "provider": result.provider,
+            "model": result.model,
+            "elapsed": round(result.elapsed, 4),
+            "coalesced": shared,
+            "image_hash": prepared.fingerprint,
+            "trace_id": trace.trace_id
+        }, status=200 if result.ok else 502)
+
+    def _render_options(self, query)->Dict:
+        """Checked before captioning, so a bad render query never costs a provider call"""
+        if "font_path" in query:
+            raise web.HTTPBadRequest(text="Pick a font by name with 'font'; paths are not accepted")
+        font_path = None
+        if "font" in query:
+            font_path = available_fonts().get(query["font"])
+            if font_path is None:
+                raise web.HTTPBadRequest(text=f"Unknown font: {query['font']}")
+
+        formats = {name.upper(): name for name in DOWNLOAD_FORMATS}
+        options = {
+            "format": formats.get(query.get("format", "PNG").upper(), "PNG"),
+            "method": query.get("method", "overlay"),
+            "font_path": font_path,
+            "quality": _number(query, "quality", 90, minimum=1, maximum=100)
+        }
+        if options["method"] == "background":
+            options["font_size"] = _number(query, "font_size", 24, minimum=1, maximum=500)
+            options["margin"] = _number(query, "margin", 50, minimum=0, maximum=2000)
+        else:
+            options["position"] = query.get("position", "bottom")
+            options["font_size"] = _number(query, "font_size", 1.0, cast=float, minimum=0.1, maximum=25.0)
+            options["thickness"] = _number(query, "thickness", 2, minimum=1, maximum=50)
+        return options
+
+    def _render(self, ingested:IngestedImage, caption:str, options:Dict)->Tuple[bytes, str]:
+        image = ingested.full()
+        if options["method"] == "background":
+            rendered = ImageCaptionOverlay.add_caption_background(
+                image, caption, font_path=options["font_path"],
+                font_size=options["font_size"], margin=options["margin"]
+            )
+        else:
+            rendered = ImageCaptionOverlay.add_caption_overlay(
+                image, caption, position=options["position"],
+                font_size=options["font_size"], thickness=options["thickness"],
+                font_path=options["font_path"]
+            )
+        return encode_image(rendered, options["format"], options["quality"]), DOWNLOAD_FORMATS[options["format"]][2]
+
+    async def handle_caption_render(self, request:web.Request)->web.Response:
+        self.requests += 1
+        provider = self._provider(request.query)
+        options = self._render_options(request.query)
+        with self.generator.tracer.trace("POST /caption/render", provider=provider) as trace:
+            prepared, ingested, image_name = await self._read_image(request)
+            result, shared = await self._caption(prepared, image_name, provider, request.query.get("model"),
+                _flag(request.query.get("use_cache")))
+            trace.attributes["coalesced"] = shared
+            if not result.ok:
+                return web.json_response({"error": result.error, "provider": result.provider}, status=502)
+
+            body, mime_type = await self._in_pool(self._render, ingested, result.caption, options)
+        # Header values must be latin-1; the JSON endpoint has the exact caption
+        caption_header = result.caption.encode("latin-1", "replace").decode("latin-1").replace("\n", " ")
+        return web.Response(body=body, content_type=mime_type, headers={
+            "X-Caption": caption_header,
+            "X-Caption-Provider": result.provider,
+            "X-Caption-Model": result.model,
+            "X-Caption-Coalesced": str(shared).lower(),
+            "X-Trace-Id": trace.trace_id
+        })
+
+    async def handle_history(self, request:web.Request)->web.Response:
+        if self.history is None:
+            return web.json_response([])
+        query = request.query
+        limit = _number(query, "limit", 100, minimum=1, maximum=10_000, clamp=True)
+        offset = _number(query, "offset", 0, minimum=0)
+        records = await asyncio.get_running_loop().run_in_executor(None, lambda: self.history.query_history(
+            model=query.get("model"), image_name=query.get("image_name"), since=query.get("since"),
+            until=query.get("until"), limit=limit, offset=offset,
+            newest_first=_flag(query.get("newest_first"), True)
+        ))
+        return web.json_response(records)
+
+    async def handle_stats(self, request:web.Request)->web.Response:
+        return web.json_response({
+            "uptime": round(time.time() - self.started, 1),
+            "requests": self.requests,
+            "upstream_calls": self.single_flight.calls,
+            "coalesced": self.single_flight.coalesced,
+            "providers": self.generator.configured_providers(),
+            "router": self.router.snapshot(),
+            "cache": self.generator.cache_stats()
+        })
+
+    async def handle_metrics(self, request:web.Request)->web.Response:
+        return web.Response(text=self.generator.metrics.render_prometheus(),
+            content_type="text/plain", headers={"X-Prometheus-Format": "0.0.4"})
+
+    async def handle_traces(self, request:web.Request)->web.Response:
+        limit = _number(request.query, "limit", 20, minimum=1, maximum=1000, clamp=True)
+        return web.json_response(self.generator.tracer.recent(limit))
+
+    async def handle_health(self, request:web.Request)->web.Response:
+        return web.json_response({"status": "ok"})
+
+    def create_app(self)->web.Application:
+        app = web.Application(client_max_size=self.max_upload_bytes)
+        app.add_routes([
+            web.post("/caption", self.handle_caption),
+            web.post("/caption/render", self.handle_caption_render),
+            web.get("/history", self.handle_history),
+            web.get("/stats", self.handle_stats),
+            web.get("/metrics", self.handle_metrics),
+            web.get("/traces", self.handle_traces),
+            web.get("/health", self.handle_health)
+        ])
+        app.on_cleanup.append(self._cleanup)
+        return app
+
+    async def _cleanup(self, app:web.Application):
+        self.render_pool.shutdown(wait=False)
+        if self.history is not None:
+            self.history.flush()
+
+
+def main(argv:List[str]|None=None)->int:
+    parser = argparse.ArgumentParser(description="Serve captioning, rendering and history over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--render-workers", type=int, default=4)
+    parser.add_argument("--storage", default="sqlite", choices=["json", "jsonl", "sqlite"])
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    generator = MultiModalCaptionGenerator()
+    generator.configure_apis(
+        openai_key=os.getenv("OPENAI_API_ICG"),
+        groq_key=os.getenv("GROQ_API_ICG"),
+        gemini_key=os.getenv("GEMINI_API_ICG")
+    )
+    history = CaptionHistory(use_file_history=False, storage=args.storage)
+
+    service = CaptionService(generator, history, render_workers=args.render_workers, timeout=args.timeout)
+    web.run_app(service.create_app(), host=args.host, port=args.port)
+    history.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,439 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+class HistoryStore:
+    """Storage engine for caption history metadata records"""
+
+    path: str
+
+    def append(self, record:Dict):
+        raise NotImplementedError
+
+    def read_all(self)->List[Dict]:
+        raise NotImplementedError
+
+    def recent(self, n:int)->List[Dict]:
+        history = self.read_all()
+        return history[-n:] if len(history) > n else history
+
+    def search(self, field:str, value:str)->List[Dict]:
+        return [item for item in self.read_all() if item.get(field, None) == value]
+
+    def append_many(self, records:Iterable[Dict]):
+        for record in records:
+            self.append(record)
+
+    def _filtered(self, model:str|None=None, image_name:str|None=None, since:str|None=None,
+    until:str|None=None)->List[Dict]:
+        return [
+            item for item in self.read_all()
+            if (model is None or item.get("model") == model)
+            and (image_name is None or item.get("image_name") == image_name)
+            and (since is None or item.get("timestamp", "") >= since)
+            and (until is None or item.get("timestamp", "") < until)
+        ]
+
+    def query(self, model:str|None=None, image_name:str|None=None, since:str|None=None, until:str|None=None,
+    limit:int|None=None, offset:int=0, newest_first:bool=False)->List[Dict]:
+        items = self._filtered(model, image_name, since, until)
+        if newest_first:
+            items.reverse()
+        return items[offset:offset + limit] if limit is not None else items[offset:]
+
+    def count(self, model:str|None=None, image_name:str|None=None, since:str|None=None,
+    until:str|None=None)->int:
+        return len(self._filtered(model, image_name, since, until))
+
+    def model_counts(self)->Dict[str, Dict]:
+        summary: Dict[str, Dict] = {}
+        for item in self.read_all():
+            entry = summary.setdefault(item.get("model"), {"count": 0, "first": None, "last": None})
+            entry["count"] += 1
+            timestamp = item.get("timestamp")
+            if timestamp and (entry["first"] is None or timestamp < entry["first"]):
+                entry["first"] = timestamp
+            if timestamp and (entry["last"] is None or timestamp > entry["last"]):
+                entry["last"] = timestamp
+        return summary
+
+    def clear(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonArrayStore(HistoryStore):
+    """The original format: one JSON array rewritten on every append"""
+
+    def __init__(self, path:str="caption_metadata.json") -> None:
+        self.path = path
+
+    def append(self, record:Dict):
+        self.append_many([record])
+
+    def append_many(self, records:Iterable[Dict]):
+        history = self.read_all()
+        history.extend(records)
+
+        with open(self.path, mode="w") as f:
+            json.dump(history, f, indent=2)
+
+    def read_all(self)->List[Dict]:
+        try:
+            with open(self.path, mode="r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class JsonLinesStore(HistoryStore):
+    """Append-only JSON-lines log: each record costs one appended line instead of a full rewrite"""
+
+    def __init__(self, path:str="caption_metadata.jsonl", fsync:str="interval", fsync_interval:float=1.0,
+    legacy_path:str|None="caption_metadata.json") -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, got {fsync!r}")
+
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._handle = None
+        self._last_fsync = time.monotonic()
+        self._compaction_thread: threading.Thread|None = None
+
+        if legacy_path:
+            self.migrate_from_json_array(legacy_path)
+
+    def migrate_from_json_array(self, legacy_path:str)->int:
+        """One-time import of the old JSON array file, which is kept as a .migrated backup"""
+        if os.path.exists(self.path) or not os.path.exists(legacy_path):
+            return 0
+
+        records = JsonArrayStore(legacy_path).read_all()
+        self._rewrite(records)
+        os.replace(legacy_path, f"{legacy_path}.migrated")
+        return len(records)
+
+    def _open(self):
+        if self._handle is None:
+            needs_newline = False
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, mode="rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    needs_newline = f.read(1) != b"\n"
+
+            self._handle = open(self.path, mode="a", encoding="utf-8")
+            if needs_newline:
+                # Terminate a torn line so the next record doesn't get glued onto it
+                self._handle.write("\n")
+        return self._handle
+
+    def append(self, record:Dict):
+        self.append_many([record])
+
+    def append_many(self, records:Iterable[Dict]):
+        lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        with self._lock:
+            handle = self._open()
+            handle.write(lines)
+            handle.flush()
+
+            if self.fsync == "always" or (
+                self.fsync == "interval" and time.monotonic() - self._last_fsync >= self.fsync_interval
+            ):
+                os.fsync(handle.fileno())
+                self._last_fsync = time.monotonic()
+
+    def _iter_records(self)->Iterator[Dict]:
+        try:
+            with open(self.path, mode="r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash mid-append leaves at most one torn line; skip it
+                        continue
+        except FileNotFoundError:
+            return
+
+    def read_all(self)->List[Dict]:
+        return list(self._iter_records())
+
+    def search(self, field:str, value:str)->List[Dict]:
+        return [item for item in self._iter_records() if item.get(field, None) == value]
+
+    def recent(self, n:int)->List[Dict]:
+        # Read backwards from the end of the file so the cost depends on n, not on the history size
+        try:
+            f = open(self.path, mode="rb")
+        except FileNotFoundError:
+            return []
+
+        with f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            buffer = b""
+            block_size = 64 * 1024
+            while position > 0 and buffer.count(b"\n") <= n:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                buffer = f.read(read_size) + buffer
+
+        records = []
+        for line in buffer.splitlines()[-(n + 1):]:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        return records[-n:] if n > 0 else []
+
+    def _rewrite(self, records:List[Dict]):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, mode="w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def compact(self, max_records:int|None=None)->int:
+        """Rewrite the log without torn lines, optionally keeping only the newest max_records"""
+        with self._lock:
+            records = list(self._iter_records())
+            if max_records is not None:
+                records = records[-max_records:]
+
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+            self._rewrite(records)
+            return len(records)
+
+    def compact_in_background(self, max_records:int|None=None)->threading.Thread:
+        if self._compaction_thread is None or not self._compaction_thread.is_alive():
+            self._compaction_thread = threading.Thread(
+                target=self.compact, kwargs={"max_records": max_records}, daemon=True
+            )
+            self._compaction_thread.start()
+        return self._compaction_thread
+
+    def clear(self):
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def close(self):
+        with self._lock:
+            if self._handle is not None:
+                self._handle.flush()
+                os.fsync(self._handle.fileno())
+                self._handle.close()
+                self._handle = None
+
+
+class SQLiteStore(HistoryStore):
+    """Indexed SQLite storage in WAL mode, so the UI can read while a batch job writes"""
+
+    COLUMNS = ("timestamp", "image_name", "model", "caption", "content_hash")
+
+    def __init__(self, path:str="caption_history.db",
+    legacy_path:str|Tuple[str, ...]|None=("caption_metadata.jsonl", "caption_metadata.json")) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._init_schema()
+
+        # Several candidates are tried in order, so a checkout that only has the original array file migrates too
+        for candidate in ((legacy_path,) if isinstance(legacy_path, str) else legacy_path or ()):
+            if os.path.exists(candidate):
+                self.migrate_from(candidate)
+                break
+
+    @property
+    def _conn(self)->sqlite3.Connection:
+        # sqlite3 connections are not shareable across threads, so each thread gets its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        with self._conn as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS interactions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT NOT NULL,
+                    image_name TEXT,
+                    model TEXT,
+                    caption TEXT,
+                    content_hash TEXT,
+                    extra TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_interactions_model ON interactions (model, id);
+                CREATE INDEX IF NOT EXISTS idx_interactions_image ON interactions (image_name, id);
+                CREATE INDEX IF NOT EXISTS idx_interactions_timestamp ON interactions (timestamp);
+                CREATE INDEX IF NOT EXISTS idx_interactions_hash ON interactions (content_hash);
+
+                -- Per-model aggregates kept current by triggers so counts don't scan the index
+                CREATE TABLE IF NOT EXISTS model_stats (
+                    model TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL,
+                    first TEXT,
+                    last TEXT
+                );
+                CREATE TRIGGER IF NOT EXISTS trg_interactions_insert AFTER INSERT ON interactions
+                BEGIN
+                    INSERT INTO model_stats (model, count, first, last)
+                    VALUES (COALESCE(NEW.model, ''), 1, NEW.timestamp, NEW.timestamp)
+                    ON CONFLICT(model) DO UPDATE SET
+                        count = count + 1,
+                        first = MIN(first, NEW.timestamp),
+                        last = MAX(last, NEW.timestamp);
+                END;
+                CREATE TRIGGER IF NOT EXISTS trg_interactions_delete AFTER DELETE ON interactions
+                BEGIN
+                    UPDATE model_stats SET count = count - 1 WHERE model = COALESCE(OLD.model, '');
+                END;
+            """)
+
+    def migrate_from(self, legacy_path:str)->int:
+        """One-time import of a JSON array or JSON-lines history into an empty database"""
+        if not os.path.exists(legacy_path) or self.count() > 0:
+            return 0
+
+        if legacy_path.endswith(".jsonl"):
+            legacy = JsonLinesStore(legacy_path, legacy_path=None)
+        else:
+            legacy = JsonArrayStore(legacy_path)
+        records = legacy.read_all()
+        self.append_many(records)
+        return len(records)
+
+    def _row_values(self, record:Dict)->tuple:
+        extra = {key: value for key, value in record.items() if key not in self.COLUMNS}
+        return (
+            record.get("timestamp", ""),
+            record.get("image_name"),
+            record.get("model"),
+            record.get("caption"),
+            record.get("content_hash"),
+            json.dumps(extra) if extra else None
+        )
+
+    def _row_to_record(self, row:sqlite3.Row)->Dict:
+        record = {
+            "timestamp": row["timestamp"],
+            "image_name": row["image_name"],
+            "model": row["model"],
+            "caption": row["caption"]
+        }
+        if row["content_hash"] is not None:
+            record["content_hash"] = row["content_hash"]
+        if row["extra"]:
+            record.update(json.loads(row["extra"]))
+        return record
+
+    def append(self, record:Dict):
+        self.append_many([record])
+
+    def append_many(self, records:Iterable[Dict]):
+        with self._conn as conn:
+            conn.executemany(
+                "INSERT INTO interactions (timestamp, image_name, model, caption, content_hash, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self._row_values(record) for record in records)
+            )
+
+    def _where(self, model:str|None=None, image_name:str|None=None, since:str|None=None,
+    until:str|None=None, content_hash:str|None=None)->tuple:
+        clauses, params = [], []
+        for column, value in (("model", model), ("image_name", image_name), ("content_hash", content_hash)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def query(self, model:str|None=None, image_name:str|None=None, since:str|None=None, until:str|None=None,
+    limit:int|None=None, offset:int=0, newest_first:bool=False, content_hash:str|None=None)->List[Dict]:
+        where, params = self._where(model, image_name, since, until, content_hash)
+        order = "DESC" if newest_first else "ASC"
+        sql = f"SELECT * FROM interactions{where} ORDER BY id {order} LIMIT ? OFFSET ?"
+        params += [limit if limit is not None else -1, offset]
+        return [self._row_to_record(row) for row in self._conn.execute(sql, params)]
+
+    def count(self, model:str|None=None, image_name:str|None=None, since:str|None=None,
+    until:str|None=None)->int:
+        if image_name is None and since is None and until is None:
+            if model is None:
+                row = self._conn.execute("SELECT COALESCE(SUM(count), 0) FROM model_stats").fetchone()
+            else:
+                row = self._conn.execute("SELECT count FROM model_stats WHERE model = ?", (model,)).fetchone()
+            return row[0] if row else 0
+
+        where, params = self._where(model, image_name, since, until)
+        return self._conn.execute(f"SELECT COUNT(*) FROM interactions{where}", params).fetchone()[0]
+
+    def model_counts(self)->Dict[str, Dict]:
+        rows = self._conn.execute("SELECT model, count, first, last FROM model_stats WHERE count > 0")
+        return {row["model"]: {"count": row["count"], "first": row["first"], "last": row["last"]} for row in rows}
+
+    def read_all(self)->List[Dict]:
+        return self.query()
+
+    def recent(self, n:int)->List[Dict]:
+        records = self.query(limit=n, newest_first=True)
+        records.reverse()
+        return records
+
+    def search(self, field:str, value:str)->List[Dict]:
+        if field not in ("model", "image_name", "content_hash"):
+            return super().search(field, value)
+        return self.query(**{field: value})
+
+    def clear(self):
+        with self._conn as conn:
+            conn.execute("DELETE FROM interactions")
+            conn.execute("DELETE FROM model_stats")
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def create_store(storage:str="jsonl", **kwargs)->HistoryStore:
+    stores = {
+        "json": JsonArrayStore,
+        "jsonl": JsonLinesStore,
+        "sqlite": SQLiteStore
+    }
+    if storage not in stores:
+        raise ValueError(f"Unknown history storage: {storage}")
+    return stores[storage](**kwargs)
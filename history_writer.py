@@ -0,0 +1,143 @@
+import os
+import json
+import weakref
+import threading
+from typing import Callable, Dict, List
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, messages_to_dict
+
+from history_storage import HistoryStore
+
+
+class _Pending:
+    def __init__(self) -> None:
+        self.messages: List[BaseMessage] = []
+        self.records: List[Dict] = []
+
+
+def _write_messages(chat_history:BaseChatMessageHistory, messages:List[BaseMessage]):
+    from langchain_community.chat_message_histories import FileChatMessageHistory
+
+    if isinstance(chat_history, FileChatMessageHistory):
+        # One read and one atomic rewrite per group instead of one per message
+        existing = chat_history.messages if chat_history.file_path.exists() else []
+        items = messages_to_dict(existing) + messages_to_dict(messages)
+        tmp_path = f"{chat_history.file_path}.tmp"
+        with open(tmp_path, mode="w", encoding=chat_history.encoding) as f:
+            f.write(json.dumps(items, ensure_ascii=chat_history.ensure_ascii))
+        os.replace(tmp_path, chat_history.file_path)
+    else:
+        chat_history.add_messages(messages)
+
+
+def _flush(lock:threading.RLock, pending:_Pending, store:HistoryStore,
+chat_history:BaseChatMessageHistory|None)->bool:
+    # The lock is held for the whole write so readers never see a record in neither place
+    with lock:
+        if not pending.messages and not pending.records:
+            return False
+        if pending.messages and chat_history is not None:
+            _write_messages(chat_history, pending.messages)
+        # Each buffer is cleared as soon as its write lands, so a retry only repeats the step that failed
+        pending.messages = []
+        if pending.records:
+            store.append_many(pending.records)
+        pending.records = []
+        return True
+
+
+def _run(writer_ref:weakref.ref, wake:threading.Event, interval:float):
+    # Holds the writer only weakly, so the thread ends once its owner (e.g. a dropped session) is collected
+    while True:
+        wake.wait(interval)
+        wake.clear()
+        writer = writer_ref()
+        if writer is None or writer._closed:
+            return
+        try:
+            writer.flush()
+        except Exception:
+            # Keep the records buffered and retry on the next tick
+            pass
+        del writer
+
+
+class BufferedHistoryWriter:
+    """Coalesces chat messages and metadata records into periodic group commits.
+
+    A flush happens once flush_every records are pending, every flush_interval seconds on a
+    background thread, on an explicit flush(), when the writer is garbage collected, and at
+    interpreter exit. The background thread stops with the writer.
+    """
+
+    def __init__(self, store:HistoryStore, chat_history:BaseChatMessageHistory|None=None,
+    flush_every:int=20, flush_interval:float|None=1.0) -> None:
+        self.store = store
+        self.chat_history = chat_history
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        self._lock = threading.RLock()
+        self._pending = _Pending()
+        self._wake = threading.Event()
+        self._closed = False
+        self.flushes = 0
+
+        # Flushes whatever is left when the writer is collected or the interpreter exits
+        self._finalizer = weakref.finalize(self, _flush, self._lock, self._pending, store, chat_history)
+
+        self._thread = None
+        if flush_interval:
+            self._thread = threading.Thread(target=_run, args=(weakref.ref(self), self._wake, flush_interval),
+                name="history-writer", daemon=True)
+            self._thread.start()
+
+    def add(self, record:Dict, messages:List[BaseMessage]|None=None):
+        with self._lock:
+            if messages:
+                self._pending.messages.extend(messages)
+            self._pending.records.append(record)
+            pending = len(self._pending.records)
+
+        if pending >= self.flush_every:
+            if self._thread is not None:
+                self._wake.set()
+            else:
+                self.flush()
+
+    @property
+    def pending_messages(self)->List[BaseMessage]:
+        with self._lock:
+            return list(self._pending.messages)
+
+    @property
+    def pending_records(self)->List[Dict]:
+        with self._lock:
+            return list(self._pending.records)
+
+    def read_with_pending(self, read:Callable[[], List], pending:str="records")->List:
+        """Run a read against the flushed data and append the matching pending items atomically"""
+        with self._lock:
+            flushed = read()
+            buffered = self._pending.messages if pending == "messages" else self._pending.records
+            return flushed + list(buffered)
+
+    def flush(self):
+        if _flush(self._lock, self._pending, self.store, self.chat_history):
+            self.flushes += 1
+
+    def discard(self):
+        with self._lock:
+            self._pending.messages = []
+            self._pending.records = []
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+        self._finalizer.detach()
@@ -0,0 +1,142 @@
+import io
+import math
+import time
+from typing import Dict, Tuple
+
+import cv2
+import numpy as np
+from PIL import ExifTags, Image
+
+from image_preprocessing import PROVIDER_MAX_EDGE
+from telemetry import span
+
+# Big enough for every provider's payload; the preview is smaller still
+WORKING_MAX_EDGE = max(PROVIDER_MAX_EDGE.values())
+
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90
+}
+
+CV2_REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2
+}
+
+
+def _open(source:bytes|str)->Image.Image:
+    return Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+
+
+def exif_orientation(image:Image.Image)->int:
+    try:
+        return int(image.getexif().get(ExifTags.Base.Orientation, 1))
+    except Exception:
+        return 1
+
+
+def decode_image(source:bytes|str, max_edge:int|None=None)->Image.Image:
+    """Decode with the EXIF orientation applied.
+
+    With `max_edge`, JPEGs are scaled by 1/2, 1/4 or 1/8 inside the decoder, to the smallest
+    of those still at least `max_edge` on the long side. Other formats decode in full.
+    """
+    image = _open(source)
+    orientation = exif_orientation(image)
+    if max_edge and image.format == "JPEG":
+        width, height = image.size
+        scale = max_edge / max(width, height)
+        if scale < 1:
+            image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+    image.load()
+
+    method = ORIENTATION_TRANSPOSE.get(orientation)
+    if method is not None:
+        image = image.transpose(method)
+        # The pixels are upright now; drop the tag so nothing downstream rotates them again
+        image.info.pop("exif", None)
+    return image
+
+
+def decode_image_cv2(source:bytes|str, max_edge:int|None=None)->np.ndarray:
+    """BGR decode through OpenCV, using its reduced JPEG modes when `max_edge` allows"""
+    flags = cv2.IMREAD_COLOR
+    if max_edge:
+        # Only the header is read here
+        with _open(source) as header:
+            fmt, size = header.format, header.size
+        if fmt == "JPEG":
+            for factor, reduced_flags in CV2_REDUCED_FLAGS.items():
+                if max(size) / factor >= max_edge:
+                    flags = reduced_flags
+                    break
+
+    if isinstance(source, bytes):
+        frame = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flags)
+    else:
+        frame = cv2.imread(source, flags)
+    if frame is None:
+        raise ValueError("Could not decode image")
+    return frame
+
+
+class IngestedImage:
+    """An upload decoded once at a working resolution; full resolution is decoded only on demand.
+
+    The working image is what captioning, hashing and previews use. `full()` decodes the
+    original size again for exports and doesn't keep it, so only the working copy stays in
+    memory between reruns.
+    """
+
+    def __init__(self, source:bytes|str, working_max_edge:int|None=WORKING_MAX_EDGE) -> None:
+        self.source = source
+        self.working_max_edge = working_max_edge
+        with _open(source) as header:
+            width, height = header.size
+            if exif_orientation(header) in (5, 6, 7, 8):
+                width, height = height, width
+            self.format = header.format
+        self.full_size: Tuple[int, int] = (width, height)
+        self._working: Image.Image|None = None
+        self.decode_seconds = 0.0
+        self.full_decodes = 0
+
+    @property
+    def working(self)->Image.Image:
+        if self._working is None:
+            start = time.perf_counter()
+            with span("ingest", format=self.format):
+                self._working = decode_image(self.source, self.working_max_edge)
+            self.decode_seconds = time.perf_counter() - start
+        return self._working
+
+    @property
+    def reduced(self)->bool:
+        return self.working.size != self.full_size
+
+    @property
+    def working_scale(self)->float:
+        """Working size relative to full size, for scaling pixel measurements like font sizes"""
+        return self.working.width / self.full_size[0]
+
+    def full(self)->Image.Image:
+        if not self.reduced:
+            return self.working
+        with span("ingest.full", format=self.format):
+            self.full_decodes += 1
+            return decode_image(self.source)
+
+    def report(self)->Dict:
+        return {
+            "format": self.format,
+            "full_size": self.full_size,
+            "working_size": self.working.size,
+            "decode_ms": self.decode_seconds * 1000,
+            "full_decodes": self.full_decodes
+        }
@@ -0,0 +1,186 @@
+import io
+import time
+import base64
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Tuple
+
+from PIL import Image
+
+from caption_cache import image_fingerprint
+from perceptual_hash import HASH_FUNCTIONS, hash_to_hex
+from telemetry import span
+
+# Long-edge limits beyond which each provider downsamples on its side anyway
+PROVIDER_MAX_EDGE = {
+    "openai": 2048,
+    "groq": 1536,
+    "gemini": 3072
+}
+
+FORMAT_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "PNG": "image/png"
+}
+
+
+@dataclass
+class PreprocessConfig:
+    format: str = "JPEG"
+    quality: int = 85
+    max_edge: Dict[str, int] = field(default_factory=lambda: dict(PROVIDER_MAX_EDGE))
+    default_max_edge: int = 2048
+
+    def max_edge_for(self, provider:str|None)->int:
+        return self.max_edge.get(provider, self.default_max_edge)
+
+    def cache_params(self, provider:str|None)->Dict:
+        return {"format": self.format, "quality": self.quality, "max_edge": self.max_edge_for(provider)}
+
+
+@dataclass
+class EncodedImage:
+    data: bytes
+    mime_type: str
+    size: Tuple[int, int]
+    encode_seconds: float
+    raw_bytes: int
+    _base64: str|None = None
+
+    @property
+    def base64(self)->str:
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.data).decode()
+        return self._base64
+
+    @property
+    def data_url(self)->str:
+        return f"data:{self.mime_type};base64,{self.base64}"
+
+    @property
+    def vs_raw_bytes(self)->int:
+        """Bytes under the uncompressed source pixels; not a saving over any earlier payload format"""
+        return self.raw_bytes - len(self.data)
+
+
+class PreparedImage:
+    """Decodes an image once and memoizes its fingerprint and every encoded payload"""
+
+    def __init__(self, image:Image.Image, config:PreprocessConfig|None=None) -> None:
+        self.source = image
+        self.config = config or PreprocessConfig()
+        self._rgb: Image.Image|None = None
+        self._fingerprint: str|None = None
+        self._perceptual_hashes: Dict[str, str] = {}
+        self._encoded: Dict[Tuple, EncodedImage] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def rgb(self)->Image.Image:
+        if self._rgb is None:
+            with span("decode"):
+                image = self.source
+                image.load()
+                if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+                    # Flatten transparency onto white rather than letting it turn black
+                    rgba = image.convert("RGBA")
+                    flattened = Image.new("RGB", rgba.size, (255, 255, 255))
+                    flattened.paste(rgba, mask=rgba.getchannel("A"))
+                    image = flattened
+                elif image.mode != "RGB":
+                    image = image.convert("RGB")
+                self._rgb = image
+        return self._rgb
+
+    @property
+    def fingerprint(self)->str:
+        if self._fingerprint is None:
+            rgb = self.rgb
+            with span("fingerprint"):
+                self._fingerprint = image_fingerprint(rgb)
+        return self._fingerprint
+
+    @property
+    def perceptual_hash(self)->str:
+        """The pHash, which is what history records store"""
+        return self.hash_for("phash")
+
+    def hash_for(self, method:str)->str:
+        # Memoized per method and kept through release(), so near-duplicate lookups still work in batches
+        if method not in self._perceptual_hashes:
+            rgb = self.rgb
+            with span("perceptual_hash"):
+                self._perceptual_hashes[method] = hash_to_hex(HASH_FUNCTIONS[method](rgb))
+        return self._perceptual_hashes[method]
+
+    def encode(self, provider:str|None=None)->EncodedImage:
+        max_edge = self.config.max_edge_for(provider)
+        key = (max_edge, self.config.format.upper(), self.config.quality)
+
+        with self._lock:
+            encoded = self._encoded.get(key)
+            if encoded is None:
+                if self.source is None:
+                    raise ValueError("Image pixels were released before this payload was encoded")
+                encoded = self._encode(*key)
+                self._encoded[key] = encoded
+            return encoded
+
+    def _encode(self, max_edge:int, fmt:str, quality:int)->EncodedImage:
+        image = self.rgb
+        with span("encode", format=fmt, max_edge=max_edge) as attributes:
+            encoded = self._encode_rgb(image, max_edge, fmt, quality)
+            attributes["payload_bytes"] = len(encoded.data)
+        return encoded
+
+    def _encode_rgb(self, image:Image.Image, max_edge:int, fmt:str, quality:int)->EncodedImage:
+        start = time.perf_counter()
+        width, height = image.size
+
+        scale = max_edge / max(width, height)
+        if scale < 1:
+            new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            image = image.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        buffered = io.BytesIO()
+        if fmt == "PNG":
+            image.save(buffered, format=fmt)
+        else:
+            image.save(buffered, format=fmt, quality=quality)
+
+        return EncodedImage(
+            data=buffered.getvalue(),
+            mime_type=FORMAT_MIME_TYPES.get(fmt, f"image/{fmt.lower()}"),
+            size=image.size,
+            encode_seconds=time.perf_counter() - start,
+            raw_bytes=width * height * 3
+        )
+
+    def release(self, hash_methods:Iterable[str]=("phash",)):
+        """Drop the decoded pixels, keeping the fingerprint, perceptual hashes and any payloads already encoded"""
+        _ = self.fingerprint
+        for method in hash_methods:
+            self.hash_for(method)
+        self.source = None
+        self._rgb = None
+
+    def report(self)->List[Dict]:
+        return [
+            {
+                "max_edge": max_edge,
+                "format": fmt,
+                "quality": quality,
+                "size": encoded.size,
+                "payload_bytes": len(encoded.data),
+                "vs_raw_bytes": encoded.vs_raw_bytes,
+                "encode_ms": encoded.encode_seconds * 1000
+            }
+            for (max_edge, fmt, quality), encoded in self._encoded.items()
+        ]
+
+
+def prepare_image(image:"Image.Image|PreparedImage", config:PreprocessConfig|None=None)->PreparedImage:
+    if isinstance(image, PreparedImage):
+        return image
+    return PreparedImage(image, config)
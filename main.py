@@ -1,20 +1,23 @@
-import io
 import os 
-import cv2 
-import numpy as np 
+import asyncio
 
-from PIL import Image
 import streamlit as st 
 
 from caption_generation import MultiModalCaptionGenerator
 from caption_history import CaptionHistory
 from caption_overlay import ImageCaptionOverlay
+from image_ingest import IngestedImage
+from perceptual_hash import NearDuplicateIndex
+from provider_router import ProviderRouter
+from render_cache import DOWNLOAD_FORMATS, RenderCache, render_key
+from telemetry import start_exporters_from_env
 from dotenv import load_dotenv
 import glob
 
 load_dotenv()
 
 # Function to get available fonts from the fonts folder
+@st.cache_data(ttl=60, show_spinner=False)
 def get_available_fonts():
     """Get list of available TrueType fonts from the fonts folder"""
     fonts_dict = {}
@@ -38,6 +41,18 @@ def get_available_fonts():
 
     return final_fonts
 
+# Rendered previews and downloads are shared across reruns and sessions, bounded by size
+@st.cache_resource
+def get_render_cache():
+    return RenderCache(max_bytes=512 * 1024 * 1024)
+
+# Prometheus endpoint and/or metrics file, when METRICS_PORT_ICG / METRICS_FILE_ICG are set
+@st.cache_resource
+def start_metrics_exporters():
+    return start_exporters_from_env()
+
+start_metrics_exporters()
+
 openai_key = os.getenv("OPENAI_API_ICG")
 groq_key = os.getenv("GROQ_API_ICG")
 gemini_key = os.getenv("GEMINI_API_ICG")
@@ -57,7 +72,15 @@ if "caption_history" not in st.session_state:
     st.session_state.caption_history = CaptionHistory()
 
 if "caption_generator" not in st.session_state:
-    st.session_state.caption_generator = MultiModalCaptionGenerator()
+    # The near-duplicate index is rebuilt from the saved history the first time it's searched
+    st.session_state.caption_generator = MultiModalCaptionGenerator(
+        duplicate_index=NearDuplicateIndex(loader=st.session_state.caption_history.get_history)
+    )
+
+if "caption_router" not in st.session_state:
+    st.session_state.caption_router = ProviderRouter(st.session_state.caption_generator)
+
+tracer = st.session_state.caption_generator.tracer
 
 # Sidebar for API configuration 
 with st.sidebar:
@@ -121,6 +144,11 @@ with st.sidebar:
         margin = st.slider("Margin", 20, 100, value=50, step=10)
         pil_font_size = st.slider("Font Size", 12, 72, value=24, step=2)
 
+    download_format = st.selectbox("Download Format", list(DOWNLOAD_FORMATS.keys()))
+    download_quality = 90
+    if download_format != "PNG":
+        download_quality = st.slider("Download Quality", 50, 100, value=90, step=5)
+
     st.markdown("---")
 
     # History Management 
@@ -129,6 +157,23 @@ with st.sidebar:
         st.session_state.caption_history.clear_history()
         st.success("✅ History cleared successfully.")
 
+    cache_stats = st.session_state.caption_generator.cache_stats()
+    st.caption(
+        f"Caption cache: {cache_stats['memory_hits'] + cache_stats['disk_hits']} hits, "
+        f"{cache_stats['misses']} misses ({cache_stats['hit_rate']:.0%} hit rate)"
+    )
+    for name, timing in st.session_state.caption_generator.stream_stats().items():
+        st.caption(
+            f"{name}: first token {timing['ttft_p50'] * 1000:.0f} ms, "
+            f"full caption {timing['total_p50'] * 1000:.0f} ms (median of {timing['streams']})"
+        )
+    for provider, connections in st.session_state.caption_generator.connection_stats().items():
+        if connections.get("requests"):
+            st.caption(
+                f"{provider} connections: {connections['requests']} requests, "
+                f"{connections['reused_connections']} on reused connections"
+            )
+
 # Main content Area 
 col1, col2 = st.columns([1, 1])
 
@@ -137,9 +182,40 @@ with col1:
     uploaded_file = st.file_uploader("Upload an image", type=["jpg", "jpeg", "png", "bmp", "tiff"])
 
     if uploaded_file is not None:
+        # Decode the upload once per file at working resolution, shared by every provider call;
+        # full resolution is only decoded for the download
+        if st.session_state.get("prepared_file_id") != uploaded_file.file_id:
+            st.session_state.ingested_image = IngestedImage(uploaded_file.getvalue())
+            st.session_state.prepared_image = st.session_state.caption_generator.prepare_image(
+                st.session_state.ingested_image.working
+            )
+            st.session_state.prepared_file_id = uploaded_file.file_id
+        ingested_image = st.session_state.ingested_image
+        prepared_image = st.session_state.prepared_image
+
         # Display original image 
-        image = Image.open(uploaded_file)
-        st.image(image, caption="Original Image", width="content")
+        st.image(ingested_image.working, caption="Original Image", width="content")
+        decode = ingested_image.report()
+        if ingested_image.reduced:
+            st.caption(
+                f"{decode['full_size'][0]}x{decode['full_size'][1]} {decode['format']} decoded at "
+                f"{decode['working_size'][0]}x{decode['working_size'][1]} in {decode['decode_ms']:.0f} ms"
+            )
+
+        # Offer the caption of a near-identical image instead of calling a provider again
+        if st.session_state.get("current_fingerprint") != prepared_image.fingerprint:
+            similar = st.session_state.caption_generator.find_similar(prepared_image)
+            if similar:
+                match = similar[0]
+                st.info(f"A similar image was captioned before by {match['model']} "
+                    f"(distance {match['distance']}): {match['caption']}")
+                if st.button("Use previous caption"):
+                    st.session_state.current_caption = match["caption"]
+                    st.session_state.current_image = prepared_image.rgb
+                    st.session_state.current_ingested = ingested_image
+                    st.session_state.current_fingerprint = prepared_image.fingerprint
+                    st.session_state.current_model = match["model"]
+                    st.session_state.caption_candidates = None
 
         # Model selection 
         st.header("🤖 Select Model")
@@ -148,35 +224,133 @@ with col1:
             "Google  GEMINI 2.5 Flash Lite": "gemini",
             "GROQ VISION": "groq"
         }
-
-        selected_model = st.selectbox("Choose a model", list(models.keys()))
-
-        if st.button("Generate Caption", type="primary"):
+        auto_model = "Fastest available (auto)"
+
+        compare_all = st.checkbox("Compare all models",
+            help="Query every model concurrently and show each caption as it arrives")
+        selected_model = st.selectbox("Choose a model", list(models.keys()) + [auto_model], disabled=compare_all,
+            help="Auto routes to the currently fastest healthy provider and hedges slow requests")
+        use_cache = st.checkbox("Reuse cached captions", value=True,
+            help="Untick to always request a fresh caption from the provider")
+        candidate_count = st.slider("Caption alternatives", 1, 5, value=1, disabled=compare_all,
+            help="Ask for several ranked captions in one request instead of regenerating")
+
+        if compare_all and st.button("Generate Captions", type="primary"):
+            display_names = {key: name for name, key in models.items()}
+            placeholders = {key: st.empty() for key in models.values()}
+            for key, placeholder in placeholders.items():
+                placeholder.info(f"⏳ Waiting for {display_names[key]}...")
+
+            async def run_comparison():
+                results = []
+                async for result in st.session_state.caption_generator.agenerate(
+                    prepared_image, providers=list(models.values()), use_cache=use_cache
+                ):
+                    name = display_names[result.provider]
+                    st.session_state.caption_router.record_result(result)
+                    if result.ok:
+                        timing = "cached" if result.cached else f"{result.elapsed:.1f}s"
+                        placeholders[result.provider].success(f"**{name}** ({timing}): {result.caption}")
+                        st.session_state.caption_history.add_interaction(
+                            uploaded_file.name, name, result.caption, content_hash=prepared_image.fingerprint,
+                            perceptual_hash=prepared_image.perceptual_hash
+                        )
+                        results.append((name, result.caption))
+                    else:
+                        placeholders[result.provider].error(f"**{name}**: {result.error}")
+                return results
+
+            with tracer.trace("compare", image=uploaded_file.name):
+                comparison = asyncio.run(run_comparison())
+            st.session_state.comparison_results = dict(comparison)
+            if comparison:
+                # The fastest successful caption is previewed first
+                st.session_state.current_model, st.session_state.current_caption = comparison[0]
+                st.session_state.current_image = prepared_image.rgb
+                st.session_state.current_ingested = ingested_image
+                st.session_state.current_fingerprint = prepared_image.fingerprint
+
+        elif compare_all and st.session_state.get("comparison_results"):
+            comparison = st.session_state.comparison_results
+            chosen_model = st.radio("Preview caption from", list(comparison.keys()))
+            st.session_state.current_model = chosen_model
+            st.session_state.current_caption = comparison[chosen_model]
+            for name, caption in comparison.items():
+                st.write(f"**{name}:** {caption}")
+
+        if not compare_all and st.button("Generate Caption", type="primary"):
             try:
-                model_key = models[selected_model]
+                model_key = models.get(selected_model, "auto")
+                model_name = selected_model
                 caption = ""
 
-                with st.spinner("Generating caption with {selected_model}..."):
-                    if model_key == "openai":
-                        caption = st.session_state.caption_generator.generate_caption_openai(image)
-                    elif model_key == "gemini":
-                        caption = st.session_state.caption_generator.generate_caption_gemini(image)
-                    elif model_key == "groq":
-                        caption = st.session_state.caption_generator.generate_caption_groq(image)
-
-                    st.session_state.current_caption = caption
-                    st.session_state.current_image = image
-                    st.session_state.current_model = selected_model
-
-                    # Add to history
-                    st.session_state.caption_history.add_interaction(
-                        uploaded_file.name,
-                        selected_model,
-                        caption
-                    )
+                candidates = None
+
+                with tracer.trace("caption", provider=model_key, image=uploaded_file.name):
+                    if candidate_count > 1:
+                        # One request returns every alternative, so the image is only uploaded once
+                        with st.spinner(f"Generating {candidate_count} captions with {selected_model}..."):
+                            if model_key == "auto":
+                                # Routed, so a failing provider falls over to the next one and counts in the stats
+                                provider, candidates = st.session_state.caption_router.route_candidates(
+                                    prepared_image, candidate_count, use_cache=use_cache
+                                )
+                            else:
+                                provider = model_key
+                                candidates = st.session_state.caption_generator.generate_candidates(
+                                    prepared_image, provider, n=candidate_count, use_cache=use_cache
+                                )
+                        caption = candidates[0]
+                        model_name = {key: name for name, key in models.items()}[provider]
+                    elif model_key == "auto":
+                        with st.spinner(f"Generating caption with {selected_model}..."):
+                            result = st.session_state.caption_router.route(prepared_image, use_cache=use_cache)
+                        if not result.ok:
+                            raise ValueError(result.error)
+                        caption = result.caption
+                        model_name = {key: name for name, key in models.items()}[result.provider]
+                    else:
+                        # Show the caption as it is generated; nothing is saved until the stream completes
+                        caption = st.write_stream(
+                            st.session_state.caption_generator.stream_caption(prepared_image, model_key, use_cache=use_cache)
+                        )
+
+                    # Alternatives stay selectable for this image until the next generation
+                    st.session_state.caption_candidates = (prepared_image.fingerprint, candidates) \
+                        if candidates and len(candidates) > 1 else None
+
+                    if caption:
+                        st.session_state.current_caption = caption
+                        st.session_state.current_image = prepared_image.rgb
+                        st.session_state.current_ingested = ingested_image
+                        st.session_state.current_fingerprint = prepared_image.fingerprint
+                        st.session_state.current_model = model_name
+
+                        # Add to history
+                        st.session_state.caption_history.add_interaction(
+                            uploaded_file.name,
+                            model_name,
+                            caption,
+                            content_hash=prepared_image.fingerprint,
+                            perceptual_hash=prepared_image.perceptual_hash,
+                            candidates=candidates
+                        )
             except Exception as e:
                 st.error(f"Error generating caption: {str(e)}")
 
+        fingerprint, candidates = st.session_state.get("caption_candidates") or (None, None)
+        if not compare_all and candidates and fingerprint == prepared_image.fingerprint \
+                and st.session_state.get("current_fingerprint") == fingerprint:
+            st.session_state.current_caption = st.radio("Choose a caption", candidates,
+                help="Ranked best first; the history entry keeps the top-ranked caption and lists the others")
+
+        for payload in prepared_image.report():
+            st.caption(
+                f"Payload {payload['size'][0]}x{payload['size'][1]} {payload['format']}: "
+                f"{payload['payload_bytes'] / 1024:.0f} KB "
+                f"({payload['vs_raw_bytes'] / 1024:.0f} KB under raw pixels, encoded in {payload['encode_ms']:.0f} ms)"
+            )
+
 with col2:
     st.header("🪄✨ Generated Captions and Preview")
 
@@ -185,46 +359,66 @@ with col2:
         
         # Generate Preview with Caption 
         if hasattr(st.session_state, "current_image"):
-            # Convert PIL to OpenCV format 
-            cv_image = cv2.cvtColor(np.array(st.session_state.current_image), cv2.COLOR_RGB2BGR)
+            # The overlay takes and returns PIL directly, so no colour or format round trips happen here
+            source_image = st.session_state.current_image
+            source_ingested = st.session_state.get("current_ingested")
+            render_cache = get_render_cache()
+
+            # The preview renders on the working-resolution image, so pixel sizes shrink with it
+            # to look like the full-resolution download
+            preview_scale = source_ingested.working_scale if source_ingested is not None else 1.0
 
             if caption_method == "Overlay on Image":
-                result_image = ImageCaptionOverlay.add_caption_overlay(
-                    cv_image,
+                render_settings = {"position": position, "font_size": font_size, "thickness": thickness,
+                    "font_path": selected_font_path}
+                render_caption = lambda image, scale: ImageCaptionOverlay.add_caption_overlay(
+                    image,
                     st.session_state.current_caption,
-                    position=position,
-                    font_size=font_size,
-                    thickness=thickness,
-                    font_path=selected_font_path
+                    **{**render_settings, "font_size": font_size * scale, "thickness": max(1, round(thickness * scale))}
                 )
             else:
                 # Convert hex colors to RGB colors
                 bg_rgb = tuple(int(bg_color[i:i+2], 16) for i in (1, 3, 5))
                 text_rgb = tuple(int(text_color[i:i+2], 16) for i in (1, 3, 5))
 
-                result_image = ImageCaptionOverlay.add_caption_background(
-                    cv_image,
+                render_settings = {"font_path": selected_font_path, "font_size": pil_font_size,
+                    "background_color": bg_rgb, "text_color": text_rgb, "margin": margin}
+                render_caption = lambda image, scale: ImageCaptionOverlay.add_caption_background(
+                    image,
                     st.session_state.current_caption,
-                    font_path=selected_font_path,
-                    font_size=pil_font_size,
-                    background_color=bg_rgb,
-                    text_color=text_rgb,
-                    margin=margin
+                    **{**render_settings, "font_size": max(1, round(pil_font_size * scale)), "margin": round(margin * scale)}
                 )
 
-            # Convert back to PIL for display
-            result_pil = Image.fromarray(cv2.cvtColor(result_image, cv2.COLOR_BGR2RGB))
-            st.image(result_pil, caption="Image with Caption", use_container_width=True)
-
-            # Download Button 
-            img_buffer = io.BytesIO()
-            result_pil.save(img_buffer, format="PNG")
-
+            # Reruns with the same image, caption and settings reuse the rendered preview
+            preview_key = render_key(
+                st.session_state.get("current_fingerprint", ""),
+                st.session_state.current_caption,
+                caption_method,
+                render_settings
+            )
+            def traced_render():
+                # Only renders that miss the cache are traced, so reruns don't flood the debug panel
+                with tracer.trace("render", method=caption_method):
+                    return render_caption(source_image, preview_scale)
+
+            result_image = render_cache.render(preview_key, traced_render)
+            st.image(render_cache.preview(preview_key, result_image), caption="Image with Caption",
+                width="stretch")
+
+            # Download Button, encoded only when clicked
+            _, extension, mime_type = DOWNLOAD_FORMATS[download_format]
+            base_name = os.path.splitext(uploaded_file.name)[0] if uploaded_file else "image"
+            if source_ingested is not None and source_ingested.reduced:
+                # Full resolution is decoded and rendered only for the download itself
+                download_data = lambda: render_cache.export(preview_key, lambda: render_caption(source_ingested.full(), 1.0),
+                    download_format, download_quality)
+            else:
+                download_data = lambda: render_cache.download(preview_key, result_image, download_format, download_quality)
             st.download_button(
                 label="🔽 Download Image with Caption",
-                data=img_buffer.getvalue(),
-                file_name=f"captioned_{uploaded_file.name if uploaded_file else 'image'}",
-                mime="image/png"
+                data=download_data,
+                file_name=f"captioned_{base_name}.{extension}",
+                mime=mime_type
             
             )
 
@@ -233,18 +427,42 @@ if getattr(st.session_state, "show_history", False):
     st.markdown("---")
     st.header("📟️ Caption Generation History")
 
-    history = st.session_state.caption_history.get_history()
+    # Only the latest entries are shown, so only they are read; the store reads them from the end
+    history = st.session_state.caption_history.get_recent_interactions(10)
 
     if history:
-        for index, item in enumerate(reversed(history[-10:])):
+        for index, item in enumerate(reversed(history)):
             with st.expander(f"{item['timestamp'][:19]} - {item['image_name']} ({item['model']})"):
                 st.write(f"**Model:** {item['model']}") 
                 st.write(f"**Image: {item['image_name']}**")
                 st.write(f"**Caption: {item['caption']}**")
+                alternatives = [candidate for candidate in item.get("candidates", []) if candidate != item["caption"]]
+                if alternatives:
+                    st.write("**Alternatives:** " + " / ".join(alternatives))
                 st.write(f"**Timestamp: {item['timestamp']}**")
     else:
         st.info("No caption history available.")
 
+# Stage breakdown of recent requests; drawn last so this run's requests are included
+with st.sidebar:
+    st.markdown("---")
+    with st.expander("⏱️ Performance Debug"):
+        trace_count = st.slider("Requests to show", 1, 50, value=10)
+        recent_traces = tracer.recent(trace_count)
+        if recent_traces:
+            st.dataframe([
+                {
+                    "time": trace["timestamp"][11:],
+                    "request": trace["name"],
+                    "total ms": round((trace["duration"] or 0) * 1000, 1),
+                    **{f"{stage} ms": round(seconds * 1000, 1) for stage, seconds in trace["stages"].items()},
+                    "error": trace["error"] or ""
+                }
+                for trace in recent_traces
+            ], hide_index=True)
+        else:
+            st.caption("No requests traced yet.")
+
 # Footer 
 st.markdown("---")
 st.markdown("""
@@ -0,0 +1,271 @@
+import itertools
+import threading
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+HASH_BITS = 64
+
+# Set bits per byte, for NumPy before 2.0 which has no bitwise_count
+_BYTE_POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+def popcount(values:np.ndarray)->np.ndarray:
+    """Set bits in each uint64"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    return _BYTE_POPCOUNT[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def _gray(image:Image.Image|np.ndarray, size:Tuple[int, int])->np.ndarray:
+    if isinstance(image, np.ndarray):
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    # Shrink first with a cheap box filter so huge uploads aren't converted at full size
+    small = image.reduce(max(1, min(image.size) // (4 * max(size)))) if min(image.size) > 8 * max(size) else image
+    return cv2.resize(np.asarray(small.convert("L"), dtype=np.float32), size, interpolation=cv2.INTER_AREA)
+
+
+def _pack(bits:np.ndarray)->int:
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def dhash(image:Image.Image|np.ndarray, hash_size:int=8)->int:
+    """Difference hash: whether each pixel is brighter than its right neighbour on a 9x8 thumbnail"""
+    pixels = _gray(image, (hash_size + 1, hash_size))
+    return _pack(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image:Image.Image|np.ndarray, hash_size:int=8, highfreq_factor:int=4)->int:
+    """DCT hash: the lowest-frequency 8x8 DCT terms of a 32x32 thumbnail, thresholded at their median"""
+    size = hash_size * highfreq_factor
+    low = cv2.dct(_gray(image, (size, size)))[:hash_size, :hash_size]
+    # The DC term only reflects overall brightness, so it's left out of the median
+    median = np.median(low.ravel()[1:])
+    return _pack(low > median)
+
+
+HASH_FUNCTIONS: Dict[str, Callable[[Image.Image|np.ndarray], int]] = {"phash": phash, "dhash": dhash}
+
+
+def hamming(a:int, b:int)->int:
+    return (a ^ b).bit_count()
+
+
+def hash_to_hex(value:int)->str:
+    return f"{value:016x}"
+
+
+class BKTree:
+    """Burkhard-Keller tree over Hamming distance; each node is [hash, item ids, {distance: child}]"""
+
+    def __init__(self) -> None:
+        self._root: list|None = None
+        self._size = 0
+
+    def __len__(self)->int:
+        return self._size
+
+    def add(self, value:int, item_id:int):
+        self._size += 1
+        if self._root is None:
+            self._root = [value, [item_id], {}]
+            return
+        node = self._root
+        while True:
+            distance = (node[0] ^ value).bit_count()
+            if distance == 0:
+                node[1].append(item_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item_id], {}]
+                return
+            node = child
+
+    def search(self, value:int, max_distance:int)->List[Tuple[int, int]]:
+        results = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = (node[0] ^ value).bit_count()
+            if distance <= max_distance:
+                results.extend((distance, item_id) for item_id in node[1])
+            # Triangle inequality: only children within max_distance of this node's distance can match
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return results
+
+
+@lru_cache(maxsize=32)
+def _flip_masks(bits:int, radius:int)->Tuple[int, ...]:
+    masks = []
+    for flipped in range(radius + 1):
+        for positions in itertools.combinations(range(bits), flipped):
+            mask = 0
+            for position in positions:
+                mask |= 1 << position
+            masks.append(mask)
+    return tuple(masks)
+
+
+class MultiIndexHashIndex:
+    """Multi-index hashing: the hash is split into segments, each indexed in its own table.
+
+    Two hashes within distance r differ by at most r // segments bits in at least one
+    segment, so probing each table with that small radius finds every candidate; the
+    candidates are then checked against the full hashes in one vectorised pass.
+    """
+
+    def __init__(self, bits:int=HASH_BITS, segments:int=4) -> None:
+        self.bits = bits
+        self.segments = segments
+        self.segment_bits = bits // segments
+        self._mask = (1 << self.segment_bits) - 1
+        self._tables: List[Dict[int, List[int]]] = [{} for _ in range(segments)]
+        self._size = 0
+
+    def __len__(self)->int:
+        return self._size
+
+    def _segment(self, value:int, index:int)->int:
+        return (value >> (index * self.segment_bits)) & self._mask
+
+    def add(self, value:int, item_id:int):
+        self._size += 1
+        for index, table in enumerate(self._tables):
+            table.setdefault(self._segment(value, index), []).append(item_id)
+
+    def probe_radius(self, max_distance:int)->int:
+        return max_distance // self.segments
+
+    def search(self, value:int, max_distance:int, hashes:np.ndarray)->List[Tuple[int, int]]:
+        masks = _flip_masks(self.segment_bits, self.probe_radius(max_distance))
+        candidates = []
+        for index, table in enumerate(self._tables):
+            segment = self._segment(value, index)
+            get = table.get
+            for mask in masks:
+                ids = get(segment ^ mask)
+                if ids:
+                    candidates.extend(ids)
+        if not candidates:
+            return []
+
+        ids = np.unique(np.array(candidates, dtype=np.int64))
+        distances = popcount(hashes[ids] ^ np.uint64(value))
+        keep = distances <= max_distance
+        return list(zip(distances[keep].tolist(), ids[keep].tolist()))
+
+
+def scan(hashes:np.ndarray, value:int, max_distance:int)->List[Tuple[int, int]]:
+    """Vectorised linear scan; beats probing once the per-segment radius gets large"""
+    distances = popcount(hashes ^ np.uint64(value))
+    ids = np.flatnonzero(distances <= max_distance)
+    return list(zip(distances[ids].tolist(), ids.tolist()))
+
+
+class NearDuplicateIndex:
+    """Perceptual hashes of captioned images, searchable by Hamming distance.
+
+    Each distinct hash keeps the latest caption per (provider, model). The index is kept
+    in memory; `loader` is called on first use to rebuild it from CaptionHistory records
+    that carry a `perceptual_hash`.
+    """
+
+    def __init__(self, threshold:int=6, method:str="phash", structure:str="auto",
+    loader:Callable[[], Iterable[Dict]]|None=None) -> None:
+        if method not in HASH_FUNCTIONS:
+            raise ValueError(f"Unknown hash method: {method}")
+        if structure not in ("auto", "multi-index", "bk-tree", "scan"):
+            raise ValueError(f"Unknown index structure: {structure}")
+        self.threshold = threshold
+        self.method = method
+        # History records carry the pHash as `perceptual_hash`; other methods need their own field
+        self.hash_field = "perceptual_hash" if method == "phash" else f"{method}_hash"
+        self.structure = structure
+        self._hashes = np.empty(1024, dtype=np.uint64)
+        self._size = 0
+        self._ids: Dict[int, int] = {}
+        self._records: List[Dict[Tuple[str, str], Dict]] = []
+        # "auto" probes the multi-index while the per-segment radius is small and scans otherwise
+        self._index = BKTree() if structure == "bk-tree" else MultiIndexHashIndex() if structure != "scan" else None
+        self._lock = threading.RLock()
+        self._loader = loader
+
+    def _load(self):
+        # Loading the history is deferred until something actually needs the index
+        if self._loader is not None:
+            loader, self._loader = self._loader, None
+            self.add_records(loader())
+
+    def __len__(self)->int:
+        with self._lock:
+            self._load()
+            return self._size
+
+    def hash_image(self, image:Image.Image|np.ndarray)->int:
+        return HASH_FUNCTIONS[self.method](image)
+
+    def add(self, value:int|str, record:Dict):
+        if isinstance(value, str):
+            value = int(value, 16)
+        key = (record.get("provider") or "", record.get("model") or "")
+        with self._lock:
+            self._load()
+            item_id = self._ids.get(value)
+            if item_id is None:
+                item_id = self._ids[value] = self._size
+                if self._size == len(self._hashes):
+                    self._hashes = np.resize(self._hashes, 2 * len(self._hashes))
+                self._hashes[item_id] = value
+                self._size += 1
+                self._records.append({})
+                if self._index is not None:
+                    self._index.add(value, item_id)
+            self._records[item_id][key] = record
+
+    def add_records(self, records:Iterable[Dict])->int:
+        added = 0
+        for record in records:
+            value = record.get(self.hash_field)
+            if value and record.get("caption"):
+                self.add(value, record)
+                added += 1
+        return added
+
+    def lookup(self, value:int|str, threshold:int|None=None)->List[Tuple[int, Dict]]:
+        """Records of similar images, closest first"""
+        if isinstance(value, str):
+            value = int(value, 16)
+        threshold = self.threshold if threshold is None else threshold
+        with self._lock:
+            self._load()
+            hashes = self._hashes[:self._size]
+            if isinstance(self._index, BKTree):
+                matches = self._index.search(value, threshold)
+            elif self._index is not None and (self.structure == "multi-index" or self._index.probe_radius(threshold) <= 1):
+                matches = self._index.search(value, threshold, hashes)
+            else:
+                matches = scan(hashes, value, threshold)
+            found = [(distance, record) for distance, item_id in matches
+                for record in self._records[item_id].values()]
+        # Newest first within a distance, so the latest caption wins a tie
+        found.sort(key=lambda match: match[1].get("timestamp") or "", reverse=True)
+        found.sort(key=lambda match: match[0])
+
+        # The same caption can be recorded by the generator and by the history
+        unique, seen = [], set()
+        for distance, record in found:
+            if record.get("caption") not in seen:
+                seen.add(record.get("caption"))
+                unique.append((distance, record))
+        return unique
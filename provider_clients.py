@@ -0,0 +1,177 @@
+import os
+import hashlib
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Tuple
+
+# The SDKs take seconds to import, so each is only imported when its client is first built
+if TYPE_CHECKING:
+    import httpx
+    import openai
+    import google.generativeai as genai
+    from groq import Groq
+
+
+@dataclass
+class PoolSettings:
+    max_connections: int = 32
+    max_keepalive_connections: int = 16
+    keepalive_expiry: float = 90.0
+    timeout: float = 60.0
+    connect_timeout: float = 10.0
+
+    @classmethod
+    def from_env(cls)->"PoolSettings":
+        settings = cls()
+        for name, env in (("max_connections", "HTTP_MAX_CONNECTIONS_ICG"),
+                ("max_keepalive_connections", "HTTP_MAX_KEEPALIVE_ICG"),
+                ("keepalive_expiry", "HTTP_KEEPALIVE_EXPIRY_ICG")):
+            value = os.getenv(env)
+            if value:
+                setattr(settings, name, type(getattr(settings, name))(float(value)))
+        return settings
+
+
+class ConnectionMetrics:
+    """Counts requests against new TCP connections and TLS handshakes, via httpcore trace events"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+
+    def _trace(self, event:str, info:Dict):
+        if event == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+        elif event == "connection.start_tls.complete":
+            with self._lock:
+                self.tls_handshakes += 1
+
+    def on_request(self, request:"httpx.Request"):
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = self._trace
+
+    def snapshot(self)->Dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": max(0, self.requests - self.new_connections),
+                "tls_handshakes": self.tls_handshakes
+            }
+
+
+def _key_id(api_key:str)->str:
+    # Clients are looked up by key, but the key itself is never kept as a dict key
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class ProviderClientRegistry:
+    """Process-wide provider clients, shared by every Streamlit session and batch worker.
+
+    OpenAI and Groq each get one pooled keep-alive httpx client per API key, so connections
+    and TLS sessions are reused across callers. Gemini model handles are cached by model
+    name. All lookups are thread-safe; the SDK clients themselves are safe to share.
+    """
+
+    def __init__(self, pool:PoolSettings|None=None, base_urls:Dict[str, str]|None=None) -> None:
+        self.pool = pool or PoolSettings.from_env()
+        self.base_urls = base_urls or {}
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple[str, str], object] = {}
+        self._http_clients: Dict[Tuple[str, str], "httpx.Client"] = {}
+        self._metrics: Dict[str, ConnectionMetrics] = {}
+        self._gemini_key: str|None = None
+        self._gemini_models: Dict[str, "genai.GenerativeModel"] = {}
+
+    def _http_client(self, provider:str)->"httpx.Client":
+        import httpx
+
+        metrics = self._metrics.setdefault(provider, ConnectionMetrics())
+        return httpx.Client(
+            limits=httpx.Limits(
+                max_connections=self.pool.max_connections,
+                max_keepalive_connections=self.pool.max_keepalive_connections,
+                keepalive_expiry=self.pool.keepalive_expiry
+            ),
+            timeout=httpx.Timeout(self.pool.timeout, connect=self.pool.connect_timeout),
+            event_hooks={"request": [metrics.on_request]}
+        )
+
+    def _client(self, provider:str, api_key:str, factory):
+        key = (provider, _key_id(api_key))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                http_client = self._http_clients[key] = self._http_client(provider)
+                client = self._clients[key] = factory(http_client)
+            return client
+
+    def openai(self, api_key:str)->"openai.OpenAI":
+        import openai
+
+        # Retries are left to the request scheduler, which knows about the shared quota
+        return self._client("openai", api_key, lambda http_client: openai.OpenAI(
+            api_key=api_key, base_url=self.base_urls.get("openai"), max_retries=0, http_client=http_client
+        ))
+
+    def groq(self, api_key:str)->"Groq":
+        from groq import Groq
+
+        return self._client("groq", api_key, lambda http_client: Groq(
+            api_key=api_key, base_url=self.base_urls.get("groq"), max_retries=0, http_client=http_client
+        ))
+
+    def configure_gemini(self, api_key:str):
+        key_id = _key_id(api_key)
+        with self._lock:
+            if self._gemini_key == key_id:
+                return
+            import google.generativeai as genai
+
+            # genai keeps one global configuration; handles built for another key are stale
+            genai.configure(api_key=api_key)
+            self._gemini_key = key_id
+            self._gemini_models.clear()
+
+    def gemini_model(self, model_name:str)->"genai.GenerativeModel":
+        import google.generativeai as genai
+
+        with self._lock:
+            if self._gemini_key is None:
+                raise ValueError("Gemini API key is not configured!")
+            model = self._gemini_models.get(model_name)
+            if model is None:
+                model = self._gemini_models[model_name] = genai.GenerativeModel(model_name=model_name)
+            return model
+
+    def metrics(self)->Dict[str, Dict]:
+        with self._lock:
+            metrics = dict(self._metrics)
+            gemini_models = len(self._gemini_models)
+        snapshot = {provider: provider_metrics.snapshot() for provider, provider_metrics in metrics.items()}
+        snapshot["gemini"] = {"cached_models": gemini_models}
+        return snapshot
+
+    def close(self):
+        with self._lock:
+            for http_client in self._http_clients.values():
+                http_client.close()
+            self._http_clients.clear()
+            self._clients.clear()
+            self._gemini_models.clear()
+
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+
+def default_registry()->ProviderClientRegistry:
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = ProviderClientRegistry()
+        return _default_registry
@@ -0,0 +1,109 @@
+import threading
+from dataclasses import dataclass
+from importlib.metadata import EntryPoint, entry_points
+from typing import Any, Callable, Dict, Iterator, List
+
+# Third-party packages register providers under this group, e.g. in pyproject.toml:
+#   [project.entry-points."image_caption_generator.providers"]
+#   myprovider = "my_package.captions:plugin"
+ENTRY_POINT_GROUP = "image_caption_generator.providers"
+
+
+@dataclass
+class ProviderPlugin:
+    """A caption provider.
+
+    `caption(generator, image, model, priority)` returns the caption for a PreparedImage;
+    the generator adds caching around it. `stream` takes the same arguments and yields text
+    deltas. A plugin needs at least one of the two: without `caption` the joined stream is
+    the caption, and without `stream` the caption arrives as one chunk.
+    `candidates(generator, image, model, n, priority)` returns up to n captions best first;
+    without it the generator asks for a caption n times. `configure(generator, api_key)` is
+    called from configure_apis.
+
+    Built-in providers are registered as metadata only (name, default model, key variable) and
+    have no callables: they are dispatched to MultiModalCaptionGenerator's own methods, which
+    do their own request building, caching and scheduling.
+    """
+    name: str
+    default_model: str
+    caption: Callable[..., str]|None = None
+    stream: Callable[..., Iterator[str]]|None = None
+    configure: Callable[[Any, str], None]|None = None
+    api_key_env: str|None = None
+    builtin: bool = False
+    candidates: Callable[..., List[str]]|None = None
+
+
+_providers: Dict[str, ProviderPlugin] = {}
+_entry_points: Dict[str, EntryPoint]|None = None
+_lock = threading.RLock()
+
+
+def _check_plugin(plugin:ProviderPlugin):
+    if not plugin.builtin and plugin.caption is None and plugin.stream is None:
+        raise ValueError(f"Provider {plugin.name} defines neither caption nor stream")
+
+
+def register_provider(plugin:ProviderPlugin, replace:bool=False):
+    _check_plugin(plugin)
+    with _lock:
+        existing = _providers.get(plugin.name)
+        if existing is not None and not replace:
+            raise ValueError(f"Provider already registered: {plugin.name}")
+        if existing is not None and existing.builtin:
+            raise ValueError(f"Built-in provider can't be replaced: {plugin.name}")
+        _providers[plugin.name] = plugin
+
+
+def unregister_provider(name:str):
+    with _lock:
+        plugin = _providers.get(name)
+        if plugin is not None and not plugin.builtin:
+            del _providers[name]
+
+
+def _discovered()->Dict[str, EntryPoint]:
+    # Entry points are listed once, but a plugin's module is only imported when it's used
+    global _entry_points
+    if _entry_points is None:
+        _entry_points = {entry_point.name: entry_point for entry_point in entry_points(group=ENTRY_POINT_GROUP)}
+    return _entry_points
+
+
+def get_provider(name:str)->ProviderPlugin:
+    with _lock:
+        plugin = _providers.get(name)
+        if plugin is not None:
+            return plugin
+
+        entry_point = _discovered().get(name)
+        if entry_point is None:
+            raise ValueError(f"Unknown provider: {name}")
+        loaded = entry_point.load()
+        plugin = loaded if isinstance(loaded, ProviderPlugin) else loaded()
+        if not isinstance(plugin, ProviderPlugin) or plugin.name != name:
+            raise ValueError(f"Entry point {name!r} did not provide a ProviderPlugin named {name!r}")
+        _check_plugin(plugin)
+        _providers[name] = plugin
+        return plugin
+
+
+def provider_names()->List[str]:
+    with _lock:
+        return list(dict.fromkeys(list(_providers) + list(_discovered())))
+
+
+def default_model(provider:str)->str:
+    try:
+        return get_provider(provider).default_model
+    except ValueError:
+        return ""
+
+
+for _builtin in (
+    ProviderPlugin("openai", "gpt-5-nano", api_key_env="OPENAI_API_ICG", builtin=True),
+    ProviderPlugin("groq", "meta-llama/llama-4-scout-17b-16e-instruct", api_key_env="GROQ_API_ICG", builtin=True),
+    ProviderPlugin("gemini", "gemini-2.5-flash-lite", api_key_env="GEMINI_API_ICG", builtin=True)
+):
+    register_provider(_builtin)
@@ -0,0 +1,221 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Dict, List, Tuple
+
+from PIL import Image
+
+from caption_generation import CaptionResult, MultiModalCaptionGenerator
+from image_preprocessing import PreparedImage
+
+
+class ProviderStats:
+    """Rolling latency and error statistics for one provider"""
+
+    def __init__(self, alpha:float=0.2, window:int=200) -> None:
+        self.alpha = alpha
+        self.ewma: float|None = None
+        self.error_rate = 0.0
+        self.latencies: deque = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.unhealthy_until = 0.0
+
+    def record(self, elapsed:float, ok:bool):
+        self.requests += 1
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            # Only successful calls say how fast the provider answers
+            self.consecutive_errors = 0
+            self.latencies.append(elapsed)
+            self.ewma = elapsed if self.ewma is None else self.ewma + self.alpha * (elapsed - self.ewma)
+        else:
+            self.errors += 1
+            self.consecutive_errors += 1
+
+    def quantile(self, q:float)->float|None:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def snapshot(self)->Dict:
+        return {
+            "ewma": self.ewma,
+            "p95": self.quantile(0.95),
+            "error_rate": self.error_rate,
+            "requests": self.requests,
+            "errors": self.errors,
+            "healthy": time.monotonic() >= self.unhealthy_until
+        }
+
+
+class ProviderRouter:
+    """Routes "any model" caption requests to the fastest healthy provider.
+
+    Providers are ranked by EWMA latency; ones without samples yet rank first so they get
+    measured. A provider that keeps failing is benched for `cooldown` seconds. With hedging
+    on, a second provider is asked once the first has run past its own p95 latency, and
+    whichever answers first wins. The loser's task is cancelled; a blocking SDK call that is
+    already running finishes in the background and its answer is dropped.
+    """
+
+    def __init__(self, generator:MultiModalCaptionGenerator, providers:List[str]|None=None,
+    hedge:bool=True, hedge_quantile:float=0.95, min_hedge_delay:float=0.05, alpha:float=0.2,
+    window:int=200, max_error_rate:float=0.5, max_consecutive_errors:int=3, cooldown:float=30.0,
+    timeout:float|None=60.0) -> None:
+        self.generator = generator
+        self.providers = providers
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_error_rate = max_error_rate
+        self.max_consecutive_errors = max_consecutive_errors
+        self.cooldown = cooldown
+        self.timeout = timeout
+
+        self._alpha = alpha
+        self._window = window
+        self._stats: Dict[str, ProviderStats] = {}
+        self._lock = threading.Lock()
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    def _stats_for(self, provider:str)->ProviderStats:
+        stats = self._stats.get(provider)
+        if stats is None:
+            stats = self._stats[provider] = ProviderStats(self._alpha, self._window)
+        return stats
+
+    def record(self, provider:str, elapsed:float, ok:bool):
+        with self._lock:
+            stats = self._stats_for(provider)
+            stats.record(elapsed, ok)
+            if not ok and (stats.consecutive_errors >= self.max_consecutive_errors
+                    or (stats.requests >= 5 and stats.error_rate > self.max_error_rate)):
+                stats.unhealthy_until = time.monotonic() + self.cooldown
+
+    def rank(self, providers:List[str]|None=None)->List[str]:
+        """Providers fastest first; benched providers go last rather than disappearing"""
+        providers = providers or self.providers or self.generator.configured_providers()
+        now = time.monotonic()
+        with self._lock:
+            def key(provider:str):
+                stats = self._stats_for(provider)
+                benched = now < stats.unhealthy_until
+                return (benched, stats.ewma if stats.ewma is not None else 0.0)
+            return sorted(providers, key=key)
+
+    def hedge_delay(self, provider:str)->float:
+        with self._lock:
+            delay = self._stats_for(provider).quantile(self.hedge_quantile)
+        if delay is None:
+            return self.timeout or 60.0
+        return max(self.min_hedge_delay, delay)
+
+    def record_result(self, result:CaptionResult):
+        """Record a provider call; cache hits are skipped, as their near-zero time would skew the ranking"""
+        if not result.cached:
+            self.record(result.provider, result.elapsed, result.ok)
+
+    async def _attempt(self, image:PreparedImage, provider:str, models:Dict[str, str],
+    use_cache:bool|None)->CaptionResult:
+        result = await self.generator.agenerate_caption(
+            image, provider, model=models.get(provider), use_cache=use_cache, timeout=self.timeout
+        )
+        self.record_result(result)
+        return result
+
+    async def aroute(self, image:Image.Image|PreparedImage, providers:List[str]|None=None,
+    models:Dict[str, str]|None=None, hedge:bool|None=None, use_cache:bool|None=None)->CaptionResult:
+        image = self.generator.prepare_image(image)
+        ranked = self.rank(providers)
+        if not ranked:
+            return CaptionResult("", "", error="No caption providers are configured")
+        models = models or {}
+        hedge = self.hedge if hedge is None else hedge
+
+        candidates = deque(ranked)
+        pending = set()
+        owners = {}
+        last_result = None
+
+        def launch():
+            provider = candidates.popleft()
+            task = asyncio.create_task(self._attempt(image, provider, models, use_cache))
+            owners[task] = provider
+            pending.add(task)
+            return provider
+
+        primary = launch()
+        hedge_provider = None
+        hedge_at = time.monotonic() + self.hedge_delay(primary) if hedge and candidates else None
+
+        try:
+            while pending:
+                wait_for = None
+                if hedge_at is not None:
+                    wait_for = max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # The primary is running slower than usual: ask the next provider too
+                    hedge_provider = launch()
+                    self.hedges += 1
+                    hedge_at = None
+                    continue
+
+                for task in done:
+                    pending.discard(task)
+                    result = task.result()
+                    if result.ok:
+                        if owners[task] == hedge_provider:
+                            self.hedge_wins += 1
+                        return result
+                    last_result = result
+
+                # Fail over to the next provider if nothing else is still in flight
+                if not pending and candidates:
+                    launch()
+                    self.failovers += 1
+                    hedge_at = None
+            return last_result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def route_candidates(self, image:Image.Image|PreparedImage, n:int, providers:List[str]|None=None,
+    models:Dict[str, str]|None=None, use_cache:bool|None=None)->Tuple[str, List[str]]:
+        """Up to n captions from the fastest healthy provider, failing over in rank order.
+
+        Returns (provider, candidates). Never hedged: a candidates request costs n captions.
+        """
+        image = self.generator.prepare_image(image)
+        models = models or {}
+        error = "No caption providers are configured"
+        for attempt, provider in enumerate(self.rank(providers)):
+            if attempt:
+                self.failovers += 1
+            start = time.perf_counter()
+            try:
+                candidates = self.generator.generate_candidates(image, provider, n=n, model=models.get(provider),
+                    use_cache=use_cache)
+            except Exception as e:
+                self.record(provider, time.perf_counter() - start, False)
+                error = f"{provider}: {e}"
+                continue
+            if not self.generator.served_from_cache():
+                self.record(provider, time.perf_counter() - start, True)
+            return provider, candidates
+        raise ValueError(error)
+
+    def route(self, image:Image.Image|PreparedImage, providers:List[str]|None=None,
+    models:Dict[str, str]|None=None, hedge:bool|None=None, use_cache:bool|None=None)->CaptionResult:
+        return asyncio.run(self.aroute(image, providers=providers, models=models, hedge=hedge, use_cache=use_cache))
+
+    def snapshot(self)->Dict[str, Dict]:
+        with self._lock:
+            return {provider: stats.snapshot() for provider, stats in self._stats.items()}
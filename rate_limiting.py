@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import heapq
+import random
+import datetime
+import itertools
+import threading
+from email.utils import parsedate_to_datetime
+from dataclasses import dataclass, field, fields
+from typing import Callable, Dict, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+# SDK errors that carry no status code but are worth retrying
+RETRYABLE_ERROR_NAMES = {"APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout"}
+
+
+@dataclass
+class ProviderLimits:
+    requests_per_minute: float|None = None
+    tokens_per_minute: float|None = None
+    # Stay a little under the quota so clock skew doesn't tip us into 429s
+    safety_margin: float = 0.9
+    burst_seconds: float = 2.0
+    max_retries: int = 5
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+
+
+# Conservative free-tier style defaults; override with env vars or a config file
+DEFAULT_LIMITS = {
+    "openai": ProviderLimits(requests_per_minute=500, tokens_per_minute=200_000),
+    "groq": ProviderLimits(requests_per_minute=30, tokens_per_minute=30_000),
+    "gemini": ProviderLimits(requests_per_minute=15, tokens_per_minute=250_000)
+}
+
+
+def load_provider_limits(config_path:str|None=None)->Dict[str, ProviderLimits]:
+    """Defaults, overridden by a JSON config file, overridden by env vars like OPENAI_RPM_ICG / OPENAI_TPM_ICG"""
+    config_path = config_path or os.getenv("RATE_LIMITS_ICG", "rate_limits.json")
+    overrides: Dict[str, Dict] = {}
+    if config_path and os.path.exists(config_path):
+        with open(config_path, mode="r") as f:
+            overrides = json.load(f)
+
+    known = {f.name for f in fields(ProviderLimits)}
+    limits = {}
+    for provider in set(DEFAULT_LIMITS) | set(overrides):
+        values = dict(vars(DEFAULT_LIMITS.get(provider, ProviderLimits())))
+        values.update({key: value for key, value in overrides.get(provider, {}).items() if key in known})
+
+        rpm = os.getenv(f"{provider.upper()}_RPM_ICG")
+        tpm = os.getenv(f"{provider.upper()}_TPM_ICG")
+        if rpm:
+            values["requests_per_minute"] = float(rpm)
+        if tpm:
+            values["tokens_per_minute"] = float(tpm)
+        limits[provider] = ProviderLimits(**values)
+    return limits
+
+
+class TokenBucket:
+    """Refills continuously at rate_per_minute, holding at most burst_seconds worth of tokens"""
+
+    def __init__(self, rate_per_minute:float, burst_seconds:float=2.0) -> None:
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now:float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount:float, now:float)->float:
+        self._refill(now)
+        # A request larger than the bucket may go once the bucket is full, then runs it negative
+        needed = min(amount, self.capacity) - self.tokens
+        return max(0.0, needed / self.rate)
+
+    def take(self, amount:float):
+        self.tokens -= amount
+
+    def drain(self):
+        self.tokens = min(self.tokens, 0.0)
+
+
+def status_code(error:Exception)->int|None:
+    code = getattr(error, "status_code", None)
+    if code is None:
+        # google.api_core exceptions expose the HTTP status as `code`
+        code = getattr(error, "code", None)
+    return int(code) if isinstance(code, int) else None
+
+
+def retry_after(error:Exception)->float|None:
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, (retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error:Exception)->bool:
+    code = status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    sequence: int
+    tokens: float = field(compare=False)
+
+
+class _ProviderState:
+    def __init__(self, limits:ProviderLimits) -> None:
+        self.limits = limits
+        margin = limits.safety_margin
+        self.requests = TokenBucket(limits.requests_per_minute * margin, limits.burst_seconds) \
+            if limits.requests_per_minute else None
+        self.tokens = TokenBucket(limits.tokens_per_minute * margin, limits.burst_seconds) \
+            if limits.tokens_per_minute else None
+        self.paused_until = 0.0
+        self.waiters: List[_Waiter] = []
+        self.stats = {"calls": 0, "retries": 0, "rate_limited": 0, "failures": 0, "wait_seconds": 0.0}
+
+    def wait_time(self, tokens:float, now:float)->float:
+        wait = max(0.0, self.paused_until - now)
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return wait
+
+
+class RequestScheduler:
+    """Per-provider admission control with retries.
+
+    Each provider has token buckets for requests and tokens per minute. Callers wait in a
+    priority queue, so interactive requests are admitted ahead of queued batch requests;
+    only the head of the queue may take capacity. Failed calls with a retryable status are
+    retried with full-jitter exponential backoff, never sooner than the server's Retry-After,
+    and a 429 pauses the whole provider for that long.
+    """
+
+    def __init__(self, limits:Dict[str, ProviderLimits]|None=None) -> None:
+        self.limits = limits if limits is not None else load_provider_limits()
+        self._states: Dict[str, _ProviderState] = {}
+        self._cond = threading.Condition()
+        self._sequence = itertools.count()
+
+    def _state(self, provider:str)->_ProviderState:
+        state = self._states.get(provider)
+        if state is None:
+            state = self._states[provider] = _ProviderState(self.limits.get(provider, ProviderLimits()))
+        return state
+
+    def acquire(self, provider:str, tokens:float=1, priority:int=PRIORITY_INTERACTIVE):
+        start = time.monotonic()
+        with self._cond:
+            state = self._state(provider)
+            waiter = _Waiter(priority, next(self._sequence), tokens)
+            heapq.heappush(state.waiters, waiter)
+            try:
+                while True:
+                    if state.waiters[0] is waiter:
+                        wait = state.wait_time(tokens, time.monotonic())
+                        if wait <= 0:
+                            if state.requests is not None:
+                                state.requests.take(1)
+                            if state.tokens is not None:
+                                state.tokens.take(tokens)
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+            finally:
+                state.waiters.remove(waiter)
+                heapq.heapify(state.waiters)
+                state.stats["wait_seconds"] += time.monotonic() - start
+                self._cond.notify_all()
+
+    def reconcile(self, provider:str, estimated:float, actual:float|None):
+        """Charge the token bucket for the difference between the estimate and real usage"""
+        if actual is None:
+            return
+        with self._cond:
+            state = self._state(provider)
+            if state.tokens is not None:
+                state.tokens.take(actual - estimated)
+            self._cond.notify_all()
+
+    def _backoff(self, provider:str, attempt:int, error:Exception)->float:
+        with self._cond:
+            state = self._state(provider)
+            limits = state.limits
+            delay = random.uniform(0, min(limits.max_delay, limits.base_delay * 2 ** attempt))
+            server_delay = retry_after(error)
+            if server_delay is not None:
+                delay = max(delay, server_delay)
+            if status_code(error) == 429:
+                # The server says we are over quota: stop everyone, not just this caller
+                state.stats["rate_limited"] += 1
+                state.paused_until = max(state.paused_until, time.monotonic() + delay)
+                if state.requests is not None:
+                    state.requests.drain()
+            state.stats["retries"] += 1
+            self._cond.notify_all()
+            return delay
+
+    def call(self, provider:str, fn:Callable[[], T], tokens:float=1,
+    priority:int=PRIORITY_INTERACTIVE)->T:
+        max_retries = self._state(provider).limits.max_retries
+        for attempt in range(max_retries + 1):
+            self.acquire(provider, tokens, priority)
+            with self._cond:
+                self._state(provider).stats["calls"] += 1
+            try:
+                return fn()
+            except Exception as e:
+                if attempt >= max_retries or not is_retryable(e):
+                    with self._cond:
+                        self._state(provider).stats["failures"] += 1
+                    raise
+                delay = self._backoff(provider, attempt, e)
+                # 429 pauses are waited out in acquire(), in priority order with everyone else
+                if status_code(e) != 429:
+                    time.sleep(delay)
+
+    def stats(self)->Dict[str, Dict]:
+        with self._cond:
+            return {provider: {**state.stats, "queued": len(state.waiters)}
+                for provider, state in self._states.items()}
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def default_scheduler()->RequestScheduler:
+    """Process-wide scheduler, so every session and batch worker shares one quota"""
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RequestScheduler()
+        return _default_scheduler
+
+
+def estimate_tokens(size:Tuple[int, int], prompt:str, max_output_tokens:int=60)->int:
+    """Rough input+output token cost of one caption request, using 512px image tiles"""
+    width, height = size
+    tiles = -(-width // 512) * -(-height // 512)
+    return 85 + 170 * tiles + len(prompt) // 4 + max_output_tokens
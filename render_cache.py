@@ -0,0 +1,122 @@
+import io
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple
+
+from PIL import Image
+
+from telemetry import timed
+
+# Download format name -> (PIL format, file extension, MIME type)
+DOWNLOAD_FORMATS = {
+    "PNG": ("PNG", "png", "image/png"),
+    "JPEG": ("JPEG", "jpg", "image/jpeg"),
+    "WebP": ("WEBP", "webp", "image/webp")
+}
+
+
+def render_key(fingerprint:str, caption:str, method:str, settings:Dict)->str:
+    """Identifies a rendered preview by the image content, the caption and every render setting"""
+    payload = json.dumps([fingerprint, caption, method, settings], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _entry_size(value:Image.Image|bytes)->int:
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    return len(value)
+
+
+@timed("render.encode")
+def encode_image(image:Image.Image, fmt:str="PNG", quality:int=90)->bytes:
+    pil_format = DOWNLOAD_FORMATS[fmt][0]
+    buffer = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buffer, format=pil_format)
+    else:
+        image.save(buffer, format=pil_format, quality=quality)
+    return buffer.getvalue()
+
+
+class RenderCache:
+    """LRU cache of rendered previews and their encoded payloads, bounded by total bytes.
+
+    Entries are shared by render key, so a rerun with unchanged image, caption and settings
+    reuses the rendered image, the preview bytes and any download already encoded.
+    """
+
+    def __init__(self, max_bytes:int=512 * 1024 * 1024, preview_max_edge:int=1600) -> None:
+        self.max_bytes = max_bytes
+        self.preview_max_edge = preview_max_edge
+        self._entries: OrderedDict[Tuple, Image.Image|bytes] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key:Tuple)->Image.Image|bytes|None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _put(self, key:Tuple, value:Image.Image|bytes):
+        size = _entry_size(value)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= _entry_size(previous)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= _entry_size(evicted)
+
+    def _get_or_create(self, key:Tuple, create:Callable[[], Image.Image|bytes])->Image.Image|bytes:
+        value = self._get(key)
+        if value is None:
+            value = create()
+            self._put(key, value)
+        return value
+
+    def render(self, key:str, render:Callable[[], Image.Image])->Image.Image:
+        return self._get_or_create(("render", key), render)
+
+    def preview(self, key:str, image:Image.Image)->bytes:
+        """Display-sized JPEG of a rendered image, so reruns don't re-encode the full frame"""
+        def create()->bytes:
+            preview = image
+            if max(image.size) > self.preview_max_edge:
+                preview = image.copy()
+                preview.thumbnail((self.preview_max_edge, self.preview_max_edge), Image.Resampling.LANCZOS)
+            return encode_image(preview, "JPEG", quality=90)
+        return self._get_or_create(("preview", key), create)
+
+    def download(self, key:str, image:Image.Image, fmt:str="PNG", quality:int=90)->bytes:
+        if fmt == "PNG":
+            quality = 0
+        return self._get_or_create(("download", key, fmt, quality), lambda: encode_image(image, fmt, quality))
+
+    def export(self, key:str, render:Callable[[], Image.Image], fmt:str="PNG", quality:int=90)->bytes:
+        """Like download, but renders on a miss and keeps only the encoded bytes, e.g. for full-resolution exports"""
+        if fmt == "PNG":
+            quality = 0
+        return self._get_or_create(("export", key, fmt, quality), lambda: encode_image(render(), fmt, quality))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self)->Dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                "bytes": self._bytes, "max_bytes": self.max_bytes}
@@ -0,0 +1,367 @@
+import os
+import time
+import uuid
+import bisect
+import datetime
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+# Seconds; covers everything from a cached lookup to a slow provider round trip
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTE_BUCKETS = tuple(1024 * 4 ** power for power in range(8))
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+METRIC_HELP = {
+    "icg_stage_seconds": ("histogram", "Time spent in each processing stage"),
+    "icg_provider_request_seconds": ("histogram", "Provider round trip time, including scheduler waits and retries"),
+    "icg_provider_requests_total": ("counter", "Provider requests by outcome"),
+    "icg_payload_bytes": ("histogram", "Encoded image payload size sent to the provider"),
+    "icg_tokens_total": ("counter", "Tokens reported by the provider"),
+    "icg_tokens": ("histogram", "Tokens reported by the provider per request"),
+    "icg_cache_requests_total": ("counter", "Caption cache lookups by result"),
+    "icg_time_to_first_token_seconds": ("histogram", "Time from opening a caption stream to its first text")
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels:Dict[str, Any])->LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None))
+
+
+class Histogram:
+    def __init__(self, buckets:Tuple[float, ...]=LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q:float)->float|None:
+        """Upper bound of the bucket holding the q-quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """Counters and histograms keyed by metric name and labels, exportable as Prometheus text"""
+
+    def __init__(self) -> None:
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name:str, value:float=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name:str, value:float, buckets:Tuple[float, ...]=LATENCY_BUCKETS, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def snapshot(self)->Dict[str, List[Dict]]:
+        with self._lock:
+            snapshot = {}
+            for name, series in self._counters.items():
+                snapshot[name] = [{**dict(key), "value": value} for key, value in series.items()]
+            for name, series in self._histograms.items():
+                snapshot[name] = [{**dict(key), "count": histogram.count, "sum": histogram.sum,
+                    "p50": histogram.quantile(0.5), "p95": histogram.quantile(0.95)}
+                    for key, histogram in series.items()]
+            return snapshot
+
+    def render_prometheus(self)->str:
+        def labels_text(key:LabelKey, extra:Tuple[Tuple[str, str], ...]=())->str:
+            pairs = key + extra
+            if not pairs:
+                return ""
+            escaped = [(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                for name, value in pairs]
+            return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+        def header(name:str, kind:str)->List[str]:
+            help_text = METRIC_HELP.get(name, (kind, name))[1]
+            return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines += header(name, "counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{labels_text(key)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                lines += header(name, "histogram")
+                for key, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{name}_bucket{labels_text(key, (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{labels_text(key)} {histogram.sum:g}")
+                    lines.append(f"{name}_count{labels_text(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path:str):
+        # Written aside and renamed, so a scraper never reads a half-written file
+        temp_path = f"{path}.tmp"
+        with open(temp_path, mode="w") as f:
+            f.write(self.render_prometheus())
+        os.replace(temp_path, path)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+@dataclass
+class Span:
+    name: str
+    offset: float
+    duration: float
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+
+class Trace:
+    """One request's stage timings, in the order the stages finished"""
+
+    def __init__(self, name:str, attributes:Dict[str, Any]) -> None:
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attributes = attributes
+        self.timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.start = time.perf_counter()
+        self.duration: float|None = None
+        self.error: str|None = None
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, name:str, start:float, duration:float, attributes:Dict[str, Any]):
+        with self._lock:
+            self.spans.append(Span(name, start - self.start, duration, attributes))
+
+    def stage_totals(self)->Dict[str, float]:
+        totals: Dict[str, float] = {}
+        with self._lock:
+            for span in self.spans:
+                totals[span.name] = totals.get(span.name, 0.0) + span.duration
+        return totals
+
+    def to_dict(self)->Dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": self.attributes,
+            "stages": self.stage_totals(),
+            "spans": [{"name": span.name, "offset": span.offset, "duration": span.duration, **span.attributes}
+                for span in self.spans]
+        }
+
+
+_current_trace: contextvars.ContextVar[Trace|None] = contextvars.ContextVar("icg_current_trace", default=None)
+
+
+def _opentelemetry_tracer():
+    try:
+        from opentelemetry import trace as otel_trace
+    except ImportError:
+        return None
+    return otel_trace.get_tracer("image_caption_generator")
+
+
+class Tracer:
+    """Times stages into `icg_stage_seconds` and groups them into per-request traces.
+
+    Spans opened inside `trace()` are kept with that request, and the last `keep` requests
+    are available from `recent()`. With `opentelemetry=True` each span is also emitted as an
+    OpenTelemetry span when the opentelemetry package is installed.
+    """
+
+    def __init__(self, metrics:MetricsRegistry, keep:int=50, opentelemetry:bool=False) -> None:
+        self.metrics = metrics
+        self._recent: deque[Trace] = deque(maxlen=keep)
+        self._lock = threading.Lock()
+        self._otel = _opentelemetry_tracer() if opentelemetry else None
+
+    @contextmanager
+    def trace(self, name:str, **attributes)->Iterator[Trace]:
+        trace = Trace(name, attributes)
+        token = _current_trace.set(trace)
+        try:
+            with self._otel_span(name, attributes):
+                yield trace
+        except BaseException as e:
+            trace.error = str(e) or type(e).__name__
+            raise
+        finally:
+            _current_trace.reset(token)
+            trace.duration = time.perf_counter() - trace.start
+            with self._lock:
+                self._recent.append(trace)
+
+    @contextmanager
+    def span(self, name:str, **attributes)->Iterator[Dict[str, Any]]:
+        """Time a stage; the yielded dict can take attributes learned while the stage runs"""
+        start = time.perf_counter()
+        try:
+            with self._otel_span(name, attributes):
+                yield attributes
+        finally:
+            self.record(name, start, time.perf_counter() - start, **attributes)
+
+    def record(self, name:str, start:float, duration:float, **attributes):
+        """Record a stage timed by the caller, e.g. one spanning a generator's lifetime"""
+        self.metrics.observe("icg_stage_seconds", duration, stage=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, start, duration, attributes)
+
+    @contextmanager
+    def _otel_span(self, name:str, attributes:Dict[str, Any]):
+        if self._otel is None:
+            yield
+            return
+        otel_attributes = {key: value for key, value in attributes.items()
+            if isinstance(value, (str, bool, int, float))}
+        with self._otel.start_as_current_span(name, attributes=otel_attributes):
+            yield
+
+    def recent(self, limit:int|None=None)->List[Dict]:
+        """Most recent traces first"""
+        with self._lock:
+            traces = list(self._recent)[::-1]
+        return [trace.to_dict() for trace in traces[:limit]]
+
+
+def current_trace()->Trace|None:
+    return _current_trace.get()
+
+
+def in_context(fn:Callable, *args)->Callable[[], Any]:
+    """Bind fn to the caller's trace, for handing to an executor thread"""
+    context = contextvars.copy_context()
+    return lambda: context.run(fn, *args)
+
+
+_default_metrics: MetricsRegistry|None = None
+_default_tracer: Tracer|None = None
+_default_lock = threading.Lock()
+
+
+def default_metrics()->MetricsRegistry:
+    global _default_metrics
+    with _default_lock:
+        if _default_metrics is None:
+            _default_metrics = MetricsRegistry()
+        return _default_metrics
+
+
+def default_tracer()->Tracer:
+    """Process-wide tracer; TRACING_ICG=otel also emits OpenTelemetry spans"""
+    global _default_tracer
+    metrics = default_metrics()
+    with _default_lock:
+        if _default_tracer is None:
+            _default_tracer = Tracer(metrics, opentelemetry=os.getenv("TRACING_ICG", "").lower() == "otel")
+        return _default_tracer
+
+
+def span(name:str, **attributes):
+    return default_tracer().span(name, **attributes)
+
+
+def timed(stage:str):
+    """Decorator form of span() for functions that are one stage as a whole"""
+    def decorator(fn:Callable)->Callable:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with default_tracer().span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_prometheus(registry:MetricsRegistry|None=None, host:str="127.0.0.1", port:int=9464)->ThreadingHTTPServer:
+    """Serve /metrics from a daemon thread; call shutdown() on the returned server to stop it"""
+    handler = type("BoundMetricsHandler", (MetricsHandler,), {"registry": registry or default_metrics()})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+class FileExporter:
+    """Rewrites a Prometheus text file every `interval` seconds, e.g. for node_exporter's textfile collector"""
+
+    def __init__(self, path:str, registry:MetricsRegistry|None=None, interval:float=15.0) -> None:
+        self.path = path
+        self.registry = registry or default_metrics()
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-file", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.registry.write(self.path)
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self.registry.write(self.path)
+
+
+def start_exporters_from_env()->List[object]:
+    """Starts the exporters asked for by METRICS_PORT_ICG and METRICS_FILE_ICG"""
+    exporters = []
+    port = os.getenv("METRICS_PORT_ICG")
+    if port:
+        exporters.append(serve_prometheus(host=os.getenv("METRICS_HOST_ICG", "127.0.0.1"), port=int(port)))
+    path = os.getenv("METRICS_FILE_ICG")
+    if path:
+        exporters.append(FileExporter(path, interval=float(os.getenv("METRICS_INTERVAL_ICG", 15))))
+    return exporters
@@ -0,0 +1,175 @@
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, List, Tuple
+
+import cv2
+from PIL import Image, ImageDraw, ImageFont
+
+# Only used for measuring; textbbox doesn't depend on the canvas contents
+_MEASURE_DRAW = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+
+
+@lru_cache(maxsize=64)
+def load_font(font_path:str|None, size:int)->ImageFont.ImageFont|ImageFont.FreeTypeFont:
+    """Process-wide cache of loaded fonts keyed by (path, size); falls back to the default font"""
+    if not font_path:
+        return ImageFont.load_default()
+    try:
+        return ImageFont.truetype(font_path, size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+class TextMeasurer:
+    """Caches text widths for one font and wraps captions from per-word widths.
+
+    Line widths are estimated by adding cached word advances plus the width of the joining
+    space. Only when an estimate lands within `slack` of the wrap limit is the full line
+    measured exactly, so the wrapped lines are the same as measuring every prefix.
+    """
+
+    def __init__(self, measure:Callable[[str], int], slack:Callable[[int], float],
+    advance:Callable[[str], float]|None=None, space_width:float|None=None,
+    max_cached_lines:int=4096) -> None:
+        self._measure = measure
+        self._advance = advance or measure
+        self._slack = slack
+        self._word_widths: Dict[str, float] = {}
+        self._line_widths: OrderedDict[str, int] = OrderedDict()
+        self._max_cached_lines = max_cached_lines
+        self._lock = threading.Lock()
+
+        # Width a single space adds between two words, including any per-call padding
+        if space_width is None:
+            space_width = self._advance("x x") - 2 * self._advance("x")
+        self.space_width = space_width
+        self.exact_measurements = 0
+
+    def width(self, text:str)->int:
+        with self._lock:
+            width = self._line_widths.get(text)
+            if width is not None:
+                self._line_widths.move_to_end(text)
+                return width
+
+        width = self._measure(text)
+        with self._lock:
+            self.exact_measurements += 1
+            self._line_widths[text] = width
+            while len(self._line_widths) > self._max_cached_lines:
+                self._line_widths.popitem(last=False)
+        return width
+
+    def word_width(self, word:str)->float:
+        width = self._word_widths.get(word)
+        if width is None:
+            width = self._advance(word)
+            self._word_widths[word] = width
+        return width
+
+    def _fits(self, line:str, estimate:float, word_count:int, max_width:int)->bool:
+        slack = self._slack(word_count)
+        if estimate + slack <= max_width:
+            return True
+        if estimate - slack > max_width:
+            return False
+        return self.width(line) <= max_width
+
+    def wrap(self, caption:str, max_width:int)->List[str]:
+        words = caption.split()
+        if " ".join(words) == caption and words:
+            estimate = sum(self.word_width(word) for word in words) + self.space_width * (len(words) - 1)
+            fits = self._fits(caption, estimate, len(words), max_width)
+        else:
+            # Irregular whitespace is drawn as-is, so it has to be measured as-is
+            fits = self.width(caption) <= max_width
+        if fits:
+            return [caption]
+
+        lines = []
+        current_line = ""
+        current_estimate = 0.0
+        current_words = 0
+
+        for word in words:
+            if current_line:
+                test_line = current_line + " " + word
+                test_estimate = current_estimate + self.space_width + self.word_width(word)
+            else:
+                test_line = word
+                test_estimate = self.word_width(word)
+
+            if self._fits(test_line, test_estimate, current_words + 1, max_width):
+                current_line = test_line
+                current_estimate = test_estimate
+                current_words += 1
+            else:
+                if current_line:
+                    lines.append(current_line)
+                current_line = word
+                current_estimate = self.word_width(word)
+                current_words = 1
+
+        if current_line:
+            lines.append(current_line)
+        return lines
+
+
+_measurers: OrderedDict[Tuple, TextMeasurer] = OrderedDict()
+_measurers_lock = threading.Lock()
+MAX_MEASURERS = 128
+
+
+def _cached_measurer(key:Tuple, factory:Callable[[], TextMeasurer])->TextMeasurer:
+    with _measurers_lock:
+        measurer = _measurers.get(key)
+        if measurer is None:
+            measurer = _measurers[key] = factory()
+            while len(_measurers) > MAX_MEASURERS:
+                _measurers.popitem(last=False)
+        else:
+            _measurers.move_to_end(key)
+        return measurer
+
+
+@lru_cache(maxsize=8192)
+def pil_text_bbox(font:ImageFont.ImageFont|ImageFont.FreeTypeFont, text:str)->Tuple[int, int, int, int]:
+    return _MEASURE_DRAW.textbbox((0, 0), text, font=font)
+
+
+def pil_text_height(font:ImageFont.ImageFont|ImageFont.FreeTypeFont, caption:str, lines:List[str])->int:
+    """Height of the whole caption's box, taken from the wrapped lines' boxes when possible"""
+    if not lines or lines == [caption]:
+        bbox = pil_text_bbox(font, caption)
+        return bbox[3] - bbox[1]
+    boxes = [pil_text_bbox(font, line) for line in lines]
+    return max(box[3] for box in boxes) - min(box[1] for box in boxes)
+
+
+def pil_measurer(font:ImageFont.ImageFont|ImageFont.FreeTypeFont)->TextMeasurer:
+    def measure(text:str)->int:
+        bbox = pil_text_bbox(font, text)
+        return bbox[2] - bbox[0]
+
+    # Advances add up exactly; only the glyph bearings at the two line ends differ from the ink box
+    font_size = getattr(font, "size", 10)
+    return _cached_measurer(("pil", font), lambda: TextMeasurer(
+        measure, lambda words: font_size * 0.5 + words + 2,
+        advance=font.getlength, space_width=font.getlength(" ")
+    ))
+
+
+def cv2_measurer(font_face:int, font_scale:float, thickness:int)->TextMeasurer:
+    def measure(text:str)->int:
+        return cv2.getTextSize(text, font_face, font_scale, thickness)[0][0]
+
+    # Each measured piece is rounded separately, so allow a couple of pixels per word
+    return _cached_measurer(("cv2", font_face, font_scale, thickness), lambda: TextMeasurer(
+        measure, lambda words: 2 * words + 2
+    ))
+
+
+@lru_cache(maxsize=1024)
+def cv2_text_size(text:str, font_face:int, font_scale:float, thickness:int)->Tuple[int, int]:
+    return tuple(cv2.getTextSize(text, font_face, font_scale, thickness)[0])
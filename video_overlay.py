@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import argparse
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import cv2
+import numpy as np
+
+from caption_overlay import ImageCaptionOverlay
+
+VIDEO_EXTENSIONS = {".mp4", ".avi", ".mov", ".mkv", ".webm", ".m4v"}
+
+
+class CaptionSprite:
+    """A caption block rasterized once as premultiplied BGR plus alpha, cropped to its ROI"""
+
+    def __init__(self, premultiplied:np.ndarray, inverse_alpha:np.ndarray, origin:Tuple[int, int]) -> None:
+        self.premultiplied = premultiplied
+        self.inverse_alpha = inverse_alpha
+        self.origin = origin
+        self._scratch = np.empty(premultiplied.shape, dtype=np.uint16)
+
+    @classmethod
+    def render(cls, frame_size:Tuple[int, int], caption:str, position:str="bottom", font_size:float=1,
+    thickness:int=2, font_path:str|None=None)->"CaptionSprite":
+        width, height = frame_size
+
+        # Render the normal overlay over black and over white; the difference recovers alpha
+        on_black = ImageCaptionOverlay.add_caption_overlay(np.zeros((height, width, 3), np.uint8), caption,
+            position=position, font_size=font_size, thickness=thickness, font_path=font_path)
+        on_white = ImageCaptionOverlay.add_caption_overlay(np.full((height, width, 3), 255, np.uint8), caption,
+            position=position, font_size=font_size, thickness=thickness, font_path=font_path)
+
+        alpha = 255 - (on_white.astype(np.int16) - on_black.astype(np.int16)).max(axis=2)
+        alpha = np.clip(alpha, 0, 255).astype(np.uint16)
+
+        rows = np.flatnonzero(alpha.any(axis=1))
+        cols = np.flatnonzero(alpha.any(axis=0))
+        if rows.size == 0:
+            return cls(np.zeros((0, 0, 3), np.uint16), np.zeros((0, 0, 1), np.uint16), (0, 0))
+
+        y0, y1 = rows[0], rows[-1] + 1
+        x0, x1 = cols[0], cols[-1] + 1
+        # Over black the rendered colour is already colour * alpha, i.e. premultiplied
+        premultiplied = on_black[y0:y1, x0:x1].astype(np.uint16) * 255
+        inverse_alpha = (255 - alpha[y0:y1, x0:x1])[..., None]
+        return cls(premultiplied, np.ascontiguousarray(inverse_alpha), (int(x0), int(y0)))
+
+    def composite(self, frame:np.ndarray)->np.ndarray:
+        """Alpha-blend the sprite onto the frame in place, touching only the sprite's ROI"""
+        if self.premultiplied.size == 0:
+            return frame
+
+        x0, y0 = self.origin
+        height, width = self.premultiplied.shape[:2]
+        roi = frame[y0:y0 + height, x0:x0 + width]
+
+        # out = (fg * a + bg * (255 - a)) / 255 in integer arithmetic, rounded
+        scratch = self._scratch
+        np.multiply(roi, self.inverse_alpha, out=scratch, casting="unsafe")
+        scratch += self.premultiplied
+        scratch += 127
+        scratch //= 255
+        roi[...] = scratch
+        return frame
+
+
+def caption_frames(frames:Iterable[np.ndarray], caption:str, **style)->Iterator[np.ndarray]:
+    """Caption a stream of BGR frames, rasterizing the caption once per frame size"""
+    sprites: Dict[Tuple[int, int], CaptionSprite] = {}
+    for frame in frames:
+        size = (frame.shape[1], frame.shape[0])
+        sprite = sprites.get(size)
+        if sprite is None:
+            sprite = sprites[size] = CaptionSprite.render(size, caption, **style)
+        yield sprite.composite(frame)
+
+
+def iter_video_frames(capture:cv2.VideoCapture)->Iterator[np.ndarray]:
+    frame = None
+    while True:
+        # Reuse the previous buffer so decoding doesn't allocate a new frame each time
+        ok, frame = capture.read(frame)
+        if not ok:
+            return
+        yield frame
+
+
+def caption_video(input_path:str, output_path:str, caption:str, fourcc:str="mp4v", **style)->Dict:
+    capture = cv2.VideoCapture(input_path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video: {input_path}")
+
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+    if not writer.isOpened():
+        capture.release()
+        raise ValueError(f"Could not open video writer for: {output_path}")
+
+    frames = 0
+    start = time.perf_counter()
+    try:
+        for frame in caption_frames(iter_video_frames(capture), caption, **style):
+            writer.write(frame)
+            frames += 1
+    finally:
+        capture.release()
+        writer.release()
+
+    elapsed = time.perf_counter() - start
+    return {"frames": frames, "elapsed": elapsed, "frames_per_second": frames / elapsed if elapsed else 0.0}
+
+
+def output_names(paths:List[str])->Dict[str, str]:
+    """Output paths relative to the inputs' common folder, so same-named files in different folders don't collide"""
+    if not paths:
+        return {}
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    return {path: os.path.relpath(os.path.abspath(path), root) for path in paths}
+
+
+def caption_image_sequence(paths:List[str], output_dir:str, caption:str, **style)->Dict:
+    os.makedirs(output_dir, exist_ok=True)
+    names = output_names(paths)
+    errors: List[Dict] = []
+    read_paths: deque[str] = deque()
+
+    def read_frames()->Iterator[np.ndarray]:
+        for path in paths:
+            frame = cv2.imread(path)
+            if frame is None:
+                # Reported and skipped, so one bad file doesn't abort the rest of the sequence
+                errors.append({"path": path, "error": f"Could not read image: {path}"})
+                continue
+            read_paths.append(path)
+            yield frame
+
+    frames = 0
+    start = time.perf_counter()
+    for frame in caption_frames(read_frames(), caption, **style):
+        output_path = os.path.join(output_dir, names[read_paths.popleft()])
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        cv2.imwrite(output_path, frame)
+        frames += 1
+
+    elapsed = time.perf_counter() - start
+    return {"frames": frames, "elapsed": elapsed, "frames_per_second": frames / elapsed if elapsed else 0.0,
+        "errors": errors}
+
+
+def main(argv:List[str]|None=None)->int:
+    parser = argparse.ArgumentParser(description="Burn a caption into a video or an image sequence")
+    parser.add_argument("inputs", nargs="+", help="A video file, or image files forming a sequence")
+    parser.add_argument("-o", "--output", required=True, help="Output video file or directory for images")
+    parser.add_argument("-c", "--caption", required=True)
+    parser.add_argument("--position", default="bottom", choices=["bottom", "center", "top"])
+    parser.add_argument("--font-size", type=float, default=1.0)
+    parser.add_argument("--thickness", type=int, default=2)
+    parser.add_argument("--font", default=None, help="TrueType font path")
+    parser.add_argument("--fourcc", default="mp4v")
+    args = parser.parse_args(argv)
+
+    style = {"position": args.position, "font_size": args.font_size, "thickness": args.thickness,
+        "font_path": args.font}
+    if len(args.inputs) == 1 and os.path.splitext(args.inputs[0])[1].lower() in VIDEO_EXTENSIONS:
+        stats = caption_video(args.inputs[0], args.output, args.caption, fourcc=args.fourcc, **style)
+    else:
+        stats = caption_image_sequence(sorted(args.inputs), args.output, args.caption, **style)
+
+    print(f"Captioned {stats['frames']} frames in {stats['elapsed']:.2f}s "
+        f"({stats['frames_per_second']:.1f} frames/s)")
+    for error in stats.get("errors", []):
+        print(error["error"], file=sys.stderr)
+    return 1 if stats.get("errors") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())